@@ -0,0 +1,63 @@
+"""
+Benchmark SyncBatch construction and (de)serialization on synthetic manifests.
+
+Builds manifests of increasing size (up to 1M chunks by default) and reports
+time per chunk for from_dict(), to_dict() and chunk_diff() against an identical batch.
+Per chunk times should stay roughly constant as the manifest grows, i.e. batch
+construction is linear in number of chunks.
+
+Usage: python benchmarks/bench_batch.py [--max-chunks N] [--chunks-per-file N]
+"""
+import argparse, time, gc, hashlib
+
+from lanscatter.chunker import SyncBatch
+
+
+def make_manifest(n_chunks: int, chunks_per_file: int, chunk_size: int = 1024*1024) -> dict:
+    """Make a SyncBatch.to_dict() compatible dictionary with n_chunks chunks"""
+    files, chunks = [], []
+    n_files = (n_chunks + chunks_per_file - 1) // chunks_per_file
+    for fi in range(n_files):
+        path = f'dir_{fi % 100:03d}/file_{fi:08d}.bin'
+        n = min(chunks_per_file, n_chunks - fi * chunks_per_file)
+        for ci in range(n):
+            h = hashlib.blake2b(f'{fi}/{ci}'.encode(), digest_size=12).hexdigest()
+            chunks.append({'path': path, 'pos': ci * chunk_size, 'size': chunk_size, 'cmpratio': 1.0, 'hash': h})
+        files.append({'path': path, 'size': n * chunk_size, 'mtime': 1500000000 + fi, 'chain_hash': None})
+    return {'chunk_size': chunk_size, 'sub_chunk_size': chunk_size // 8, 'files': files, 'chunks': chunks}
+
+
+def timed(func):
+    gc.collect()
+    t = time.perf_counter()
+    res = func()
+    return res, time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-chunks', type=int, default=1000000, help='Largest manifest size to test')
+    parser.add_argument('--chunks-per-file', type=int, default=20, help='Chunks per synthetic file')
+    args = parser.parse_args()
+
+    sizes = []
+    n = args.max_chunks
+    while n >= 10000 and len(sizes) < 5:
+        sizes.insert(0, n)
+        n //= 2
+
+    print(f"{'chunks':>10} {'files':>8} {'from_dict s':>12} {'us/chunk':>9} {'to_dict s':>10} {'us/chunk':>9} "
+          f"{'diff s':>8} {'us/chunk':>9}")
+    for n in sizes:
+        manifest = make_manifest(n, args.chunks_per_file)
+        batch, t_from = timed(lambda: SyncBatch.from_dict(manifest))
+        __, t_to = timed(lambda: batch.to_dict())
+        other = SyncBatch.from_dict(manifest)
+        __, t_diff = timed(lambda: batch.chunk_diff(other))
+        print(f"{n:>10} {len(manifest['files']):>8} {t_from:>12.2f} {t_from/n*1e6:>9.2f} {t_to:>10.2f} {t_to/n*1e6:>9.2f} "
+              f"{t_diff:>8.2f} {t_diff/n*1e6:>9.2f}")
+        del batch, other, manifest
+
+
+if __name__ == '__main__':
+    main()
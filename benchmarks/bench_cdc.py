@@ -0,0 +1,76 @@
+"""
+Benchmark content defined chunking (chunker.cdc_chunk_ends) against fixed size chunks.
+
+Writes a random test file, then reports:
+ - speed of finding CDC chunk boundaries, with numpy and with the pure Python fallback
+ - chunk size distribution
+ - how much of the data would have to be transferred again after a few small insertions into the
+   file, with fixed and content defined chunks (= size of chunks whose hashes are new)
+
+Usage: python benchmarks/bench_cdc.py [--size-mb N] [--chunk-size N] [--edits N] [--python-mb N]
+"""
+import argparse, asyncio, os, random, tempfile
+from pathlib import Path
+
+from lanscatter import chunker
+from lanscatter.chunker import scan_dir
+from lanscatter.fileio import FileIO
+from lanscatter.common import Defaults
+from bench_batch import timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=256, help='Size of test file')
+    parser.add_argument('--chunk-size', type=int, default=Defaults.CHUNK_SIZE // 16, help='(Max) chunk size')
+    parser.add_argument('--edits', type=int, default=5, help='Number of small insertions to make')
+    parser.add_argument('--python-mb', type=int, default=8, help='Amount of data to test pure Python fallback with')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'test.bin'
+        data = bytearray(os.urandom(args.size_mb * 1024 * 1024))
+        path.write_bytes(data)
+        fio = FileIO(Path(tmp))
+
+        min_size, avg_size, max_size = chunker.cdc_chunk_sizes(args.chunk_size)
+        print(f'{args.size_mb} MB file, CDC chunk sizes min {min_size}, avg {avg_size}, max {max_size}')
+        with open(str(path), 'rb') as f:
+            if chunker.numpy is not None:
+                ends, t = timed(lambda: chunker.cdc_chunk_ends(f, 0, len(data), args.chunk_size))
+                print(f'Boundaries (numpy):  {len(data) / 1024 / 1024 / t:8.0f} MB/s')
+            else:
+                print('Boundaries (numpy):  numpy not installed')
+            n = min(len(data), args.python_mb * 1024 * 1024)
+            numpy, chunker.numpy = chunker.numpy, None
+            py_ends, t = timed(lambda: chunker.cdc_chunk_ends(f, 0, n, args.chunk_size))
+            chunker.numpy = numpy
+            print(f'Boundaries (Python): {n / 1024 / 1024 / t:8.1f} MB/s')
+
+        def scan(chunking):
+            batch, errors = asyncio.run(scan_dir(
+                fio, args.chunk_size, args.chunk_size // Defaults.HASH_TASKS_PER_CHUNK, old_batch=None,
+                progress_func=lambda *a, **kw: None, test_compress=False, chunking=chunking))
+            assert not errors
+            return batch
+
+        before = {c: scan(c) for c in chunker.CHUNKINGS}
+        sizes = sorted(c.size for c in before['cdc'].chunks)
+        print(f'CDC chunks: {len(sizes)}, sizes min {sizes[0]}, median {sizes[len(sizes) // 2]}, max {sizes[-1]}')
+
+        rnd = random.Random(1234)
+        for __ in range(args.edits):
+            pos = rnd.randrange(len(data))
+            data[pos:pos] = os.urandom(rnd.randint(1, 100))
+        path.write_bytes(data)
+
+        print(f'After {args.edits} small insertions:')
+        for chunking in chunker.CHUNKINGS:
+            (after, t) = timed(lambda: scan(chunking))
+            new_hashes = after.all_hashes() - before[chunking].all_hashes()
+            changed = sum(c.size for c in after.chunks if c.hash in new_hashes)
+            print(f'{chunking:>6}: {100 * changed / len(data):6.2f}% of data in new chunks, scan {t:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
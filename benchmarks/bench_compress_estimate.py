@@ -0,0 +1,95 @@
+"""
+Benchmark accuracy and speed of sampled compressibility estimation against full LZ4 compression.
+
+Splits every file of a corpus into chunks and compares, per chunk, cmpratio from
+chunker.hash_and_test_compress() (sampled estimate) against compressing the whole chunk
+with lz4.frame (what scan_dir used to do). Reports mean / max absolute cmpratio error,
+how often the estimate agrees on the use-LZ4-or-not decision (Defaults.LZ4_MAX_CMPRATIO)
+and time spent in each. Default corpus is Python's standard library plus some synthetic files.
+
+Usage: python benchmarks/bench_compress_estimate.py [--chunk-size N] [DIR ...]
+"""
+import argparse, os, sysconfig, tempfile, random, zlib
+import lz4.frame
+from pathlib import Path
+
+from lanscatter import chunker
+from lanscatter.common import Defaults
+from bench_batch import timed
+
+
+def make_synthetic(basedir: Path):
+    rnd = random.Random(1234)
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for __ in range(rnd.randint(2, 10))) for __ in range(5000)]
+    text = b' '.join(rnd.choice(words) for __ in range(2 * 1024 * 1024))
+    files = {
+        'random.bin': os.urandom(16 * 1024 * 1024),
+        'zeros.bin': b'\0' * 16 * 1024 * 1024,
+        'text.txt': text,
+        'deflated.gz': b'\x1f\x8b' + zlib.compress(text, 9),
+        'mixed.bin': b''.join((os.urandom(256 * 1024) if rnd.random() < 0.5 else text[:256 * 1024]) for __ in range(64)),
+    }
+    for name, data in files.items():
+        (basedir / name).write_bytes(data)
+
+
+def chunks_of(dirs, chunk_size):
+    for d in dirs:
+        for root, __, files in os.walk(d):
+            for fn in files:
+                p = os.path.join(root, fn)
+                if os.path.isfile(p) and not os.path.islink(p):
+                    with open(p, 'rb') as f:
+                        pos = 0
+                        while True:
+                            data = f.read(chunk_size)
+                            if not data:
+                                break
+                            yield p, pos, data
+                            pos += len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dirs', nargs='*', help='Corpus directories (default: Python stdlib + synthetic files)')
+    parser.add_argument('--chunk-size', type=int, default=Defaults.CHUNK_SIZE // Defaults.HASH_TASKS_PER_CHUNK,
+                        help='Chunk size to test in')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dirs = args.dirs
+        if not dirs:
+            make_synthetic(Path(tmp))
+            dirs = [sysconfig.get_paths()['stdlib'], tmp]
+
+        n_chunks = total_bytes = 0
+        errors, disagreements, t_full, t_est = [], 0, 0.0, 0.0
+        worst = (0.0, '')
+        for path, pos, data in chunks_of(dirs, args.chunk_size):
+            full, t = timed(lambda: len(lz4.frame.compress(data)))
+            t_full += t
+            [(__, est)], t = timed(lambda: chunker.hash_and_test_compress(data, True, file_start=(pos == 0)))
+            t_est += t
+            __, t = timed(lambda: chunker.hash_and_test_compress(data, False))
+            t_est -= t  # (only count estimation, not hashing)
+
+            ratio_full, ratio_est = min(1.0, full / len(data)), min(1.0, est / len(data))
+            err = abs(ratio_full - ratio_est)
+            errors.append(err)
+            if err > worst[0]:
+                worst = (err, f'{path} @ {pos}: full {ratio_full:.3f}, estimated {ratio_est:.3f}')
+            if (ratio_full < Defaults.LZ4_MAX_CMPRATIO) != (ratio_est < Defaults.LZ4_MAX_CMPRATIO):
+                disagreements += 1
+            n_chunks += 1
+            total_bytes += len(data)
+
+    print(f'Corpus: {n_chunks} chunks, {total_bytes / 1024 / 1024:.0f} MB, chunk size {args.chunk_size}')
+    print(f'cmpratio error: mean {sum(errors) / max(1, n_chunks):.4f}, max {worst[0]:.4f} ({worst[1]})')
+    print(f'LZ4 decision agreement: {100 * (1 - disagreements / max(1, n_chunks)):.2f}% '
+          f'({disagreements} chunks disagree)')
+    print(f'Time: full LZ4 {t_full:.2f}s ({total_bytes / 1024 / 1024 / max(t_full, 1e-9):.0f} MB/s), '
+          f'estimate {t_est:.2f}s ({total_bytes / 1024 / 1024 / max(t_est, 1e-9):.0f} MB/s)')
+
+
+if __name__ == '__main__':
+    main()
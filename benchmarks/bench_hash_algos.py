@@ -0,0 +1,58 @@
+"""
+Benchmark available chunk hash algorithms (chunker.HASH_ALGOS) on large files.
+
+For each algorithm, reports:
+ - raw: single threaded hashing speed, data already in memory
+ - scan: full scan_dir() of the test dir (reading + hashing, no compressibility test)
+
+Test files are written to a temp dir (and read once before timing, so they are likely
+in page cache if RAM allows), or give an existing directory to scan instead.
+Optional algorithms are only included if their packages (blake3, xxhash) are installed.
+
+Usage: python benchmarks/bench_hash_algos.py [--size-mb N] [--backend thread|process] [DIR]
+"""
+import argparse, asyncio, os, tempfile
+from pathlib import Path
+
+from lanscatter.chunker import scan_dir, HASH_ALGOS, HashFunc
+from lanscatter.fileio import FileIO
+from lanscatter.common import Defaults
+from bench_batch import timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dir', nargs='?', help='Directory to scan (default: temp dir with a generated file)')
+    parser.add_argument('--size-mb', type=int, default=4096, help='Size of generated test file')
+    parser.add_argument('--backend', choices=('thread', 'process'), default='thread', help='scan_dir hash backend')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        basedir = Path(args.dir or tmp)
+        if not args.dir:
+            with open(str(basedir / 'big.bin'), 'wb') as f:
+                for __ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+        total_mb = sum(p.stat().st_size for p in basedir.rglob('*') if p.is_file()) / 1024 / 1024
+
+        fio = FileIO(basedir)
+
+        def scan(algo):
+            return asyncio.run(scan_dir(
+                fio, Defaults.CHUNK_SIZE, Defaults.CHUNK_SIZE // Defaults.HASH_TASKS_PER_CHUNK, old_batch=None,
+                progress_func=lambda *a, **kw: None, test_compress=False, hash_backend=args.backend, hash_algo=algo))
+
+        scan(Defaults.HASH_ALGO)  # Warm up page cache
+        sample = os.urandom(64 * 1024 * 1024)
+
+        print(f'{total_mb:.0f} MB, {args.backend} backend, {os.cpu_count()} CPUs')
+        print(f"{'algo':>10} {'raw MB/s':>10} {'scan s':>8} {'scan MB/s':>10}")
+        for algo in sorted(HASH_ALGOS.keys()):
+            __, t_raw = timed(lambda: HashFunc(algo).update(sample).result())
+            (batch, errors), t_scan = timed(lambda: scan(algo))
+            assert not errors and batch.hash_algo == algo
+            print(f"{algo:>10} {len(sample) / 1024 / 1024 / t_raw:>10.0f} {t_scan:>8.2f} {total_mb / t_scan:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark scan_dir() hashing throughput of the thread and process backends vs. worker count.
+
+Writes a temporary directory of random (half compressible) files, warms up page cache
+and then hashes it from scratch with both backends at increasing worker counts,
+checking that all runs produce identical batches.
+
+Usage: python benchmarks/bench_hashing.py [--total-mb N] [--files N] [--max-workers N] [--no-compress]
+"""
+import argparse, asyncio, os, tempfile
+from pathlib import Path
+
+from lanscatter.chunker import scan_dir
+from lanscatter.fileio import FileIO
+from lanscatter.common import Defaults
+from bench_batch import timed
+
+
+def make_files(basedir: Path, total_mb: int, n_files: int):
+    file_size = total_mb * 1024 * 1024 // n_files
+    for i in range(n_files):
+        with open(str(basedir / f'file_{i:04d}.bin'), 'wb') as f:
+            for __ in range(0, file_size, 1024 * 1024):
+                f.write(os.urandom(512 * 1024) + b'\0' * (512 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--total-mb', type=int, default=1024, help='Total size of test files')
+    parser.add_argument('--files', type=int, default=16, help='Number of test files')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count(), help='Largest worker count to test')
+    parser.add_argument('--no-compress', action='store_true', help="Don't test compressibility while hashing")
+    args = parser.parse_args()
+
+    workers = [1]
+    while workers[-1] * 2 <= args.max_workers:
+        workers.append(workers[-1] * 2)
+    if workers[-1] != args.max_workers:
+        workers.append(args.max_workers)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_files(Path(tmp), args.total_mb, args.files)
+        fio = FileIO(Path(tmp))
+        chunk_size = Defaults.CHUNK_SIZE // 8
+
+        def scan(backend, n):
+            return asyncio.run(scan_dir(
+                fio, chunk_size, chunk_size // Defaults.HASH_TASKS_PER_CHUNK, old_batch=None,
+                progress_func=lambda *a, **kw: None, test_compress=not args.no_compress,
+                hash_backend=backend, hash_workers=n))
+
+        reference, __ = scan('thread', 1)  # (also warms up page cache)
+        print(f"{'workers':>8} {'backend':>8} {'seconds':>8} {'MB/s':>8}")
+        for n in workers:
+            for backend in ('thread', 'process'):
+                scan(backend, n)  # Warm up (e.g. start worker processes)
+                (batch, errors), t = timed(lambda: scan(backend, n))
+                assert not errors and batch == reference
+                print(f"{n:>8} {backend:>8} {t:>8.2f} {args.total_mb / t:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
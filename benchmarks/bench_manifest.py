@@ -0,0 +1,50 @@
+"""
+Benchmark binary manifest codec against the JSON serialization of SyncBatch.
+
+For synthetic manifests of increasing size, reports encoded size (raw and deflated),
+time to deflate it (like websocket compression does) and encode/decode throughput for:
+ - json:     json.dumps(batch.to_dict()) / SyncBatch.from_dict(json.loads(...))
+ - manifest: manifest.encode_batch(batch) / manifest.decode_batch(...)
+
+Usage: python benchmarks/bench_manifest.py [--max-chunks N] [--chunks-per-file N]
+"""
+import argparse, json, zlib
+
+from lanscatter.chunker import SyncBatch
+from lanscatter import manifest
+from bench_batch import make_manifest, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-chunks', type=int, default=200000, help='Largest manifest size to test')
+    parser.add_argument('--chunks-per-file', type=int, default=20, help='Chunks per synthetic file')
+    args = parser.parse_args()
+
+    sizes = []
+    n = args.max_chunks
+    while n >= 10000 and len(sizes) < 3:
+        sizes.insert(0, n)
+        n //= 4
+
+    print(f"{'chunks':>8} {'format':>9} {'bytes/chunk':>12} {'deflated':>9} {'deflate s':>10} "
+          f"{'encode s':>9} {'us/chunk':>9} {'decode s':>9} {'us/chunk':>9}")
+    for n in sizes:
+        batch = SyncBatch.from_dict(make_manifest(n, args.chunks_per_file))
+        codecs = (
+            ('json', lambda: json.dumps(batch.to_dict()).encode('utf-8'),
+                lambda d: SyncBatch.from_dict(json.loads(d.decode('utf-8')))),
+            ('manifest', lambda: manifest.encode_batch(batch), manifest.decode_batch))
+        for name, enc, dec in codecs:
+            data, t_enc = timed(enc)
+            decoded, t_dec = timed(lambda: dec(data))
+            assert decoded == batch
+            deflated, t_deflate = timed(lambda: len(zlib.compress(data, 9)))
+            print(f"{n:>8} {name:>9} {len(data)/n:>12.1f} {deflated/n:>9.1f} {t_deflate:>10.2f} "
+                  f"{t_enc:>9.2f} {t_enc/n*1e6:>9.2f} {t_dec:>9.2f} {t_dec/n*1e6:>9.2f}")
+            del data, decoded
+        del batch
+
+
+if __name__ == '__main__':
+    main()
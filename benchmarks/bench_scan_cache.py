@@ -0,0 +1,61 @@
+"""
+Benchmark how scan_dir() cache modes (chunker.SCAN_CACHE_MODES) affect OS page cache.
+
+Writes a test file (or scans given directory), then for each mode drops it from page cache,
+scans it and reports scan speed and how much page cache grew during the scan (psutil 'cached').
+With 'keep', cache grows by about the size of the data; 'drop' and 'direct' should leave it
+roughly unchanged, so that other files (e.g. chunks being uploaded) stay cached.
+
+Usage: python benchmarks/bench_scan_cache.py [--size-mb N] [--backend thread|process] [DIR]
+"""
+import argparse, asyncio, os, tempfile
+import psutil
+from pathlib import Path
+
+from lanscatter.chunker import scan_dir, SCAN_CACHE_MODES
+from lanscatter.fileio import FileIO
+from lanscatter.common import Defaults
+from bench_batch import timed
+
+
+def evict(basedir: Path):
+    for p in basedir.rglob('*'):
+        if p.is_file() and hasattr(os, 'posix_fadvise'):
+            with open(str(p), 'rb') as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dir', nargs='?', help='Directory to scan (default: temp dir with a generated file)')
+    parser.add_argument('--size-mb', type=int, default=2048, help='Size of generated test file')
+    parser.add_argument('--backend', choices=('thread', 'process'), default='thread', help='scan_dir hash backend')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir='.') as tmp:
+        basedir = Path(args.dir or tmp)
+        if not args.dir:
+            with open(str(basedir / 'big.bin'), 'wb') as f:
+                for __ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+                f.flush()
+                os.fsync(f.fileno())
+        total_mb = sum(p.stat().st_size for p in basedir.rglob('*') if p.is_file()) / 1024 / 1024
+        fio = FileIO(basedir)
+
+        print(f'{total_mb:.0f} MB, {args.backend} backend')
+        print(f"{'mode':>8} {'scan s':>8} {'MB/s':>8} {'cache growth MB':>16}")
+        for mode in SCAN_CACHE_MODES:
+            evict(basedir)
+            cached_before = getattr(psutil.virtual_memory(), 'cached', 0)
+            (batch, errors), t = timed(lambda: asyncio.run(scan_dir(
+                fio, Defaults.CHUNK_SIZE, Defaults.CHUNK_SIZE // Defaults.HASH_TASKS_PER_CHUNK, old_batch=None,
+                progress_func=lambda *a, **kw: None, test_compress=False, hash_backend=args.backend,
+                cache_mode=mode)))
+            assert not errors
+            growth = (getattr(psutil.virtual_memory(), 'cached', 0) - cached_before) / 1024 / 1024
+            print(f'{mode:>8} {t:>8.2f} {total_mb / t:>8.0f} {growth:>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
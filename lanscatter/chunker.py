@@ -1,25 +1,30 @@
-from typing import List, Set, Iterable, Dict, Tuple, Optional, Callable, Generator
+from typing import List, Set, Iterable, Dict, Tuple, Optional, Callable
 from types import SimpleNamespace
-import os, json, hashlib, asyncio, time
-import aiofiles, aiofiles.os, collections, threading
+import os, json, hashlib, asyncio, time, stat, bisect, functools
+import collections, threading, itertools, multiprocessing, atexit
+import concurrent.futures, concurrent.futures.process
 import mmap
-from pathlib import Path, PurePosixPath
-import lz4.frame
-from .common import Defaults, process_multibuffer_io, HashableBase
+from contextlib import suppress
+from pathlib import PurePosixPath
+import lz4.frame, lz4.block
+from .common import Defaults, process_multibuffer_io, SlotsRecord
 
 # Tools for scanning files in a directory and splitting them into hashed chunks.
 # MasterNode and PeerNode both use this for maintaining and syncing their state.
 
 HashType = str
+Leaf = Tuple[HashType, int]  # (hash of a leaf or ZERO_DATA, its compressed size), see leaf_size()
 
-class FileChunk(HashableBase):
+class FileChunk(SlotsRecord):
+    __slots__ = ('path', 'pos', 'size', 'cmpratio', 'hash')
     path: str           # path + filename
     pos: int            # chunk start position in bytes
     size: int           # chunk size in bytes
     cmpratio: float     # Compression ratio (compressed size / original size)
     hash: HashType      # Chain hash of subchunks
 
-class FileAttribs(HashableBase):
+class FileAttribs(SlotsRecord):
+    __slots__ = ('path', 'size', 'mtime', 'chain_hash')
     path: str
     size: int                      # size of complete file in bytes
     mtime: int                     # last modified (unix timestamp)
@@ -30,10 +35,51 @@ class FileAttribs(HashableBase):
         return self.size < 0
 
 
+class _TruncatedHash:
+    """Wrapper for hashlib style objects, to make their hexdigest() shorter"""
+    def __init__(self, h, digest_size: int):
+        self.h, self.digest_size = h, digest_size
+
+    def update(self, data):
+        self.h.update(data)
+
+    def hexdigest(self) -> str:
+        return self.h.hexdigest()[:self.digest_size * 2]
+
+
+# Registry of supported hash algorithms: name -> factory for a hashlib style object (update() & hexdigest()).
+# Master picks one and advertises it in SyncBatch.hash_algo, peers hash with the same one.
+HASH_ALGOS: Dict[str, Callable] = {
+    'blake2b': lambda: hashlib.blake2b(digest_size=12),      # Default
+    'sha256': lambda: _TruncatedHash(hashlib.sha256(), 16),  # Fast on CPUs with SHA extensions (OpenSSL uses them)
+}
+
+try:
+    import blake3  # Optional. SIMD optimized and internally multithreaded.
+    HASH_ALGOS['blake3'] = lambda: _TruncatedHash(blake3.blake3(max_threads=blake3.blake3.AUTO), 16)
+except ImportError:
+    pass
+
+try:
+    import xxhash  # Optional. Very fast, but not cryptographic -- only use it on trusted networks.
+    HASH_ALGOS['xxh3'] = lambda: xxhash.xxh3_128()
+except ImportError:
+    pass
+
+
+def check_hash_algo(algo: str) -> None:
+    """Raise ValueError if given hash algorithm is not available"""
+    if algo not in HASH_ALGOS:
+        raise ValueError(f"Unsupported hash algorithm '{algo}' (available: {', '.join(sorted(HASH_ALGOS))})")
+
+
 class HashFunc:
-    """Replaceable hash function, currently implemented as blake2b"""
-    def __init__(self):
-        self.h = hashlib.blake2b(digest_size=12)
+    """Replaceable hash function. Algorithm is picked by name from HASH_ALGOS, blake2b by default."""
+    def __init__(self, algo: str = Defaults.HASH_ALGO):
+        factory = HASH_ALGOS.get(algo)
+        if factory is None:
+            check_hash_algo(algo)
+        self.h = factory()
 
     def update(self, data):
         self.h.update(data)
@@ -43,34 +89,144 @@ class HashFunc:
         return self.h.hexdigest()
 
 
-def calc_chain_hash(chunks: Iterable[FileChunk]) -> HashType:
+def calc_chain_hash(chunks: Iterable[FileChunk], algo: str = Defaults.HASH_ALGO) -> HashType:
     """
     Sort given chunks by position in file and calculate a combined (chain) hash for them
     """
     path = None
-    csum = HashFunc().result()
+    csum = HashFunc(algo).result()
     for c in sorted(chunks, key=lambda c: c.pos):
-        csum = HashFunc().update((csum + c.hash).encode('utf-8')).result()
+        csum = HashFunc(algo).update((csum + c.hash).encode('utf-8')).result()
         assert(c.path == path or path is None)
         path = c.path
     return csum
 
 
+ZERO_HASH_PREFIX = 'zero:'
+
+
+def zero_chunk_hash(size: int) -> HashType:
+    """
+    Hash for a chunk that is all zero bytes (e.g. a hole in a sparse file). These are
+    never transferred, peers create them locally instead (see FileIO.write_zeros()).
+    """
+    return f'{ZERO_HASH_PREFIX}{size}'
+
+
+def is_zero_hash(h: HashType) -> bool:
+    return h.startswith(ZERO_HASH_PREFIX)
+
+
+@functools.lru_cache(maxsize=64)
+def _zero_sub_chunk_hash(size: int, hash_algo: str) -> HashType:
+    """Real hash of given amount of zeros, for sub chunks of zeros in chunks that also contain other data"""
+    h = HashFunc(hash_algo)
+    for i in range(0, size, len(_ZEROS)):
+        h.update(_ZEROS[:min(len(_ZEROS), size - i)])
+    return h.result()
+
+
+def _merge_chunk_diff(here: List[FileChunk], there: List[FileChunk]) -> Tuple[List[FileChunk], List[FileChunk]]:
+    """
+    Merge join two position sorted chunk lists of a file (see SyncBatch.chunks_of()).
+    Same as set differences of the lists, even if there are several chunks at the same position.
+    :return: (chunks only in 'here', chunks only in 'there'), both sorted by position
+    """
+    here_only, there_only = [], []
+    i, j = 0, 0
+    while i < len(here) and j < len(there):
+        a, b = here[i], there[j]
+        if a.pos < b.pos:
+            here_only.append(a)
+            i += 1
+        elif b.pos < a.pos:
+            there_only.append(b)
+            j += 1
+        else:
+            i_end, j_end = i + 1, j + 1
+            while i_end < len(here) and here[i_end].pos == a.pos:
+                i_end += 1
+            while j_end < len(there) and there[j_end].pos == b.pos:
+                j_end += 1
+            if i_end - i == 1 and j_end - j == 1:
+                if a != b:
+                    here_only.append(a)
+                    there_only.append(b)
+            else:
+                here_at, there_at = set(here[i:i_end]), set(there[j:j_end])
+                here_only.extend(c for c in here[i:i_end] if c not in there_at)
+                there_only.extend(c for c in there[j:j_end] if c not in here_at)
+            i, j = i_end, j_end
+    here_only.extend(here[i:])
+    there_only.extend(there[j:])
+    return here_only, there_only
+
+
 class SyncBatch:
     """
     Represents sync folder contents and provides tools for comparing them
     """
     chunk_size: int
     sub_chunk_size: int
-    chunks: Set[FileChunk]
+    hash_algo: str                  # Name of hash algorithm (in HASH_ALGOS) that chunk hashes were calculated with
+    chunking: str                   # How files were split into chunks (in CHUNKINGS). 'fixed' or 'cdc'.
+    chunks: Set[FileChunk]          # Don't modify directly, use add() and discard() to keep indexes in sync
     files: Dict[str, FileAttribs]
+    hashed_at: Dict[str, Tuple[float, int]]  # Local bookkeeping for scan_dir(), not serialized: path -> (time
+                                             # when whole file was last hashed, inode number)
+    leaves: Dict[str, List[Leaf]]  # Local bookkeeping, not serialized: path -> leaf hashes of whole file, if
+                                     # they are file aligned (see leaves_aligned()). For chunk size changes.
+    chunk_leaves: Dict[HashType, List[HashType]]  # Optional: chunk hash -> hashes of its leaves (see leaf_size()),
+                                                  # for verifying and resuming partial downloads. Not in digest().
 
-    def __init__(self, chunk_size: int = 0, sub_chunk_size: int = 0):
+    def __init__(self, chunk_size: int = 0, sub_chunk_size: int = 0, hash_algo: str = Defaults.HASH_ALGO,
+                 chunking: str = Defaults.CHUNKING):
         assert chunk_size >= sub_chunk_size
         self.chunk_size = chunk_size
         self.sub_chunk_size = sub_chunk_size
+        self.hash_algo = hash_algo
+        self.chunking = chunking
         self.chunks = set()
         self.files = {}
+        self.hashed_at = {}
+        self.leaves = {}
+        self.chunk_leaves = {}
+        self._chunks_by_hash: Dict[HashType, Set[FileChunk]] = {}
+        self._chunks_by_path: Dict[str, List[FileChunk]] = {}  # sorted by pos, unless path is in _unsorted_paths
+        self._unsorted_paths: Set[str] = set()
+        self._path_digests: Dict[str, bytes] = {}  # Cached per-path content digests, for digest()
+        self._digest: Optional[str] = None
+
+    def _invalidate_digest(self, path: str) -> None:
+        self._path_digests.pop(path, None)
+        self._digest = None
+
+    def _index_chunk(self, c: FileChunk) -> None:
+        self._chunks_by_hash.setdefault(c.hash, set()).add(c)
+        self._chunks_by_path.setdefault(c.path, []).append(c)
+        self._unsorted_paths.add(c.path)
+        self._invalidate_digest(c.path)
+
+    def _unindex_chunk(self, c: FileChunk) -> None:
+        same_hash = self._chunks_by_hash.get(c.hash)
+        if same_hash is not None:
+            same_hash.discard(c)
+            if not same_hash:
+                del self._chunks_by_hash[c.hash]
+                self.chunk_leaves.pop(c.hash, None)
+        same_path = self._chunks_by_path.get(c.path)
+        if same_path is not None:
+            same_path.remove(c)
+            if not same_path:
+                del self._chunks_by_path[c.path]
+                self._unsorted_paths.discard(c.path)
+        self._invalidate_digest(c.path)
+
+    def _reindex(self) -> None:
+        self._chunks_by_hash, self._chunks_by_path, self._unsorted_paths = {}, {}, set()
+        self._path_digests, self._digest = {}, None
+        for c in self.chunks:
+            self._index_chunk(c)
 
     def __bool__(self):
         """True if batch is not empty"""
@@ -82,7 +238,28 @@ class SyncBatch:
 
     def __eq__(self, other):
         """Compare batch contents. True if folders they represent have identical contents."""
-        return self.__repr__() == other.__repr__()
+        return isinstance(other, SyncBatch) and self.digest() == other.digest()
+
+    def digest(self) -> str:
+        """
+        Return a hex digest of batch contents (a hash tree over files and their chunks).
+        Per-file digests are cached and only recalculated for files that have changed since last call.
+        """
+        if self._digest is None:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(repr((self.chunk_size, self.sub_chunk_size, self.hash_algo, self.chunking)).encode('utf-8'))
+            for path in sorted(set(self.files.keys()) | set(self._chunks_by_path.keys())):
+                pd = self._path_digests.get(path)
+                if pd is None:
+                    f = self.files.get(path)
+                    ph = hashlib.blake2b(digest_size=16)
+                    ph.update(repr((path, f.size, f.mtime, f.chain_hash) if f else (path,)).encode('utf-8'))
+                    for c in sorted(self.chunks_of(path), key=lambda c: (c.pos, c.hash)):
+                        ph.update(repr((c.pos, c.size, c.cmpratio, c.hash)).encode('utf-8'))
+                    pd = self._path_digests[path] = ph.digest()
+                h.update(pd)
+            self._digest = h.hexdigest()
+        return self._digest
 
     def sanity_checks(self) -> None:
         """Assert that contents are valid"""
@@ -95,19 +272,32 @@ class SyncBatch:
         for c in self.chunks:
             assert c.path in self.files
 
-    def add(self, files: Iterable[FileAttribs] = (), chunks: Iterable[FileChunk] = ()):
+    def add(self, files: Iterable[FileAttribs] = (), chunks: Iterable[FileChunk] = (),
+            chunk_leaves: Optional[Dict[HashType, List[HashType]]] = None):
         """
         Add given file attributes and chunks to batch, if not there already.
         Recalculates file chain hashes for files that got new chunks.
+        Leaf hashes in chunk_leaves are kept for chunks that are in the batch.
         """
         chunks = tuple(chunks)
-        self.files.update({a.path: a for a in files})
-        self.chunks.update(chunks)
+        for a in files:
+            self.files[a.path] = a
+            self._invalidate_digest(a.path)
+        for c in chunks:
+            n = len(self.chunks)
+            self.chunks.add(c)
+            if len(self.chunks) != n:  # (cheaper than a separate 'in' test)
+                self._index_chunk(c)
         for path in set((c.path for c in chunks)):
-            if path not in self.files:
-                self.files[path] = FileAttribs(path=path, size=0, mtime=int(time.time()), chain_hash=None)
-            self.files[path].chain_hash = calc_chain_hash((c for c in self.chunks if c.path == path))
-            self.files[path].size = sum((c.size for c in self.chunks if c.path == path))
+            f = self.files.get(path)
+            path_chunks = self.chunks_of(path)
+            # (Replace instead of modifying, as FileAttribs objects may be shared with other batches)
+            self.files[path] = FileAttribs(path=path, size=sum((c.size for c in path_chunks)),
+                                           mtime=(f.mtime if f else int(time.time())),
+                                           chain_hash=calc_chain_hash(path_chunks, self.hash_algo))
+        for h, hashes in (chunk_leaves or {}).items():
+            if h in self._chunks_by_hash:
+                self.chunk_leaves[h] = hashes
 
     def discard(self, paths: Iterable[str] = (), chunks: Iterable[FileChunk] = ()):
         """
@@ -117,40 +307,86 @@ class SyncBatch:
         paths = set(paths)
         for path in paths:
             self.files.pop(path, None)
-        self.chunks = set((c for c in self.chunks if c.path not in paths))
+            self._invalidate_digest(path)
+            for c in tuple(self._chunks_by_path.get(path, ())):
+                self.chunks.discard(c)
+                self._unindex_chunk(c)
         for c in tuple(chunks):
-            self.chunks.discard(c)
-            if c.path in self.files:
-                self.files[c.path].chain_hash = None
+            if c in self.chunks:
+                self.chunks.discard(c)
+                self._unindex_chunk(c)
+            f = self.files.get(c.path)
+            if f is not None and f.chain_hash is not None:
+                self.files[c.path] = FileAttribs(path=f.path, size=f.size, mtime=f.mtime, chain_hash=None)
+                self._invalidate_digest(c.path)
+
+    def set_mtime(self, path: str, mtime: float):
+        """Change modification time of given file or directory in batch"""
+        f = self.files[path]
+        self.files[path] = FileAttribs(path=f.path, size=f.size, mtime=mtime, chain_hash=f.chain_hash)
+        self._invalidate_digest(path)
 
     def first_chunk_with(self, chunk_hash: HashType) -> Optional[FileChunk]:
         """Return first chunk with given content (hash)"""
-        return next(iter((c for c in self.chunks if c.hash == chunk_hash)), None)
+        same_hash = self._chunks_by_hash.get(chunk_hash)
+        return next(iter(same_hash)) if same_hash else None
+
+    def chunks_with(self, chunk_hash: HashType) -> Set[FileChunk]:
+        """Return all chunks with given content (hash). Don't modify the result."""
+        return self._chunks_by_hash.get(chunk_hash) or set()
+
+    def chunks_of(self, path: str) -> List[FileChunk]:
+        """Return chunks of given file, sorted by position. Don't modify the result."""
+        if path in self._unsorted_paths:
+            self._chunks_by_path[path].sort(key=lambda c: c.pos)
+            self._unsorted_paths.discard(path)
+        return self._chunks_by_path.get(path) or []
+
+    def differing_paths(self, there: 'SyncBatch') -> Iterable[str]:
+        """
+        Yield paths whose attributes or chunks differ between this and given batch.
+        Compares cached per-path digests, so paths that haven't changed since last call cost only a dict lookup.
+        Don't modify the batches while iterating.
+        """
+        self.digest(), there.digest()  # Fill per-path digest caches
+        here_digests, there_digests = self._path_digests, there._path_digests
+        for path, d in here_digests.items():
+            if there_digests.get(path) != d:
+                yield path
+        for path in there_digests.keys() - here_digests.keys():
+            yield path
 
     def file_tree_diff(self, there: 'SyncBatch'):
         """Compare this and given batches for file attribute changes"""
-        there_by_path = {a.path: a for a in there.files.values()}
-        names_here, names_there = set(self.files.keys()), set(there_by_path.keys())
-        differing_attribs = [a for a in self.files.values() if (a.path in there_by_path and there_by_path[a.path] != a)]
-        return SimpleNamespace(
-            there_only=names_there - names_here,
-            here_only=names_here - names_there,
-            with_different_attribs=differing_attribs)
+        res = SimpleNamespace(there_only=set(), here_only=set(), with_different_attribs=[])
+        for path in tuple(self.differing_paths(there)):
+            a, b = self.files.get(path), there.files.get(path)
+            if a is None:
+                res.there_only.add(path)
+            elif b is None:
+                res.here_only.add(path)
+            elif a != b:
+                res.with_different_attribs.append(a)
+        return res
 
     def chunk_diff(self, there: 'SyncBatch'):
         """Compare this and given batches for content (chunk list) changes"""
-        return SimpleNamespace(
-            there_only=there.chunks - self.chunks,
-            here_only=self.chunks - there.chunks)
+        res = SimpleNamespace(there_only=set(), here_only=set())
+        for path in tuple(self.differing_paths(there)):
+            here_only, there_only = _merge_chunk_diff(self.chunks_of(path), there.chunks_of(path))
+            res.here_only.update(here_only)
+            res.there_only.update(there_only)
+        return res
 
     def copy_chunk_compress_ratios_from(self, other):
         """Copy (replace) chunk compression ratio values from given other FileBatch."""
         cmp_ratios = {c.hash: c.cmpratio for c in other.chunks if c.cmpratio is not None}
         self.chunks = set((FileChunk(path=c.path, pos=c.pos, size=c.size, hash=c.hash, cmpratio=cmp_ratios.get(c.hash)) for c in self.chunks))
+        self._reindex()
 
     def all_hashes(self) -> Set[HashType]:
         """Return set of unique hashes in the batch"""
-        return set((c.hash for c in self.chunks))
+        return set(self._chunks_by_hash.keys())
 
     def have_all_hashes(self, other: Iterable[HashType]) -> bool:
         """True if the batch contains all hashes that the 'other' does."""
@@ -158,63 +394,908 @@ class SyncBatch:
 
     def to_dict(self) -> Dict:
         """Turn batch object into a serializable dictionary"""
-        return {
+        res = {
             'chunk_size': self.chunk_size,
             'sub_chunk_size': self.sub_chunk_size,
-            'files': [f.__dict__ for f in sorted(list(self.files.values()), key=lambda f: f.path)],
-            'chunks': [c.__dict__ for c in sorted(list(self.chunks), key=lambda c: c.path + f'{c.pos:016}')]}
+            'hash_algo': self.hash_algo,
+            'chunking': self.chunking,
+            'files': [f.to_dict() for f in sorted(list(self.files.values()), key=lambda f: f.path)],
+            'chunks': [c.to_dict() for c in sorted(list(self.chunks), key=lambda c: c.path + f'{c.pos:016}')]}
+        if self.chunk_leaves:
+            res['chunk_leaves'] = {h: self.chunk_leaves[h] for h in sorted(self.chunk_leaves)}
+        return res
 
     @staticmethod
     def from_dict(data: Dict) -> 'SyncBatch':
-        res = SyncBatch(chunk_size=data['chunk_size'], sub_chunk_size=data['sub_chunk_size'])
+        res = SyncBatch(chunk_size=data['chunk_size'], sub_chunk_size=data['sub_chunk_size'],
+                        hash_algo=data.get('hash_algo', Defaults.HASH_ALGO),
+                        chunking=data.get('chunking', Defaults.CHUNKING))
         res.add(files=(FileAttribs(**d) for d in data['files']),
-                chunks=(FileChunk(**d) for d in data['chunks']))
+                chunks=(FileChunk(**d) for d in data['chunks']),
+                chunk_leaves=data.get('chunk_leaves'))
         return res
 
+    def delta_to(self, new: 'SyncBatch') -> Optional[Dict]:
+        """
+        Describe changes from this batch to given newer one as a serializable dictionary, for apply_delta().
+        Only files whose (cached) per-path digests differ are compared, so this is cheap for small changes.
+
+        :return: Delta dict, or None if batches have different chunk geometry or hash algorithm (=send a full batch)
+        """
+        if (self.chunk_size, self.sub_chunk_size, self.hash_algo, self.chunking) != \
+                (new.chunk_size, new.sub_chunk_size, new.hash_algo, new.chunking):
+            return None
+        res = {'files': [], 'removed_files': [], 'chunks': [], 'removed_chunks': []}
+        for path in sorted(self.differing_paths(new)):
+            if path not in new.files:
+                res['removed_files'].append(path)
+                continue
+            if path not in self.files or self.files[path] != new.files[path]:
+                res['files'].append(new.files[path].to_dict())
+            old_only, new_only = _merge_chunk_diff(self.chunks_of(path), new.chunks_of(path))
+            res['removed_chunks'].extend(c.to_dict() for c in old_only)
+            res['chunks'].extend(c.to_dict() for c in new_only)
+            for c in new_only:
+                if c.hash in new.chunk_leaves:
+                    res.setdefault('chunk_leaves', {})[c.hash] = new.chunk_leaves[c.hash]
+        return res
 
-class SubChunkHashTask(HashableBase):
+    def apply_delta(self, delta: Dict) -> None:
+        """Apply changes made by delta_to() to this batch."""
+        self.discard(paths=delta['removed_files'], chunks=(FileChunk(**d) for d in delta['removed_chunks']))
+        self.add(files=(FileAttribs(**d) for d in delta['files']),
+                 chunks=(FileChunk(**d) for d in delta['chunks']),
+                 chunk_leaves=delta.get('chunk_leaves'))
+
+
+class SubChunkHashTask(SlotsRecord):
+    __slots__ = ('chunk', 'pos', 'size', 'pos_perc', 'result')
     chunk: FileChunk    # Chunk this sub-part belongs to
     pos: int            # start position in bytes
     size: int           # chunk size in bytes
     pos_perc: float     # pos / total_file_size (for progress reporting)
-    cmpr_size: int      # Compressed size
-    result: HashType    # Hex checksum of data contents (blake2, digest_size=12)
+    result: Optional[List[Leaf]]  # Hashes and compressed sizes of leaves in it
+
+
+HASH_BACKENDS = ('thread', 'process')
+
+_process_pools: Dict[int, concurrent.futures.ProcessPoolExecutor] = {}  # worker count -> pool
+_process_pools_lock = threading.Lock()
+
+
+def _get_process_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Get a shared hashing process pool. Kept alive between scans, as starting worker processes is slow.
+    Workers are not fork()ed from this (multithreaded) process, as children could inherit locks held by other threads.
+    """
+    with _process_pools_lock:
+        if workers not in _process_pools:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _process_pools[workers] = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context(method))
+        return _process_pools[workers]
+
+
+def _discard_process_pool(workers: int) -> None:
+    with _process_pools_lock:
+        pool = _process_pools.pop(workers, None)
+    if pool:
+        pool.shutdown(wait=False)
+
+
+@atexit.register
+def _shutdown_process_pools() -> None:
+    """Stop all hashing worker processes"""
+    with _process_pools_lock:
+        pools = list(_process_pools.values())
+        _process_pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=True)
+
+
+HASH_READ_STEP = 1024 * 1024  # Process pool workers read files this much at a time
+
+# How scan_dir() treats OS page cache when reading files. 'keep' reads normally, 'drop' tells kernel to read ahead
+# and to drop what's been read (posix_fadvise), 'direct' bypasses page cache (O_DIRECT) where supported, using
+# 'drop' otherwise. Hashing a big tree otherwise evicts everything else from cache, including chunks being served.
+SCAN_CACHE_MODES = ('keep', 'drop', 'direct')
+DIRECT_IO_ALIGN = 4096  # O_DIRECT reads are done in multiples of this, into page aligned buffers
+
+
+def check_scan_cache_mode(mode: str) -> None:
+    """Raise ValueError if given scan cache mode is not supported"""
+    if mode not in SCAN_CACHE_MODES:
+        raise ValueError(f"Unsupported scan cache mode '{mode}' (available: {', '.join(SCAN_CACHE_MODES)})")
+
+
+def scan_read_buffer(size: int) -> memoryview:
+    """Allocate a read buffer for ScanReader.read() of up to size bytes (page aligned, with room for O_DIRECT)"""
+    return memoryview(mmap.mmap(-1, size + 2 * DIRECT_IO_ALIGN))
+
 
+class ScanReader:
+    """
+    Blocking reader of file ranges for hashing, with page cache handling as in SCAN_CACHE_MODES.
+    """
+    def __init__(self, full_path: str, cache_mode: str):
+        self.full_path, self.f = full_path, None
+        self.advise = cache_mode != 'keep' and hasattr(os, 'posix_fadvise')
+        self._open(direct=(cache_mode == 'direct' and hasattr(os, 'O_DIRECT')))
+
+    def _open(self, direct: bool) -> None:
+        self.direct = False
+        if direct:
+            with suppress(OSError):  # (not supported by filesystem)
+                self.f = open(os.open(self.full_path, os.O_RDONLY | os.O_DIRECT), 'rb', buffering=0)
+                self.direct = True
+        if not self.direct:
+            self.f = open(self.full_path, 'rb', buffering=0)
+            if self.advise:
+                os.posix_fadvise(self.f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.f.close()
+
+    def _read_at(self, pos: int, buff: memoryview) -> int:
+        self.f.seek(pos)
+        got = 0
+        while got < len(buff):
+            n = self.f.readinto(buff[got:])
+            if not n:
+                break  # EOF
+            got += n
+        return got
+
+    def read(self, pos: int, size: int, buff: memoryview, ahead: int = 0) -> memoryview:
+        """
+        Read up to size bytes at pos (less at EOF). Return a view of buff (from scan_read_buffer()) with the data.
+        Ahead is how many bytes after this are going to be read next (kernel is asked to start reading them).
+        """
+        if self.direct:
+            start = pos - pos % DIRECT_IO_ALIGN
+            end = -(-(pos + size) // DIRECT_IO_ALIGN) * DIRECT_IO_ALIGN
+            try:
+                got = self._read_at(start, buff[:end - start])
+                return buff[pos - start:max(pos - start, min(got, pos - start + size))]
+            except OSError:
+                # Some filesystems accept O_DIRECT on open but fail reads (EINVAL). Use page cache then.
+                self.close()
+                self._open(direct=False)
+        got = self._read_at(pos, buff[:size])
+        if self.advise and got:  # (length 0 would mean 'until end of file')
+            if ahead > 0:
+                os.posix_fadvise(self.f.fileno(), pos + got, ahead, os.POSIX_FADV_WILLNEED)
+            os.posix_fadvise(self.f.fileno(), pos, got, os.POSIX_FADV_DONTNEED)
+        return buff[:got]
+
+
+COMPRESS_SAMPLE_SIZE = 16 * 1024  # Compressibility is estimated by LZ4 compressing windows of this size...
+COMPRESS_SAMPLES = 4               # ...this many per HASH_READ_STEP of data
+
+# File headers of formats that are already compressed (no point in testing them)
+_INCOMPRESSIBLE_MAGICS = (
+    b'PK\x03\x04', b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00',  # zip, gz, bz2, xz
+    b"7z\xbc\xaf'\x1c", b'\x28\xb5\x2f\xfd',  # 7z, zstd
+    b'\x04\x22\x4d\x18', b'Rar!\x1a\x07',  # lz4, rar
+    b'\xff\xd8\xff', b'\x89PNG', b'GIF8',  # jpeg, png, gif
+    b'OggS', b'fLaC', b'ID3', b'\x1a\x45\xdf\xa3')  # ogg, flac, mp3, mkv/webm
+
+
+def is_known_incompressible(head: bytes) -> bool:
+    """Check if file header (first 16 bytes or so) looks like an already compressed format"""
+    return head.startswith(_INCOMPRESSIBLE_MAGICS) or head[4:8] == b'ftyp' or \
+        (head[:4] == b'RIFF' and head[8:12] == b'WEBP')  # (mp4/mov/heic, webp)
+
+
+def estimate_compressed_size(data, file_start: bool = False) -> int:
+    """
+    Estimate LZ4 compressed size of data without compressing all of it. Compresses COMPRESS_SAMPLES
+    evenly spaced windows and extrapolates. Gives up early (= incompressible) if the first window
+    doesn't compress, or if data starts with a header of a known compressed format.
+
+    :param data: Bytes-like to estimate
+    :param file_start: True if data is the beginning of a file (=check magic bytes)
+    :return: Estimated compressed size in bytes
+    """
+    data = memoryview(data)
+    n = len(data)
+    if file_start and is_known_incompressible(bytes(data[:16])):
+        return n
+    if n <= COMPRESS_SAMPLE_SIZE * COMPRESS_SAMPLES:
+        return len(lz4.frame.compress(data))  # Small enough to compress fully (with frame overhead, like uploads)
+    step = (n - COMPRESS_SAMPLE_SIZE) // (COMPRESS_SAMPLES - 1)
+    sampled = cmpr = 0
+    for i in range(COMPRESS_SAMPLES):
+        cmpr += len(lz4.block.compress(data[i * step:i * step + COMPRESS_SAMPLE_SIZE], store_size=False))
+        sampled += COMPRESS_SAMPLE_SIZE
+        if cmpr >= sampled * Defaults.LZ4_MAX_CMPRATIO:
+            return n  # Looks like random data, don't bother sampling more
+    return int(n * cmpr / sampled)
+
+
+ZERO_DATA = 'zero'  # Returned instead of a hash for data that's all zero bytes (see zero_chunk_hash())
+_ZEROS = bytes(HASH_READ_STEP)
+
+
+def _is_zero(piece) -> bool:
+    return len(piece) > 0 and piece[0] == 0 and piece[-1] == 0 and bytes(piece) == _ZEROS[:len(piece)]
+
+
+def _hash_pieces(pieces: Iterable, test_compress: bool, file_start: bool, hash_algo: str,
+                 leaf_size: Optional[int]) -> List[Leaf]:
+    """
+    Hash and estimate compressibility of consecutive pieces of data (at most HASH_READ_STEP bytes each),
+    in leaves of leaf_size bytes (None = all of data is a single leaf).
+    Return [(hash, compressed size), ...], with ZERO_DATA as hash for leaves that are all zeros.
+    """
+    res: List[Leaf] = []
+    h, size, cmpr_size, total = None, 0, 0, 0
+
+    def leaf_result() -> Leaf:
+        return (h.result() if h is not None else (ZERO_DATA if size else HashFunc(hash_algo).result()),
+                cmpr_size if test_compress else size)
+
+    for p in pieces:
+        while len(p):
+            seg, p = (p, p[len(p):]) if leaf_size is None else (p[:leaf_size - size], p[leaf_size - size:])
+            if h is None and not _is_zero(seg):
+                h = HashFunc(hash_algo)  # Hash zeros only when it turns out they are not all there is
+                for i in range(0, size, len(_ZEROS)):
+                    h.update(_ZEROS[:min(len(_ZEROS), size - i)])
+            if h is not None:
+                h.update(seg)
+            if test_compress:
+                cmpr_size += estimate_compressed_size(seg, file_start=(file_start and not total))
+            size += len(seg)
+            total += len(seg)
+            if size == leaf_size:
+                res.append(leaf_result())
+                h, size, cmpr_size = None, 0, 0
+    if size or not res:
+        res.append(leaf_result())
+    return res
+
+
+def hash_and_test_compress(data, test_compress: bool, file_start: bool = False,
+                           hash_algo: str = Defaults.HASH_ALGO, leaf_size: Optional[int] = None) -> List[Leaf]:
+    """
+    Hash a buffer (bytes-like, e.g. a memoryview of a reused buffer) in leaves of leaf_size bytes (None = one leaf)
+    and return [(hash, compressed size), ...] for them. Hash is ZERO_DATA if leaf is all zeros (it's not hashed at all).
+    Compressed size is estimated (see estimate_compressed_size()) in HASH_READ_STEP pieces, to give results
+    identical to hash_file_range(). It's len(data) if test_compress is False.
+    """
+    data = memoryview(data)
+    return _hash_pieces((data[i:i + HASH_READ_STEP] for i in range(0, len(data), HASH_READ_STEP)),
+                        test_compress, file_start, hash_algo, leaf_size)
+
+
+_worker_buffers = threading.local()
+
+
+def hash_file_range(full_path: str, pos: int, size: int, test_compress: bool,
+                    hash_algo: str = Defaults.HASH_ALGO, leaf_size: Optional[int] = None,
+                    cache_mode: str = 'keep') -> List[Leaf]:
+    """
+    Read a range of a file and hash_and_test_compress() it. Used by process pool workers,
+    which read the data themselves instead of receiving it pickled from the parent process.
+    Streams through a small reused per-worker buffer, so memory use doesn't depend on sub chunk size.
+    """
+    buff = getattr(_worker_buffers, 'buff', None)
+    if buff is None:
+        buff = _worker_buffers.buff = scan_read_buffer(HASH_READ_STEP)
+
+    def read_pieces(reader: ScanReader):
+        p, end = pos, pos + size
+        while p < end:
+            want = min(end - p, HASH_READ_STEP)  # (whole pieces, so estimator sees same pieces as in threaded path)
+            piece = reader.read(p, want, buff, ahead=min(end - p - want, HASH_READ_STEP))
+            if piece:
+                yield piece
+            if len(piece) < want:
+                break  # EOF
+            p += want
+
+    with ScanReader(full_path, cache_mode) as reader:
+        return _hash_pieces(read_pieces(reader), test_compress, file_start=(pos == 0), hash_algo=hash_algo,
+                            leaf_size=leaf_size)
+
+
+def leaf_size(sub_chunk_size: int) -> int:
+    """
+    Size of leaves that chunks are hashed in. Chunk hash is a chain hash of its leaf hashes, leaves starting from
+    chunk start. This doesn't depend on chunk size, so if chunks are made of whole leaves, hashes for other
+    chunk sizes can be calculated from leaf hashes without reading files again (see chunks_from_leaves()).
+    """
+    return max(1, min(Defaults.LEAF_SIZE, sub_chunk_size))
+
+
+def leaves_aligned(chunk_size: int, sub_chunk_size: int, chunking: str) -> bool:
+    """True if leaves of files chunked like this are file aligned (= leaf hashes are reusable with other chunk sizes)"""
+    return chunking == 'fixed' and chunk_size % leaf_size(sub_chunk_size) == 0
+
+
+def leaf_hashes(chunk_size: int, leaves: List[Leaf], leaf: int, hash_algo: str) -> List[HashType]:
+    """Hashes of a chunk's leaves, with ZERO_DATA replaced by real hashes of zeros (as in SyncBatch.chunk_leaves)"""
+    return [(_zero_sub_chunk_hash(min(leaf, chunk_size - i * leaf), hash_algo) if h == ZERO_DATA else h)
+            for i, (h, __) in enumerate(leaves)]
+
+
+def chain_leaf_hashes(hashes: Iterable[HashType], hash_algo: str) -> HashType:
+    """Chunk hash from hashes of its leaves"""
+    res = ''
+    for h in hashes:
+        res = HashFunc(hash_algo).update((res + h).encode('utf-8')).result()
+    return res
+
+
+def _combine_leaves(chunk: FileChunk, leaves: List[Leaf], leaf: int, hash_algo: str) -> None:
+    """Set chunk hash and cmpratio from its leaves (in pos order, starting from chunk start)"""
+    if leaves and chunk.size and all(h == ZERO_DATA for (h, __) in leaves):
+        chunk.hash, chunk.cmpratio = zero_chunk_hash(chunk.size), 0.0  # (never transferred)
+        return
+    chunk.hash = chain_leaf_hashes(leaf_hashes(chunk.size, leaves, leaf, hash_algo), hash_algo)
+    cmpr_size = sum(cmpr for (__, cmpr) in leaves)
+    chunk.cmpratio = min(1.0, float("%.2g" % (cmpr_size / chunk.size))) if chunk.size else 1.0
+
+
+def chunks_from_leaves(path: str, file_size: int, leaves: List[Leaf], chunk_size: int, leaf: int,
+                       hash_algo: str = Defaults.HASH_ALGO) -> Optional[List[FileChunk]]:
+    """
+    Combine leaf hashes of a whole file into fixed size chunks, without reading the file.
+    Results are identical to hashing the file with given chunk size, which must be a multiple of leaf size.
+
+    :return: List of FileChunks, or None if leaves don't cover the file
+    """
+    assert chunk_size % leaf == 0
+    if len(leaves) != max(1, -(-file_size // leaf)):
+        return None
+    res, per_chunk = [], chunk_size // leaf
+    for i, pos in enumerate(range(0, max(1, file_size), chunk_size)):
+        c = FileChunk(path=path, pos=pos, size=min(chunk_size, file_size - pos), cmpratio=0, hash='')
+        _combine_leaves(c, leaves[i * per_chunk:(i + 1) * per_chunk], leaf, hash_algo)
+        res.append(c)
+    return res
+
+
+class ChunkHasher:
+    """
+    Hash a chunk incrementally as its data comes in (e.g. while downloading it), to verify it without reading
+    it back from disk. Result is identical to the chunk hash scan_dir() gives. Feed data in order, starting
+    from chunk start. Blocking (hashing is CPU bound), run update() in an executor.
+
+    If expected leaf hashes (from SyncBatch.chunk_leaves) are given, every leaf is checked as soon as it's complete,
+    so bad data is noticed early, and parts that are known to be good can be skipped (see skip()).
+    """
+    def __init__(self, sub_chunk_size: int, hash_algo: str = Defaults.HASH_ALGO,
+                 expected_leaves: Optional[List[HashType]] = None):
+        self.leaf, self.hash_algo, self.expected_leaves = leaf_size(sub_chunk_size), hash_algo, expected_leaves
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget all data, start from chunk start"""
+        self.leaf_hashes: List[HashType] = []
+        self.leaves_zero = True  # All complete leaves were zeros
+        self.h, self.leaf_pos, self.leaf_zero = HashFunc(self.hash_algo), 0, True
+
+    @property
+    def size(self) -> int:
+        """Bytes hashed so far"""
+        return len(self.leaf_hashes) * self.leaf + self.leaf_pos
 
-async def file_to_hash_tasks(fio, relpath: str, max_chunk_size: int, max_sub_chunk_size: int) -> \
+    @property
+    def verified_size(self) -> int:
+        """Bytes from chunk start that have been checked against expected_leaves (0 if there are none)"""
+        return len(self.leaf_hashes) * self.leaf if self.expected_leaves is not None else 0
+
+    def skip(self, pos: int) -> None:
+        """
+        Continue from given chunk position, taking leaves up to it from expected_leaves instead of hashing data.
+        For data that's known to be good already, e.g. verified_size of an earlier try, or unchanged parts of
+        a modified chunk (see changed_leaf_ranges()). Position must be at a leaf boundary or at chunk end.
+        """
+        if pos <= self.size:
+            return
+        assert self.expected_leaves is not None and self.leaf_pos == 0
+        skipped = self.expected_leaves[len(self.leaf_hashes):-(-pos // self.leaf)]
+        zero = _zero_sub_chunk_hash(self.leaf, self.hash_algo)
+        self.leaves_zero = self.leaves_zero and all(h == zero for h in skipped)
+        self.leaf_hashes.extend(skipped)
+
+    def update(self, data) -> None:
+        """Hash more data. Raises IOError if a leaf doesn't match expected_leaves (and forgets its data)."""
+        data = memoryview(data)
+        while len(data):
+            seg, data = data[:self.leaf - self.leaf_pos], data[self.leaf - self.leaf_pos:]
+            if self.leaf_zero:
+                self.leaf_zero = all(_is_zero(seg[i:i + HASH_READ_STEP]) for i in range(0, len(seg), HASH_READ_STEP))
+            self.h.update(seg)
+            self.leaf_pos += len(seg)
+            if self.leaf_pos == self.leaf:
+                h, i = self.h.result(), len(self.leaf_hashes)
+                if self.expected_leaves is not None and (i >= len(self.expected_leaves) or h != self.expected_leaves[i]):
+                    self.h, self.leaf_pos, self.leaf_zero = HashFunc(self.hash_algo), 0, True
+                    raise IOError(f'Hash mismatch in leaf #{i} (at {i * self.leaf} bytes)')
+                self.leaf_hashes.append(h)
+                self.leaves_zero = self.leaves_zero and self.leaf_zero
+                self.h, self.leaf_pos, self.leaf_zero = HashFunc(self.hash_algo), 0, True
+
+    def result(self) -> HashType:
+        if self.size and self.leaves_zero and self.leaf_zero:
+            return zero_chunk_hash(self.size)
+        return chain_leaf_hashes(
+            self.leaf_hashes + ([self.h.result()] if (self.leaf_pos or not self.leaf_hashes) else []), self.hash_algo)
+
+
+def changed_leaf_ranges(have: List[HashType], want: List[HashType], leaf: int, size: int,
+                        start: int = 0) -> List[Tuple[int, int]]:
+    """
+    Find which parts of a chunk differ from what's there already, e.g. in an old version of a modified chunk.
+
+    :param have: Leaf hashes of existing data, for leaves from 'start' on (may be fewer than wanted)
+    :param want: Leaf hashes of the chunk (SyncBatch.chunk_leaves)
+    :param leaf: Leaf size
+    :param size: Chunk size
+    :param start: Chunk position of the first leaf in 'have' (multiple of leaf size)
+    :return: [(start, end), ...] byte ranges of the chunk to fetch, adjacent differing leaves merged into one range
+    """
+    res = []
+    first = start // leaf
+    for i in range(first, len(want)):
+        if i - first < len(have) and have[i - first] == want[i]:
+            continue
+        pos, end = i * leaf, min(size, (i + 1) * leaf)
+        if res and res[-1][1] == pos:
+            res[-1] = (res[-1][0], end)
+        else:
+            res.append((pos, end))
+    return res
+
+
+# Chunking modes. 'fixed' splits files at multiples of chunk size, 'cdc' (content defined chunking) at positions
+# picked by a rolling hash of file contents, so that inserting or removing data only changes chunks around the edit.
+CHUNKINGS = ('fixed', 'cdc')
+
+try:
+    import numpy  # Optional. Makes finding content defined chunk boundaries a lot faster.
+except ImportError:
+    numpy = None
+
+# Random 32 bit value for each byte value, for the Gear rolling hash. Changing these moves CDC chunk boundaries.
+_GEAR = tuple(int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=4).digest(), 'little') for i in range(256))
+_GEAR_NP = numpy.array(_GEAR, dtype=numpy.uint32) if numpy else None
+
+
+def check_chunking(chunking: str) -> None:
+    """Raise ValueError if given chunking mode is not supported"""
+    if chunking not in CHUNKINGS:
+        raise ValueError(f"Unsupported chunking '{chunking}' (available: {', '.join(CHUNKINGS)})")
+
+
+def cdc_chunk_sizes(max_chunk_size: int) -> Tuple[int, int, int]:
+    """Minimum, average (a power of two) and maximum chunk size for content defined chunking"""
+    avg = 1 << max(6, (max_chunk_size // 4).bit_length() - 1)
+    return min(avg // 4, max_chunk_size), min(avg, max_chunk_size), max_chunk_size
+
+
+def _gear_first_match(data, first: int, mask: int) -> int:
+    """
+    Find first index i >= first (and >= 31) in data where the Gear hash of data[i-31:i+1] has all mask bits zero.
+    Gear hash is h = ((h << 1) + _GEAR[byte]) mod 2^32 for each byte, so only the last 32 bytes affect it.
+
+    :return: Index or -1 if not found
+    """
+    if len(data) <= first:
+        return -1
+    if numpy is not None:
+        # Vectorized: sum of _GEAR[byte[i-k]] << k for k=0..31, built by doubling the window length
+        g = _GEAR_NP[numpy.frombuffer(data, dtype=numpy.uint8, offset=first - 31)]
+        shift = 1
+        while shift < 32:
+            g[shift:] += g[:-shift] << numpy.uint32(shift)
+            shift *= 2
+        hits = numpy.flatnonzero((g[31:] & numpy.uint32(mask)) == 0)
+        return first + int(hits[0]) if len(hits) else -1
+    h = 0
+    for b in data[first-31:first]:
+        h = ((h << 1) + _GEAR[b]) & 0xFFFFFFFF
+    for i in range(first, len(data)):
+        h = ((h << 1) + _GEAR[data[i]]) & 0xFFFFFFFF
+        if not h & mask:
+            return i
+    return -1
+
+
+def cdc_chunk_ends(f, start: int, end: int, max_chunk_size: int) -> List[int]:
+    """
+    Find content defined chunk boundaries in a file range, FastCDC style: cut where Gear hash of the preceding
+    bytes matches a mask, but never before min size, and with a harder mask before average chunk size
+    than after it ("normalized chunking"), to make chunk sizes cluster around average.
+
+    :param f: File object (opened in binary mode) to read from
+    :param start: Start position of the first chunk
+    :param end: End of range (file size)
+    :param max_chunk_size: Maximum chunk size, see cdc_chunk_sizes()
+    :return: List of chunk end positions (exclusive), last one being `end`
+    """
+    min_size, avg_size, max_size = cdc_chunk_sizes(max_chunk_size)
+    bits = avg_size.bit_length() - 1
+    mask_hard = ((1 << min(32, bits + 1)) - 1) << (32 - min(32, bits + 1))  # (upper bits depend on more bytes)
+    mask_easy = ((1 << max(1, bits - 1)) - 1) << (32 - max(1, bits - 1))
+    res, chunk_start = [], start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + max_size, end)
+        i = chunk_start + max(32, min_size) - 1  # Last byte of shortest allowed chunk
+        while i < chunk_end - 1:
+            hard = i < chunk_start + avg_size
+            seg_end = min(chunk_end - 1, i + HASH_READ_STEP, (chunk_start + avg_size) if hard else end)
+            f.seek(i - 31)
+            hit = _gear_first_match(f.read(seg_end - i + 31), 31, mask_hard if hard else mask_easy)
+            if hit >= 0:
+                chunk_end = i + hit - 31 + 1
+                break
+            i = seg_end
+        res.append(chunk_end)
+        chunk_start = chunk_end
+    return res
+
+
+async def file_to_hash_tasks(fio, relpath: str, max_chunk_size: int, max_sub_chunk_size: int,
+                             file_size: Optional[int] = None, start_pos: int = 0,
+                             chunking: str = Defaults.CHUNKING, layout: Optional[List[FileChunk]] = None) ->\
         Tuple[List[FileChunk], List[SubChunkHashTask]]:
     """
-    Split file into chunks and chunks further into hash tasks.
-    Chunk hash will be a chain hash of sub chunk hashes (and later, file hash a chain hash of chunk hashes).
+    Split file into chunks and chunks further into hash tasks (of whole leaves, see leaf_size()).
+    Chunk hash will be a chain hash of leaf hashes (and later, file hash a chain hash of chunk hashes).
 
     :param fio: FileIO object to read from
     :param relpath: Pathname to file
     :param max_chunk_size: Maximum chunk size in bytes
-    :param max_sub_chunk_size: Maximum hash task size in bytes
+    :param max_sub_chunk_size: Maximum hash task size in bytes (also determines leaf size)
+    :param file_size: File size, if already known (otherwise stat()s the file)
+    :param start_pos: Only split file from this position on (must be a chunk boundary)
+    :param chunking: 'fixed' or 'cdc', see CHUNKINGS. CDC reads the file to find chunk boundaries.
+    :param layout: Optional chunks (sorted by pos) of another version of the file to take chunk boundaries from,
+                   instead of finding them from contents. Lets a peer hash an incomplete file in the same chunks
+                   as master, even if content defined boundaries would come out differently.
     """
     res_chunks, res_sub_chunks = [], []
     assert max_chunk_size >= max_sub_chunk_size
-    file_size = (await fio.stat(relpath)).st_size
+    assert chunking != 'fixed' or start_pos % max_chunk_size == 0
+    if file_size is None:
+        file_size = (await fio.stat(relpath)).st_size
     if file_size == 0:
         res_chunks = [FileChunk(path=relpath, pos=0, cmpratio=1, hash='', size=0)]
-        res_sub_chunks = [SubChunkHashTask(chunk=res_chunks[0], pos=0, cmpr_size=0, result=None, pos_perc=0, size=0)]
+        res_sub_chunks = [SubChunkHashTask(chunk=res_chunks[0], pos=0, result=None, pos_perc=0, size=0)]
     else:
-        for chunk_pos in range(0, file_size, max_chunk_size):
-            chunk = FileChunk(path=relpath, pos=chunk_pos, cmpratio=0, hash='',
-                              size=min(max_chunk_size, file_size - chunk_pos))
+        chunk_ends, pos = [], start_pos
+        for c in (layout or ()):  # (contiguous run of chunks from start_pos on)
+            if c.pos < pos:
+                continue
+            if c.pos > pos or c.size <= 0 or pos >= file_size:
+                break
+            pos = min(c.pos + c.size, file_size)
+            chunk_ends.append(pos)
+        if pos < file_size:
+            if chunking == 'cdc':
+                def find_ends():
+                    with open(fio.resolve_and_sanitize(relpath), 'rb') as f:
+                        return cdc_chunk_ends(f, pos, file_size, max_chunk_size)
+                chunk_ends.extend(await asyncio.get_running_loop().run_in_executor(None, find_ends))
+            else:
+                chunk_ends.extend(min(p + max_chunk_size, file_size) for p in range(pos, file_size, max_chunk_size))
+
+        chunk_pos = start_pos
+        for chunk_end in chunk_ends:
+            chunk = FileChunk(path=relpath, pos=chunk_pos, cmpratio=0, hash='', size=chunk_end - chunk_pos)
             res_chunks.append(chunk)
-            for ht_pos in range(chunk.pos, chunk.pos+chunk.size, max_sub_chunk_size):
-                res_sub_chunks.append(SubChunkHashTask(
-                    chunk=chunk, pos=ht_pos, cmpr_size=None, result=None, pos_perc=float(ht_pos)/file_size,
-                    size=min(max_sub_chunk_size, (chunk.pos + chunk.size) - ht_pos)))
+            res_sub_chunks.extend(chunk_hash_tasks(chunk, max_sub_chunk_size, file_size))
+            chunk_pos = chunk_end
     return res_chunks, res_sub_chunks
 
 
+async def _stat_dirty_paths(fio, old_batch: SyncBatch, dirty_paths: Set[str]) -> \
+        Tuple[Dict[str, os.stat_result], Dict[str, os.stat_result], Set[str], Set[str]]:
+    """
+    Stat (and walk, for dirs) only given paths for a targeted rescan, and their parent dirs (as they've probably
+    got new mtimes). Everything else in old_batch is trusted to be unchanged without even stat()ing it.
+    :return: Tuple(file stats, dir stats, trusted file paths, trusted dir paths)
+    """
+    file_stats: Dict[str, os.stat_result] = {}
+    dir_stats: Dict[str, os.stat_result] = {}
+    trusted_files, trusted_dirs = set(), set()
+
+    def dirty_parent(p: str):
+        return any(str(d) in dirty_paths for d in PurePosixPath(p).parents)
+    for p, f in old_batch.files.items():
+        if p not in dirty_paths and not dirty_parent(p):
+            (trusted_dirs if f.is_dir else trusted_files).add(p)
+    for p in dirty_paths:
+        if dirty_parent(p):
+            continue  # (walked as part of parent)
+        try:
+            st = await fio.stat(p)
+        except OSError:
+            continue  # Deleted (or otherwise unusable, like a symlink pointing outside sync dir)
+        if stat.S_ISDIR(st.st_mode):
+            dir_stats[p] = st
+            sub_files, sub_dirs = await fio.scan_tree(p)
+            file_stats.update(sub_files)
+            dir_stats.update(sub_dirs)
+        elif stat.S_ISREG(st.st_mode):
+            file_stats[p] = st
+    for d in set(str(d) for p in dirty_paths for d in PurePosixPath(p).parents) - {'.'} - set(dir_stats.keys()):
+        trusted_dirs.discard(d)
+        try:
+            st = await fio.stat(d)
+            if stat.S_ISDIR(st.st_mode):
+                dir_stats[d] = st
+        except OSError:
+            pass  # Gone
+    return file_stats, dir_stats, trusted_files, trusted_dirs
+
+
+async def _dir_attribs(fio, dir_stats: Dict[str, os.stat_result], trusted_dirs: Set[str],
+                       old_batch: Optional[SyncBatch], fnames: List[str], errors: List[str]) -> List[FileAttribs]:
+    """
+    FileAttribs for all scanned dirs and parents of given files. Mtimes are taken from dir_stats, old_batch
+    (for trusted dirs) or stat()ed if neither has them. Failures are appended to errors.
+    """
+    res = []
+    dirs = (set(dir_stats.keys()) | trusted_dirs | set(str(d) for p in fnames for d in PurePosixPath(p).parents)) - {'.'}
+    for d in dirs:
+        try:
+            if d in dir_stats:
+                mtime = int(dir_stats[d].st_mtime)
+            elif d in trusted_dirs:
+                mtime = old_batch.files[d].mtime
+            else:
+                mtime = int((await fio.stat(d)).st_mtime)
+            res.append(FileAttribs(path=d, size=-1, chain_hash=None, mtime=mtime))
+        except (OSError, IOError) as e:
+            errors.append(f'[{d}/]: ' + str(e))
+    return res
+
+
+def _unchanged_leaves(path: str, s: os.stat_result, leaf_batch: Optional[SyncBatch], hash_cache, leaf: int,
+                      test_compress: bool, hash_algo: str) -> Optional[List[Leaf]]:
+    """
+    Leaf hashes of an unchanged file from leaf_batch (an old batch with other chunk geometry) or hash_cache,
+    for recombining them into chunks (see chunks_from_leaves()). None if neither has them.
+    """
+    f = leaf_batch.files.get(path) if leaf_batch else None
+    if f is not None and f.size == s.st_size and f.mtime == int(s.st_mtime) and path in leaf_batch.leaves:
+        return leaf_batch.leaves[path]
+    return hash_cache.lookup_leaves(path, s, leaf, test_compress, hash_algo) if hash_cache else None
+
+
+def _whole_file_leaves(chunks: List[FileChunk], new_leaves: Dict[int, List[Leaf]],
+                       old_leaves: Optional[List[Leaf]], leaf: int) -> Optional[List[Leaf]]:
+    """
+    Leaves of a rehashed file, from newly hashed chunks and old leaves of kept chunks (None if incomplete).
+    :param chunks: All chunks of the file, in pos order
+    :param new_leaves: id(chunk) -> leaves, for newly hashed chunks
+    :param old_leaves: Leaves of the file in old batch, for chunks that were kept (appended or written files)
+    """
+    res = []
+    for c in chunks:
+        end = -(-(c.pos + c.size) // leaf)
+        if c.pos != len(res) * leaf:
+            return None  # (gap in chunks)
+        elif id(c) in new_leaves:
+            res.extend(new_leaves[id(c)])
+        elif old_leaves and len(old_leaves) >= end:
+            res.extend(old_leaves[c.pos // leaf:end])
+        else:
+            return None
+    return res
+
+
+def _read_order(path: str, s: os.stat_result, phys_pos: Optional[int]):
+    """Sort key for reading files: by location on disk if known, otherwise by inode number (~creation order)"""
+    return phys_pos is None, phys_pos or 0, s.st_ino, path
+
+
+async def _read_devices(queues: Dict[int, asyncio.Queue], hash_device: Callable, times: Dict[int, float]) -> None:
+    """
+    Run hash_device(st_dev, queue) for all devices in parallel, so that a slow disk doesn't hold back others.
+    :param queues: st_dev -> queue of SubChunkHashTasks to read from that device, in read order
+    :param times: Dict to store how long each device took (seconds) in
+    """
+    async def timed_hash_device(dev: int, queue: asyncio.Queue):
+        t = time.time()
+        await hash_device(dev, queue)
+        times[dev] = time.time() - t
+    loops = [asyncio.ensure_future(timed_hash_device(dev, q)) for dev, q in queues.items()]
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        for t in loops:
+            t.cancel()
+        await asyncio.gather(*loops, return_exceptions=True)
+
+
+async def _read_device_tasks(fio, queue: asyncio.Queue, n_buffers: int, buffer_size: int, cache_mode: str,
+                             consumer: Callable) -> None:
+    """
+    Read hash tasks of one device sequentially (in an executor), into n_buffers preallocated buffers that are reused.
+    Filled buffers (SimpleNamespace with task and view of data) are passed to async consumer, which runs in parallel.
+    """
+    reader: Optional[ScanReader] = None
+    loop = asyncio.get_running_loop()
+
+    async def read_file_sub_chunks(buff: SimpleNamespace):
+        """Producer for producer/consumer loop"""
+        if queue.empty():
+            return None
+        else:
+            ht = queue.get_nowait()
+            full_path = str(fio.resolve_and_sanitize(ht.chunk.path))
+
+            def read():
+                nonlocal reader
+                if not reader or reader.full_path != full_path:  # (reuse current file if possible)
+                    if reader: reader.close()
+                    reader = ScanReader(full_path, cache_mode)
+                return reader.read(ht.pos, ht.size, buff.data, ahead=ht.size)
+            buff.task, buff.view = ht, await loop.run_in_executor(None, read)
+            return buff
+
+    try:
+        await process_multibuffer_io(
+            producer=read_file_sub_chunks, consumer=consumer, parallel_consumers=True,
+            initial_buffers=[SimpleNamespace(data=scan_read_buffer(buffer_size), task=None, view=None)
+                             for __ in range(n_buffers)])
+    finally:
+        if reader: reader.close()
+
+
+async def _run_device_tasks(queue: asyncio.Queue, limit: int, run_task: Callable) -> None:
+    """Run async run_task(hash_task) for all tasks in queue, at most limit of them at a time"""
+    in_flight = set()
+    try:
+        while in_flight or not queue.empty():
+            while len(in_flight) < limit and not queue.empty():
+                in_flight.add(asyncio.ensure_future(run_task(queue.get_nowait())))
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                t.result()
+    finally:
+        for t in in_flight:
+            t.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+def _split_written(old_chunks: List[FileChunk], path: str, size: int, written: Iterable[Tuple[int, int]]) ->\
+        Optional[Tuple[List[FileChunk], List[FileChunk]]]:
+    """
+    Split a file that's only been written to at given places (scan_dir()'s dirty_chunks) into old chunks
+    that can be kept and new (unhashed) ones for the written ranges.
+    :param old_chunks: Chunks of the file in old batch
+    :param size: Current file size
+    :param written: (pos, size) of written ranges
+    :return: Tuple(kept chunks, new chunks), or None if no written range was usable
+    """
+    new, end = [], 0
+    for pos, sz in sorted(set(written)):
+        if pos >= end and sz > 0 and pos + sz <= size:  # (skip overlapping and out of bounds ones)
+            new.append(FileChunk(path=path, pos=pos, size=sz, cmpratio=0, hash=''))
+            end = pos + sz
+    if not new:
+        return None
+    new_ends = [c.pos + c.size for c in new]
+    kept = []
+    for c in old_chunks:
+        i = bisect.bisect_right(new_ends, c.pos)  # (first new chunk that ends after c starts)
+        if c.pos + c.size <= size and (i >= len(new) or new[i].pos >= c.pos + c.size):
+            kept.append(c)
+    return kept, new
+
+
+def _hole_tasks(tasks: List[SubChunkHashTask], data: Optional[List[Tuple[int, int]]]) -> List[SubChunkHashTask]:
+    """
+    Find hash tasks that are completely inside holes of a sparse file, and need not be read.
+    :param data: Data ranges of the file (see FileIO.data_ranges()), None if unknown
+    """
+    if data is None:
+        return []
+    data_ends = [e for (s, e) in data]
+    res = []
+    for ht in tasks:
+        i = bisect.bisect_right(data_ends, ht.pos)  # (first data range that ends after task start)
+        if i >= len(data) or data[i][0] >= ht.pos + ht.size:
+            res.append(ht)
+    return res
+
+
+def _hole_leaves(size: int, leaf: int, test_compress: bool) -> List[Leaf]:
+    """Hash task result for a hole (all zeros), as hash_and_test_compress() would give for it"""
+    return [(ZERO_DATA, 0 if test_compress else min(leaf, size - i)) for i in range(0, size, leaf)]
+
+
+def _appended_prefix(old_batch: SyncBatch, path: str, s: os.stat_result, verified_after: float) -> List[FileChunk]:
+    """
+    If a file seems to have only been appended to since old_batch (same inode, bigger size, mtime not older),
+    return its unchanged leading chunks from old_batch. Otherwise (or if the file was last hashed in full
+    before verified_after) return an empty list.
+    """
+    f = old_batch.files[path]
+    hashed = old_batch.hashed_at.get(path)
+    if f.is_dir or hashed is None or s.st_size <= f.size or int(s.st_mtime) < f.mtime:
+        return []
+    hashed_t, ino = hashed
+    if ino != s.st_ino or hashed_t < verified_after:
+        return []  # Replaced, or time to verify the whole file again
+    res, pos = [], 0
+    for c in old_batch.chunks_of(path):
+        if c.pos != pos or c.pos + c.size > f.size:
+            break
+        if c.pos + c.size == f.size and (old_batch.chunking != 'fixed' or c.size != old_batch.chunk_size):
+            break  # Last chunk was cut by end of file, not at a chunk boundary
+        res.append(c)
+        pos += c.size
+    return res
+
+
+class _PartialBatchPublisher:
+    """
+    Collects what scan_dir() has got ready so far, and hands it to partial_batch_func as a SyncBatch
+    at most every interval seconds.
+    """
+    def __init__(self, func: Callable[[SyncBatch], None], interval: float, batch_args: Tuple[int, int, str, str],
+                 files: List[FileAttribs], chunks: List[FileChunk], dirs: List[FileAttribs]):
+        """
+        :param batch_args: SyncBatch() args for partial batches (chunk_size, sub_chunk_size, hash_algo, chunking)
+        :param files: Unchanged files. Not copied, scan_dir() adds more to the list before hashing starts.
+        :param chunks: Chunks of unchanged files (same as above)
+        :param dirs: Directories
+        """
+        self.func, self.interval, self.batch_args = func, interval, batch_args
+        self.files, self.chunks, self.dirs = files, chunks, dirs
+        self.finished: List[Tuple[FileAttribs, List[FileChunk]]] = []  # Hashed files, in order of completion
+        self.last_t = time.time()
+
+    def file_done(self, attribs: FileAttribs, chunks: List[FileChunk]) -> None:
+        """Add a completely hashed file, and publish a partial batch if it's time for one"""
+        self.finished.append((attribs, chunks))
+        if time.time() - self.last_t < self.interval:
+            return
+        partial = SyncBatch(*self.batch_args)
+        partial.add(files=itertools.chain(self.files, (a for a, __ in self.finished), self.dirs),
+                    chunks=itertools.chain(self.chunks, *(chs for __, chs in self.finished)))
+        self.func(partial)
+        self.last_t = time.time()
+
+
+def chunk_hash_tasks(chunk: FileChunk, max_sub_chunk_size: int, file_size: int) -> List[SubChunkHashTask]:
+    """Split a (non-empty) chunk into hash tasks of at most max_sub_chunk_size bytes, made of whole leaves"""
+    task_size = max_sub_chunk_size - max_sub_chunk_size % leaf_size(max_sub_chunk_size)
+    return [SubChunkHashTask(chunk=chunk, pos=ht_pos, result=None, pos_perc=float(ht_pos)/file_size,
+                             size=min(task_size, (chunk.pos + chunk.size) - ht_pos))
+            for ht_pos in range(chunk.pos, chunk.pos + chunk.size, task_size)]
+
+
 async def scan_dir(fio, max_chunk_size: int, max_sub_chunk_size: int, old_batch: Optional[SyncBatch],
-                   progress_func: Callable, test_compress: bool) ->\
+                   progress_func: Callable, test_compress: bool, hash_cache=None,
+                   dirty_paths: Optional[Iterable[str]] = None,
+                   hash_backend: str = 'thread', hash_workers: Optional[int] = None,
+                   hash_algo: str = Defaults.HASH_ALGO,
+                   partial_batch_func: Optional[Callable[['SyncBatch'], None]] = None,
+                   partial_batch_interval: float = Defaults.PARTIAL_BATCH_INTERVAL,
+                   append_verify_interval: Optional[float] = None,
+                   chunking: str = Defaults.CHUNKING, layout_batch: Optional[SyncBatch] = None,
+                   dirty_chunks: Optional[Dict[str, Iterable[Tuple[int, int]]]] = None,
+                   device_stats_func: Optional[Callable[[str, int, float], None]] = None,
+                   cache_mode: str = Defaults.SCAN_CACHE_MODE,
+                   chunk_leaves: bool = False) ->\
         Tuple[SyncBatch, Iterable[str]]:
     """
-    Scan given directory and generate a list of FileChunks of its contents. If old_chunks is provided,
+    Scan given directory and generate a SyncBatch of its contents. If old_batch is provided,
     assumes contents haven't changed if mtime and size are identical. Optionally tests how compressible chunks are.
 
     :param fio: FileIO with basedir on folder to scan
@@ -222,34 +1303,129 @@ async def scan_dir(fio, max_chunk_size: int, max_sub_chunk_size: int, old_batch:
     :param max_chunk_size: Length of chunk to split files into
     :param max_sub_chunk_size: Block size to hash at a time (chunk has is a chain hash of sub chunks)
     :param old_batch: If given, compares dir it and skips hashing files with identical size & mtime
-    :param test_compress: Test for compressibility while hashing
-    :return: Tuple(New list of FileChunks or old_chunks if no changes are detected, List[errors],
-                   Dict[<hash>: compress_ratio, ...])
+    :param test_compress: Estimate compressibility (FileChunk.cmpratio) while hashing, see estimate_compressed_size()
+    :param hash_cache: Optional persistent HashCache. Files found there (with matching size, mtime, inode and ctime)
+                       are not rehashed, and hashes of newly hashed files are stored in it.
+    :param dirty_paths: If given (along with old_batch), only these files and directory trees are looked at on disk.
+                        Everything else is assumed to be unchanged since old_batch. (See DirWatcher.)
+    :param hash_backend: 'thread' (hash in default executor, data read by asyncio) or 'process' (hash in a process
+                         pool whose workers read the file ranges themselves; scales better on many core machines)
+    :param hash_workers: Number of parallel hash tasks (default: Defaults.MAX_WORKERS threads / one process per core)
+    :param hash_algo: Hash algorithm to use (name in HASH_ALGOS)
+    :param partial_batch_func: If given, called (at most every partial_batch_interval seconds) during long scans
+                               with a partial SyncBatch of everything that's ready so far: unchanged files, files
+                               hashed so far and directories. Lets master start distributing before scan finishes.
+    :param partial_batch_interval: See above
+    :param append_verify_interval: If given, files that only seem to have grown since old_batch (same inode, bigger
+                                   size, mtime not older) are treated as appended to: their full chunks are kept from
+                                   old_batch and only the rest is hashed. To catch other kinds of edits, whole file
+                                   is rehashed anyway if it was last hashed in full over this many seconds ago.
+    :param chunking: How to split files into chunks, see CHUNKINGS. With 'cdc', max_chunk_size is the maximum size of
+                     variable sized chunks (see cdc_chunk_sizes()).
+    :param layout_batch: CDC only. If given, files are split at the same positions as they are in this batch
+                         (see file_to_hash_tasks()). Peers use master's batch, to find what's already in place.
+    :param dirty_chunks: Optional {path: [(pos, size), ...]} of chunks that have been written since old_batch, and
+                         are known to be the only changes to those files (e.g. peer's own downloads). Paths are
+                         looked at like dirty_paths, but only given chunks are hashed, if file size hasn't changed.
+                         Other chunks are taken from old_batch without reading them.
+    :param device_stats_func: If given, called after hashing with (device name, bytes read, seconds) for each
+                              device (disk) that files were read from. Devices are read in parallel, files on each
+                              one in order of their physical location (on spinning disks), to avoid seeking.
+    :param cache_mode: How to use OS page cache when reading files, see SCAN_CACHE_MODES. Default ('drop') keeps big
+                       scans from evicting everything else from cache, e.g. chunks that are being uploaded.
+    :param chunk_leaves: Also list leaf hashes of chunks in result's SyncBatch.chunk_leaves (for peers to verify
+                         partial downloads). Chunks that weren't rehashed get them from old_batch or whole file
+                         leaves if possible, otherwise (e.g. CDC files from hash cache) they are left without.
+    :return: Tuple(SyncBatch of directory contents (old_batch itself if nothing has changed), List[errors])
     """
     errors = []
-    fnames = []
-    dirs = []
-    for root, d_names, f_names in os.walk(str(fio.basedir), topdown=False, onerror=None, followlinks=False):
-        for path in d_names:
-            dirs.append(str(PurePosixPath((Path(root)/path).relative_to(fio.basedir))))
-        for f in f_names:
-            fnames.append(str(PurePosixPath((Path(root)/f).relative_to(PurePosixPath(fio.basedir)))))
-
-    async def file_needs_rehash(p: str):
-        try:
-            f = old_batch.files.get(p) if old_batch else None
-            s = await fio.stat(p)
-            return f is None or f.size != s.st_size or f.mtime != int(s.st_mtime)
-        except (FileNotFoundError, KeyError):
+    scan_start_t = time.time()
+    if hash_backend not in HASH_BACKENDS:
+        raise ValueError(f'Unknown hash backend: {hash_backend}')
+    check_hash_algo(hash_algo)
+    check_chunking(chunking)
+    check_scan_cache_mode(cache_mode)
+
+    leaf = leaf_size(max_sub_chunk_size)
+    aligned = leaves_aligned(max_chunk_size, max_sub_chunk_size, chunking)
+
+    # Old batch is only usable if it was chunked with identical geometry and hash algorithm.
+    # Otherwise its leaf hashes may still be, for recombining unchanged files into new chunks.
+    leaf_batch = None
+    if old_batch and (old_batch.chunk_size, old_batch.sub_chunk_size, old_batch.hash_algo, old_batch.chunking) != \
+            (max_chunk_size, max_sub_chunk_size, hash_algo, chunking):
+        if aligned and old_batch.hash_algo == hash_algo and leaf_size(old_batch.sub_chunk_size) == leaf:
+            leaf_batch = old_batch
+        old_batch = None
+
+    # Walk the tree (or dirty parts of it) and stat everything in one pass. These stat results
+    # (taken before hashing) are used for everything below, files are never re-stat()ed.
+    trusted_files, trusted_dirs = set(), set()  # Assumed unchanged without even stat()ing them (targeted rescan)
+    dirty_chunks = dirty_chunks or {}
+    dirty_paths = None if dirty_paths is None else (set(dirty_paths) | set(dirty_chunks.keys()))
+    full_scan = dirty_paths is None or not old_batch or bool(dirty_paths & {'', '.'})
+    if full_scan:
+        file_stats, dir_stats = await fio.scan_tree()
+    else:
+        file_stats, dir_stats, trusted_files, trusted_dirs = await _stat_dirty_paths(fio, old_batch, dirty_paths)
+    fnames = list(trusted_files) + list(file_stats.keys())
+
+    cached_files = {}  # path -> (FileAttribs, [FileChunk, ...]) from hash_cache
+    releafed_files: Dict[str, List[Leaf]] = {}  # path -> leaves, for cached_files recombined from leaf hashes
+    uncached_files = []  # unchanged files (according to old_batch) that are missing from hash_cache
+    appended_files: Dict[str, List[FileChunk]] = {}  # path -> full chunks that need no rehash, for grown files
+    written_files: Set[str] = set()  # paths where only dirty_chunks need rehashing
+
+    def cache_lookup(p: str, s: os.stat_result):
+        return hash_cache.lookup(p, s, max_chunk_size, max_sub_chunk_size, test_compress, hash_algo, chunking)
+
+    def file_needs_rehash(p: str):
+        f = old_batch.files.get(p) if old_batch else None
+        s = file_stats[p]
+        if f is not None and p in dirty_chunks and f.size == s.st_size > 0:
+            written_files.add(p)  # (even if mtime didn't change, we know it was written to)
             return True
+        if f is not None and f.size == s.st_size and f.mtime == int(s.st_mtime):
+            if hash_cache and not hash_cache.contains(p, s, max_chunk_size, max_sub_chunk_size, test_compress,
+                                                      hash_algo, chunking):
+                uncached_files.append(p)
+            return False
+        cached = cache_lookup(p, s) if hash_cache else None
+        if cached is not None:
+            chain_hash, chunks = cached
+            cached_files[p] = (
+                FileAttribs(path=p, size=s.st_size, mtime=int(s.st_mtime), chain_hash=chain_hash),
+                [FileChunk(path=p, pos=pos, size=size, cmpratio=cmpratio, hash=h) for (pos, size, cmpratio, h) in chunks])
+            return False
+        leaves = _unchanged_leaves(p, s, leaf_batch, hash_cache, leaf, test_compress, hash_algo) if aligned else None
+        chunks = chunks_from_leaves(p, s.st_size, leaves, max_chunk_size, leaf, hash_algo) if leaves else None
+        if chunks is not None:
+            cached_files[p] = (
+                FileAttribs(path=p, size=s.st_size, mtime=int(s.st_mtime), chain_hash=calc_chain_hash(chunks, hash_algo)),
+                chunks)
+            releafed_files[p] = leaves
+            return False
+        if f is not None and append_verify_interval is not None:
+            prefix = _appended_prefix(old_batch, p, s, scan_start_t - append_verify_interval)
+            if prefix:
+                appended_files[p] = prefix
+        return True
 
     # Return immediately if we are completely up to date:
-    files_needing_rehash = set([fn for fn in fnames if await file_needs_rehash(fn)])
-    if old_batch and not files_needing_rehash and len(fnames) == len(old_batch.files):
+    files_needing_rehash = set([fn for fn in file_stats.keys() if file_needs_rehash(fn)])
+    if uncached_files:
+        for fn in uncached_files:
+            chunks = old_batch.chunks_of(fn)
+            hash_cache.store(fn, file_stats[fn], max_chunk_size, max_sub_chunk_size, test_compress,
+                             old_batch.files[fn].chain_hash, ((c.pos, c.size, c.cmpratio, c.hash) for c in chunks),
+                             hash_algo=hash_algo, chunking=chunking, leaf_size=leaf, leaves=old_batch.leaves.get(fn))
+        hash_cache.flush()
+    if old_batch and not files_needing_rehash and not cached_files and len(fnames) == len(old_batch.files):
         return old_batch, errors
 
     # Prepare progress reporting
-    total_size = int(sum([(await fio.stat(f)).st_size for f in fnames]))
+    total_size = int(sum((s.st_size for s in file_stats.values())) +
+                     sum((old_batch.files[f].size for f in trusted_files)))
     total_remaining = total_size
     progr_lock = threading.RLock()  # Mutex to maintain integrity of total_remaining inside file_progress()
 
@@ -261,90 +1437,243 @@ async def scan_dir(fio, max_chunk_size: int, max_sub_chunk_size: int, old_batch:
 
     # Hash files as needed
     res_files, res_chunks = [], []
+    new_chunk_leaves: Dict[HashType, List[HashType]] = {}
+    hashed_at: Dict[str, Tuple[float, int]] = {}
+    file_leaves: Dict[str, List[Leaf]] = {}
 
-    # Copy hashes for apparently non-modified files from old_chunks:
+    # Copy hashes for apparently non-modified files from old_chunks (or hash cache, or recombine leaf hashes):
     for fn in (set(fnames) - files_needing_rehash):
-        res_chunks.extend([c for c in old_batch.chunks if c.path == fn])
-        res_files.append(old_batch.files[fn])
-        total_remaining -= res_files[-1].size
+        if fn in cached_files:
+            attribs, chunks = cached_files[fn]
+            hashed_at[fn] = (leaf_batch and leaf_batch.hashed_at.get(fn)) or (scan_start_t, file_stats[fn].st_ino)
+            if fn in releafed_files:
+                file_leaves[fn] = releafed_files[fn]
+                if hash_cache:
+                    hash_cache.store(fn, file_stats[fn], max_chunk_size, max_sub_chunk_size, test_compress,
+                                     attribs.chain_hash, ((c.pos, c.size, c.cmpratio, c.hash) for c in chunks),
+                                     hash_algo=hash_algo, chunking=chunking, leaf_size=leaf, leaves=file_leaves[fn])
+        else:
+            attribs, chunks = old_batch.files[fn], old_batch.chunks_of(fn)
+            if fn in old_batch.hashed_at:
+                hashed_at[fn] = old_batch.hashed_at[fn]
+            if fn in old_batch.leaves:
+                file_leaves[fn] = old_batch.leaves[fn]
+        res_chunks.extend(chunks)
+        res_files.append(attribs)
+        total_remaining -= attribs.size
 
     # Split files into chunks and sub chunks (hash tasks)
-    new_chunks = []
-    hash_tasks_pending = asyncio.Queue()
-    hash_tasks_done = []
-    for fn in files_needing_rehash:
-        chs, sub_chs = await file_to_hash_tasks(fio, fn, max_chunk_size, max_sub_chunk_size)
-        new_chunks.extend(chs)
+    new_chunks: Dict[str, List[FileChunk]] = {}
+    hash_tasks_pending: Dict[int, asyncio.Queue] = {}  # st_dev -> hash tasks to read from that device, in order
+    device_bytes = collections.Counter()  # st_dev -> bytes to read
+    file_hash_tasks: Dict[str, List[SubChunkHashTask]] = {}
+    file_tasks_remaining = collections.Counter()
+
+    hole_tasks: List[SubChunkHashTask] = []  # Hash tasks that are completely inside holes of sparse files
+
+    async def split_file(fn: str):
+        prefix = appended_files.get(fn, [])
+        layout = layout_batch.chunks_of(fn) if (layout_batch and chunking == 'cdc') else None
+        size = file_stats[fn].st_size
+        try:
+            written = _split_written(old_batch.chunks_of(fn), fn, size, dirty_chunks[fn]) \
+                if fn in written_files else None
+            if written:
+                prefix, chs = written
+                sub_chs = [ht for c in chs for ht in chunk_hash_tasks(c, max_sub_chunk_size, size)]
+            else:
+                written_files.discard(fn)
+                chs, sub_chs = await file_to_hash_tasks(
+                    fio, fn, max_chunk_size, max_sub_chunk_size, file_size=size,
+                    start_pos=sum(c.size for c in prefix), chunking=chunking, layout=layout)
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(None, fio.data_ranges, fn, size) \
+                if size >= max_sub_chunk_size * 2 else None
+            phys_pos = await loop.run_in_executor(None, fio.physical_offset, fn) \
+                if fio.is_rotational(file_stats[fn].st_dev) else None
+        except (OSError, IOError) as e:  # (CDC reads files to split them)
+            errors.append(f'[{fn}]: ' + str(e))
+            return None
+        return prefix, chs, sub_chs, _hole_tasks(sub_chs, data), phys_pos
+
+    rehash_order = list(files_needing_rehash)
+    splits = await asyncio.gather(*(split_file(fn) for fn in rehash_order))  # (in parallel, CDC takes a while)
+    for fn, split in zip(rehash_order, splits):
+        if split is None:
+            files_needing_rehash.discard(fn)
+    splits = sorted(((fn, sp) for fn, sp in zip(rehash_order, splits) if sp), key=lambda x: _read_order(x[0], file_stats[x[0]], x[1][4]))
+    for fn, (prefix, chs, sub_chs, holes, __) in splits:
+        new_chunks[fn] = sorted(prefix + chs, key=lambda c: c.pos)
+        total_remaining -= sum(c.size for c in prefix)
+        file_hash_tasks[fn] = sub_chs
+        file_tasks_remaining[fn] = len(sub_chs)
+        hole_tasks.extend(holes)
+        holes = set(id(ht) for ht in holes)
+        dev = file_stats[fn].st_dev
         for ht in sub_chs:
-            hash_tasks_pending.put_nowait(ht)
+            if id(ht) not in holes:
+                hash_tasks_pending.setdefault(dev, asyncio.Queue()).put_nowait(ht)
+                device_bytes[dev] += ht.size
 
+    def combine_file_hashes(fn: str, complete: bool):
+        """Combine SubChunkHashTasks results of given file into Chunks, and store them in cache if hashed completely"""
+        new_leaves, tasks = {}, file_hash_tasks.pop(fn)
+        for __, chunk_tasks in itertools.groupby(tasks, key=lambda ht: id(ht.chunk)):  # (tasks are in pos order)
+            chunk_tasks = [ht for ht in chunk_tasks if ht.result is not None]
+            if chunk_tasks:
+                leaves = [l for ht in chunk_tasks for l in ht.result]
+                c = chunk_tasks[0].chunk
+                _combine_leaves(c, leaves, leaf, hash_algo)
+                new_leaves[id(c)] = leaves
+                if chunk_leaves and not is_zero_hash(c.hash):
+                    new_chunk_leaves[c.hash] = leaf_hashes(c.size, leaves, leaf, hash_algo)
+        if complete:
+            chunks = new_chunks[fn]  # (including kept chunks of an appended or partially written file)
+            s = file_stats[fn]
+            # (Kept chunks weren't verified, so file keeps the time of its last full hash)
+            kept_old = fn in appended_files or fn in written_files
+            full_hash_t = old_batch.hashed_at.get(fn, (scan_start_t,))[0] if kept_old else scan_start_t
+            hashed_at[fn] = (full_hash_t, s.st_ino)
+            leaves = _whole_file_leaves(chunks, new_leaves, old_batch.leaves.get(fn) if kept_old else None, leaf)
+            if aligned and leaves is not None:
+                file_leaves[fn] = leaves
+            if hash_cache:
+                hash_cache.store(fn, s, max_chunk_size, max_sub_chunk_size, test_compress,
+                                 calc_chain_hash(chunks, hash_algo), ((c.pos, c.size, c.cmpratio, c.hash) for c in chunks),
+                                 hash_algo=hash_algo, chunking=chunking, leaf_size=leaf, leaves=file_leaves.get(fn))
+
+    def hashed_file_attribs(fn: str) -> FileAttribs:
+        """File attributes (from stat before hashing) and tree hash for a rehashed file"""
+        s = file_stats[fn]
+        return FileAttribs(path=fn, size=s.st_size, mtime=int(s.st_mtime),
+                           chain_hash=calc_chain_hash(new_chunks[fn], hash_algo))
+
+    publisher = None
+    if partial_batch_func is not None:
+        dir_attribs = [FileAttribs(path=d, size=-1, chain_hash=None, mtime=int(st.st_mtime))
+                       for d, st in dir_stats.items()] + [old_batch.files[d] for d in trusted_dirs]
+        publisher = _PartialBatchPublisher(partial_batch_func, partial_batch_interval,
+                                           (max_chunk_size, max_sub_chunk_size, hash_algo, chunking),
+                                           res_files, res_chunks, dir_attribs)
+
+    def hash_task_done(hash_task: SubChunkHashTask):
+        path = hash_task.chunk.path
+        file_tasks_remaining[path] -= 1
+        if file_tasks_remaining[path] == 0:
+            combine_file_hashes(path, complete=True)
+            if publisher:
+                publisher.file_done(hashed_file_attribs(path), new_chunks[path])
+
+    # Holes of sparse files are zeros, no need to read them
+    for ht in hole_tasks:
+        ht.result = _hole_leaves(ht.size, leaf, test_compress)
+        file_progress(ht.chunk.path, ht.size, ht.pos_perc)
+        hash_task_done(ht)
+
+    device_times: Dict[int, float] = {}  # st_dev -> seconds it took to read
     # Hash files (process SubChunkHashTask) using multiple threads
-    if True:
-        async def hash_and_compress(buff):
-            hash_task, data = buff
+    if hash_backend == 'thread':
+        async def hash_and_compress(buff: SimpleNamespace):
+            hash_task, data = buff.task, buff.view
             def do_it():
                 file_progress(hash_task.chunk.path, hash_task.size, hash_task.pos_perc)
-                with lz4.frame.LZ4FrameCompressor() as lz:
-                    return HashFunc().update(data).result(),\
-                           (len(lz.begin()) + len(lz.compress(data)) + len(lz.flush())) if test_compress else len(data)
+                return hash_and_test_compress(data, test_compress, file_start=(hash_task.pos == 0),
+                                              hash_algo=hash_algo, leaf_size=leaf)
             loop = asyncio.get_running_loop()
-            hash_task.result, hash_task.cmpr_size = await loop.run_in_executor(None, do_it)
-            hash_tasks_done.append(hash_task)
-
-        fh = None
-        async def read_file_sub_chunks(__):
-            """Producer for producer/consumer loop."""
-            nonlocal fh
-            if hash_tasks_pending.empty():
-                return None
-            else:
-                ht = hash_tasks_pending.get_nowait()
-                # Reuse current file handle if possible
-                if not fh or fh.name != ht.chunk.path or await fh.tell() != ht.pos:
-                    if fh: await fh.close()
-                    fh = await fio.open_and_seek(ht.chunk.path, ht.pos, for_write=False).__aenter__()
-                return ht, await fh.read(ht.size)
+            hash_task.result = await loop.run_in_executor(None, do_it)
+            hash_task_done(hash_task)
 
+        async def hash_device(__, queue: asyncio.Queue):
+            await _read_device_tasks(fio, queue, n_buffers, max_sub_chunk_size, cache_mode, hash_and_compress)
+
+        # Number of buffers limits both parallelism and memory use (each one is a whole sub chunk).
+        # They are divided between devices.
+        n_buffers = max(1, min(hash_workers or Defaults.MAX_WORKERS,
+                               Defaults.HASH_BUFFER_MEMORY // max(1, max_sub_chunk_size))
+                        // max(1, len(hash_tasks_pending)))
         try:
-            await process_multibuffer_io(
-                producer=read_file_sub_chunks, consumer=hash_and_compress, parallel_consumers=True,
-                initial_buffers=[(True, True) for __ in range(Defaults.MAX_WORKERS)])
+            await _read_devices(hash_tasks_pending, hash_device, device_times)
         except (OSError, IOError) as e:
             errors.append(f'Hashing failed: ' + str(e))
-        finally:
-            if fh: await fh.close()
-
-    # Combine SubChunkHashTasks results in Chunks
-    # (multithread processed SubChunkHashTasks may be out of order; sort them by pos to get correct chain hashes)
-    hash_tasks_done = sorted(hash_tasks_done, key=lambda ht: ht.chunk.path + '\0' + '\0' + "%016d" % ht.pos)
-    for ht in hash_tasks_done:
-        ht.chunk.cmpratio += ht.cmpr_size  # temporarily accumulate size, we'll calculate ratio later
-        ht.chunk.hash = HashFunc().update((ht.chunk.hash + ht.result).encode('utf-8')).result()
-        assert ht.chunk in new_chunks
-    for c in new_chunks:
-        c.cmpratio = min(1.0, float("%.2g" % (c.cmpratio / (c.size or 1))))
-    res_chunks.extend(new_chunks)
-
-    # Read file attributes and calculate tree hashes
-    for fn in files_needing_rehash:
-        try:
-            s = await fio.stat(fn)
-            chunks = [c for c in res_chunks if c.path == fn]
-            assert fn not in (fa.path for fa in res_files)
-            res_files.append(FileAttribs(path=fn, size=s.st_size, mtime=int(s.st_mtime), chain_hash=calc_chain_hash(chunks)))
-        except (OSError, IOError) as e:
-            errors.append(f'[{fn}]: ' + str(e))
 
-    # Include all directories and read their file attribs
-    dirs = set(dirs) | set((str(PurePosixPath(Path(p).parent)) for p in fnames)) - set('.')
-    for d in dirs:
+    # ...or multiple processes
+    elif hash_tasks_pending:
+        workers = hash_workers or os.cpu_count() or Defaults.MAX_WORKERS
+        pool = _get_process_pool(workers)
+        loop = asyncio.get_running_loop()
+
+        async def hash_in_worker(hash_task: SubChunkHashTask):
+            full_path = str(fio.resolve_and_sanitize(hash_task.chunk.path))
+            hash_task.result = await loop.run_in_executor(
+                pool, hash_file_range, full_path, hash_task.pos, hash_task.size, test_compress, hash_algo, leaf,
+                cache_mode)
+            file_progress(hash_task.chunk.path, hash_task.size, hash_task.pos_perc)
+            hash_task_done(hash_task)
+
+        async def hash_device(dev: int, queue: asyncio.Queue):
+            # Keep workers busy, but don't queue up the whole directory at once (or seek around on a spinning disk)
+            limit = workers * 2 if not fio.is_rotational(dev) else min(workers * 2, Defaults.ROTATIONAL_DISK_READERS)
+            await _run_device_tasks(queue, limit, hash_in_worker)
+
         try:
-            res_files.append(FileAttribs(path=d, size=-1, chain_hash=None,
-                                         mtime=int((await fio.stat(d)).st_mtime)))
+            await _read_devices(hash_tasks_pending, hash_device, device_times)
         except (OSError, IOError) as e:
-            errors.append(f'[{d}/]: ' + str(e))
+            errors.append(f'Hashing failed: ' + str(e))
+        except concurrent.futures.process.BrokenProcessPool as e:
+            errors.append(f'Hashing failed, worker process died: ' + str(e))
+            _discard_process_pool(workers)
+
+    if device_stats_func:
+        for dev, t in device_times.items():
+            name = f'{os.major(dev)}:{os.minor(dev)}' if hasattr(os, 'major') else str(dev)
+            device_stats_func(name, device_bytes[dev], t)
 
-    res = SyncBatch(max_chunk_size, max_sub_chunk_size)
+    # Combine whatever got hashed of files that failed halfway (won't be cached)
+    for fn in tuple(file_hash_tasks.keys()):
+        combine_file_hashes(fn, complete=False)
+    for chs in new_chunks.values():
+        res_chunks.extend(chs)
+
+    # File attributes (from stat before hashing) and tree hashes
+    res_files.extend(hashed_file_attribs(fn) for fn in files_needing_rehash)
+
+    # Include all directories and their file attribs
+    res_files.extend(await _dir_attribs(fio, dir_stats, trusted_dirs, old_batch, fnames, errors))
+
+    if hash_cache:
+        if full_scan:
+            hash_cache.forget_all_except(fnames)
+        hash_cache.flush()
+
+    res = SyncBatch(max_chunk_size, max_sub_chunk_size, hash_algo, chunking)
     res.add(files=res_files, chunks=res_chunks)
+    res.hashed_at = hashed_at
+    res.leaves = file_leaves
+    if chunk_leaves:
+        res.chunk_leaves = _collect_chunk_leaves(res, new_chunk_leaves, old_batch, leaf_batch)
 
     return res, errors
+
+
+def _collect_chunk_leaves(batch: SyncBatch, new_chunk_leaves: Dict[HashType, List[HashType]],
+                         *old_batches: Optional[SyncBatch]) -> Dict[HashType, List[HashType]]:
+    """
+    Find leaf hashes for (non-zero) chunks in batch: from newly hashed ones, old batches with the same
+    leaf size and hash algorithm (same hash = same leaves) or from whole file leaves of aligned files.
+    """
+    leaf = leaf_size(batch.sub_chunk_size)
+    old_batches = [b for b in old_batches if b and b.hash_algo == batch.hash_algo and
+                   leaf_size(b.sub_chunk_size) == leaf]
+    res = {}
+    for h in batch.all_hashes():
+        if is_zero_hash(h):
+            continue
+        hashes = new_chunk_leaves.get(h) or next((b.chunk_leaves[h] for b in old_batches if h in b.chunk_leaves), None)
+        if hashes is None:
+            c = next((c for c in batch.chunks_with(h) if c.path in batch.leaves and c.pos % leaf == 0), None)
+            if c is not None:
+                leaves = batch.leaves[c.path][c.pos // leaf:-(-(c.pos + c.size) // leaf)]
+                hashes = leaf_hashes(c.size, leaves, leaf, batch.hash_algo) if leaves else None
+        if hashes is not None:
+            res[h] = hashes
+    return res
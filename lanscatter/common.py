@@ -1,6 +1,6 @@
 from datetime import datetime
-from typing import Callable, Iterable, List
-import json, argparse, asyncio, time
+from typing import Callable, Iterable, List, Dict, Tuple
+import json, argparse, asyncio, time, operator
 import psutil, platform, os
 from contextlib import suppress
 
@@ -14,6 +14,12 @@ class Defaults:
 
     CHUNK_SIZE = 128 * 1024 * 1024
     HASH_TASKS_PER_CHUNK = 8  # How many parts to split chunks when tree-hashing it
+    LEAF_SIZE = 1024 * 1024  # Chunk hashes are chain hashes of this size pieces (see chunker.leaf_size())
+    HASH_ALGO = 'blake2b'  # Default hash algorithm for chunks, see chunker.HASH_ALGOS
+    CHUNKING = 'fixed'  # Default chunking mode, see chunker.CHUNKINGS ('cdc' for content defined chunks)
+    HASH_BUFFER_MEMORY = 256 * 1024 * 1024  # Max total size of read buffers when hashing (caps parallel hash tasks)
+    ROTATIONAL_DISK_READERS = 2  # Max parallel hash tasks reading from one spinning disk (process backend)
+    SCAN_CACHE_MODE = 'drop'  # How hashing uses OS page cache, see chunker.SCAN_CACHE_MODES
 
     FILE_BUFFER_SIZE = 256 * 1024
     DOWNLOAD_BUFFER_MAX = 256 * 1024
@@ -25,14 +31,23 @@ class Defaults:
     CONCURRENT_TRANSFERS_PEER = 2
     DIR_SCAN_INTERVAL_PEER = 60
 
+    WATCH_DEBOUNCE = 1.0  # Wait for this many seconds of quiet after a change before rescanning
+    WATCH_OWN_WRITE_GRACE = 3.0  # Ignore changes to files we've written ourselves this many seconds after the fact
+    FULL_RESCAN_INTERVAL_WATCHED = 30 * 60  # Safety full rescan interval when watching sync dir for changes
+
+    APPEND_VERIFY_INTERVAL = 10 * 60  # Fully rehash files that only grew (see scan_dir) at least this often (seconds)
+    PARTIAL_BATCH_INTERVAL = 15  # Publish partially scanned sync dir this often during long master scans (seconds)
+
     MAX_WORKERS = 8
     TIMEOUT_WHEN_NO_PROGRESS = 8
     MIN_LOG_RESOUCE_USAGE_PERIOD = 30
 
+    LZ4_MAX_CMPRATIO = 0.95  # Only compress transfers of chunks that compress at least this well
+
     SPARSE_FILE_MIN_SIZE = 128 * 1024 * 1024  # Sparse file creation on Windows entails slow shell calls
 
     APP_VERSION = '0.1.4'
-    PROTOCOL_VERSION = '4.0.0'
+    PROTOCOL_VERSION = '5.0.0'
 
 
 def drop_process_priority():
@@ -76,6 +91,22 @@ def parse_cli_args(is_master: bool):
                             default=Defaults.CHUNK_SIZE, help='Chunk size for splitting files (in bytes)')
         parser.add_argument('--no-compress', dest='no_compress', action='store_true', default=False,
                             help="Disable LZ4 compression")
+        from .chunker import HASH_ALGOS  # (here to avoid circular import)
+        parser.add_argument('--hash-algo', dest='hash_algo', choices=sorted(HASH_ALGOS.keys()),
+                            default=Defaults.HASH_ALGO,
+                            help="Hash algorithm for chunks. Peers must support it too. 'blake3' and 'xxh3' need "
+                                 "optional packages 'blake3' and 'xxhash'. 'xxh3' is not cryptographic, so only use "
+                                 "it on trusted networks.")
+        from .chunker import CHUNKINGS
+        parser.add_argument('--chunking', dest='chunking', choices=CHUNKINGS, default=Defaults.CHUNKING,
+                            help="How to split files into chunks. 'fixed' cuts at multiples of chunk size. 'cdc' "
+                                 "(content defined chunking) cuts at positions picked from file contents, into "
+                                 "chunks of about chunksize/4 bytes on average (chunksize max), so that data inserted "
+                                 "into a file only changes chunks around it. Install 'numpy' to make 'cdc' scans faster.")
+        parser.add_argument('--leaf-hashes', dest='leaf_hashes', action='store_true', default=False,
+                            help=f"Include hashes of chunk parts ({Defaults.LEAF_SIZE} byte leaves) in sync batch, so "
+                                 f"that peers can verify partial downloads and resume interrupted ones. Makes sync "
+                                 f"batches bigger.")
 
         '''
         parser.add_argument('--sslcert', type=str, default=None, help='SSL certificate file for HTTPS (optional)')
@@ -84,6 +115,28 @@ def parse_cli_args(is_master: bool):
 
     parser.add_argument('-w', '--max-workers', dest='max_workers', type=int,
                         default=Defaults.MAX_WORKERS, help='Max thread workers to allocate.')
+    parser.add_argument('--hash-backend', dest='hash_backend', choices=('thread', 'process'), default='thread',
+                        help="Hash files in worker threads, or in a pool of worker processes "
+                             "(scales better on machines with many cores)")
+    parser.add_argument('--hash-workers', dest='hash_workers', type=int, default=0,
+                        help='Number of parallel hashing tasks. Default: --max-workers for threads, '
+                             'number of CPU cores for processes.')
+    from .chunker import SCAN_CACHE_MODES
+    parser.add_argument('--scan-cache', dest='scan_cache', choices=SCAN_CACHE_MODES, default=Defaults.SCAN_CACHE_MODE,
+                        help="How hashing uses OS page cache. 'drop' asks kernel to read ahead and to forget file "
+                             "data after hashing it, so that scanning big dirs doesn't evict everything else. "
+                             "'direct' bypasses page cache (O_DIRECT, Linux). 'keep' reads normally.")
+    parser.add_argument('--hash-cache', dest='hash_cache', type=str, default='',
+                        help='Persistent hash cache file (SQLite) to avoid rehashing unchanged files after restart. '
+                             'Default: a per sync dir file in user cache directory.')
+    parser.add_argument('--no-hash-cache', dest='no_hash_cache', action='store_true', default=False,
+                        help="Don't use a persistent hash cache")
+    parser.add_argument('--no-watch', dest='no_watch', action='store_true', default=False,
+                        help="Don't watch sync dir for changes (inotify, or polling every --rescan-interval seconds), "
+                             "just do full rescans every --rescan-interval seconds")
+    parser.add_argument('--full-rescan-interval', dest='full_rescan_interval', type=float,
+                        default=Defaults.FULL_RESCAN_INTERVAL_WATCHED,
+                        help='Seconds between full safety rescans when watching sync dir for changes')
 
 
     parser.add_argument('--json', dest='json', action='store_true', default=False, help='Show status as JSON (for GUI usage)')
@@ -165,6 +218,60 @@ class HashableBase:
         return self.__dict__ == other.__dict__
 
 
+class SlotsRecord:
+    """
+    Compact record with value semantics, for objects kept by the million in sets and dicts (e.g. FileChunks).
+    Subclasses list their fields in __slots__. Instead of a __dict__ and a repr() per hash() like in HashableBase,
+    fields are compared as a tuple and hash is cached. (Changing a field resets it, but don't do that while
+    the object is in a set or a dict.)
+    """
+    __slots__ = ('_hash',)
+    _values: Callable   # attrgetter of fields, in __slots__ order
+    _sorted_fields: Tuple[str, ...]
+    _sorted_values: Callable
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._values = operator.attrgetter(*cls.__slots__)
+        cls._sorted_fields = tuple(sorted(cls.__slots__))
+        cls._sorted_values = operator.attrgetter(*cls._sorted_fields)
+
+    def __init__(self, **kwargs):
+        if len(kwargs) != len(self.__slots__):
+            missing, unknown = set(self.__slots__) - set(kwargs), set(kwargs) - set(self.__slots__)
+            raise TypeError(f'{self.__class__.__name__}: missing fields {missing}, unknown fields {unknown}')
+        for k in self.__slots__:
+            object.__setattr__(self, k, kwargs[k])
+        object.__setattr__(self, '_hash', None)
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        object.__setattr__(self, '_hash', None)
+
+    def __getstate__(self):
+        return self._values(self)
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            object.__setattr__(self, k, v)
+        object.__setattr__(self, '_hash', None)
+
+    def __repr__(self):
+        return self.__class__.__name__ + str(self.to_dict())
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash(self._values(self)))
+        return self._hash
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and self._values(self) == self._values(other)
+
+    def to_dict(self) -> Dict:
+        """Fields as a (serializable) dictionary, in sorted order. Class(**d) makes a copy."""
+        return dict(zip(self._sorted_fields, self._sorted_values(self)))
+
+
 async def process_multibuffer_io(producer: Callable, consumer: Callable, initial_buffers: Iterable,
                                  timeout=float('inf'), parallel_consumers=False):
     """
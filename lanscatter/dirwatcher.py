@@ -0,0 +1,344 @@
+from typing import Optional, Set, Dict, Callable, Tuple, List
+from pathlib import Path, PurePosixPath
+from contextlib import contextmanager
+import asyncio, os, time, struct, ctypes, ctypes.util, errno, platform, threading
+
+from .common import Defaults
+
+# Filesystem change notifications for sync dir, to avoid periodical full rescans.
+#
+# Watchers collect relative paths (posix style, like FileAttribs.path) of changed files and
+# directories. After changes have settled for a while (debounce), they are handed to
+# scan_dir(dirty_paths=...) for a targeted rescan. If the watcher loses track of changes
+# (event queue overflow etc), it reports None instead, meaning "do a full rescan".
+
+
+class DirWatcher:
+    """
+    Base class for watchers. Subclasses call _on_change() from the event loop thread.
+    """
+    def __init__(self, basedir: str, debounce: float = Defaults.WATCH_DEBOUNCE):
+        self.basedir = Path(basedir)
+        self.debounce = debounce
+        self.max_delay = debounce * 10  # Don't wait for a quiet moment forever if files keep changing
+        self.own_write_grace = Defaults.WATCH_OWN_WRITE_GRACE
+        self.changes_ready = asyncio.Event()
+        self._changes: Optional[Set[str]] = set()  # None = lost track, need a full rescan
+        self._first_change_t: Optional[float] = None
+        self._last_change_t = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._own_writes: Dict[str, int] = {}        # path -> nesting count of own_writes() contexts
+        self._own_writes_until: Dict[str, float] = {}  # path -> ignore events until this time
+
+    def start(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+
+    @contextmanager
+    def own_writes(self, *paths: str):
+        """
+        Context manager for ignoring changes that we make ourselves to given paths.
+        Events are ignored while inside the context, and for a short grace period after it
+        (events may arrive late).
+        """
+        for p in paths:
+            self._own_writes[p] = self._own_writes.get(p, 0) + 1
+        try:
+            yield
+        finally:
+            until = time.time() + self.own_write_grace
+            for p in paths:
+                self._own_writes[p] -= 1
+                if not self._own_writes[p]:
+                    del self._own_writes[p]
+                self._own_writes_until[p] = until
+
+    def _is_own_write(self, path: str) -> bool:
+        if path in self._own_writes:
+            return True
+        until = self._own_writes_until.get(path)
+        if until is not None:
+            if time.time() < until:
+                return True
+            del self._own_writes_until[path]
+        return False
+
+    def _on_change(self, path: Optional[str]) -> None:
+        """
+        Record a change.
+        :param path: Changed path relative to basedir, or None if changes were lost (=full rescan needed)
+        """
+        if path is not None:
+            if self._is_own_write(path):
+                return
+            if self._changes is not None:
+                self._changes.add(path)
+        else:
+            self._changes = None
+        now = time.time()
+        self._last_change_t = now
+        if self._first_change_t is None:
+            self._first_change_t = now
+            self._schedule_check(self.debounce)
+
+    def _schedule_check(self, delay: float) -> None:
+        self._timer = asyncio.get_event_loop().call_later(delay, self._check_settled)
+
+    def _check_settled(self) -> None:
+        now = time.time()
+        quiet_at = self._last_change_t + self.debounce
+        if now >= quiet_at or now >= self._first_change_t + self.max_delay:
+            self._timer = None
+            self.changes_ready.set()
+        else:
+            self._schedule_check(min(quiet_at, self._first_change_t + self.max_delay) - now)
+
+    def pop_changes(self) -> Optional[Set[str]]:
+        """
+        Return changes collected so far (empty set if none) and start collecting anew.
+        None means that a full rescan is needed.
+        """
+        res = self._changes
+        self._changes = set()
+        self._first_change_t = None
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.changes_ready.clear()
+        return res
+
+    async def wait_changes(self, timeout: float) -> Optional[Set[str]]:
+        """Wait until some changes have settled (or timeout) and return pop_changes()."""
+        try:
+            await asyncio.wait_for(self.changes_ready.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return set()
+        return self.pop_changes()
+
+    def _relpath(self, full: str) -> str:
+        return str(PurePosixPath(Path(full).relative_to(self.basedir)))
+
+
+class InotifyWatcher(DirWatcher):
+    """Linux inotify based watcher (through ctypes, no extra dependencies). One watch per directory."""
+
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    IN_ONLYDIR, IN_DONT_FOLLOW, IN_EXCL_UNLINK = 0x01000000, 0x02000000, 0x04000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+    _event_hdr = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self, basedir: str, debounce: float = Defaults.WATCH_DEBOUNCE):
+        super().__init__(basedir, debounce)
+        if platform.system() != 'Linux':
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1 failed: ' + os.strerror(e))
+        self._fd_lock = threading.Lock()     # Held while using fd from executor threads, so close() can't pull it away
+        self._watches: Dict[int, str] = {}  # watch descriptor -> relative dir path ('' for basedir). Loop thread only.
+        self._walks_running = 0
+        self._unknown_wd_events: List[Tuple[int, int, str]] = []  # Events for watches that walks haven't returned yet
+        try:
+            self._add_watch('')
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _inotify_add_watch(self, rel_dir: str) -> Optional[int]:
+        """Add a watch for given dir. Thread safe. Returns watch descriptor, or None if dir (or watcher) is gone."""
+        with self._fd_lock:
+            if self._fd < 0:
+                return None
+            wd = self._libc.inotify_add_watch(self._fd, str(self.basedir / rel_dir).encode('utf-8'), self.WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return None  # Vanished already, parent's events cover it
+            raise OSError(e, f"inotify_add_watch failed for '{rel_dir}': " + os.strerror(e) +
+                          (' (see /proc/sys/fs/inotify/max_user_watches)' if e == errno.ENOSPC else ''))
+        return wd
+
+    def _add_watch(self, rel_dir: str) -> None:
+        wd = self._inotify_add_watch(rel_dir)
+        if wd is not None:
+            self._watches[wd] = rel_dir
+
+    def _watch_subdirs(self, rel_dir: str) -> List[Tuple[int, str]]:
+        """
+        Add watches for all subdirs of given (watched) dir. Blocking, run in executor.
+        :return: List of (watch descriptor, relative dir path) for the event loop thread to put in self._watches
+        """
+        res = []
+        for root, d_names, __ in os.walk(str(self.basedir / rel_dir), onerror=None, followlinks=False):
+            for d in d_names:
+                if self._fd < 0:
+                    return res  # Closed meanwhile
+                path = self._relpath(os.path.join(root, d))
+                wd = self._inotify_add_watch(path)
+                if wd is not None:
+                    res.append((wd, path))
+        return res
+
+    def _start_subdir_walk(self, rel_dir: str, report: bool) -> None:
+        """
+        Watch subdirs of given (watched) dir in an executor, as walking a big tree would block the event loop.
+        :param report: Report rel_dir as changed when done, as its subdirs may have changed before they were watched
+        """
+        def walk_done(f: asyncio.Future):
+            self._walks_running -= 1
+            if self._fd < 0 or f.cancelled():
+                return
+            if f.exception() is not None:
+                self._on_change(None)  # Out of watches or similar. Can't be sure to catch changes anymore.
+            else:
+                self._watches.update(f.result())
+                if report:
+                    self._on_change(rel_dir)
+            # Replay events that arrived for new watches before they were known
+            early, self._unknown_wd_events = self._unknown_wd_events, []
+            for ev in early:
+                self._handle_event(*ev)
+        self._walks_running += 1
+        asyncio.get_event_loop().run_in_executor(None, self._watch_subdirs, rel_dir).add_done_callback(walk_done)
+
+    def start(self) -> None:
+        asyncio.get_event_loop().add_reader(self._fd, self._read_events)
+        self._start_subdir_walk('', report=False)  # (nodes do a full scan at start anyway)
+
+    def close(self) -> None:
+        super().close()
+        if self._fd >= 0:
+            asyncio.get_event_loop().remove_reader(self._fd)
+            with self._fd_lock:  # (waits for an ongoing inotify_add_watch() in a walk to finish)
+                os.close(self._fd)
+                self._fd = -1
+
+    def _read_events(self) -> None:
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._on_change(None)
+                return
+            i = 0
+            while i + self._event_hdr.size <= len(buf):
+                wd, mask, __, name_len = self._event_hdr.unpack_from(buf, i)
+                i += self._event_hdr.size
+                name = buf[i:i + name_len].split(b'\0', 1)[0].decode('utf-8', errors='surrogateescape')
+                i += name_len
+                self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & self.IN_Q_OVERFLOW:
+            self._on_change(None)
+            return
+        rel_dir = self._watches.get(wd)
+        if rel_dir is None and self._walks_running:
+            self._unknown_wd_events.append((wd, mask, name))  # Probably from a watch that a walk just added
+            return
+        if mask & self.IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        if rel_dir is None:
+            return
+        if not name:
+            # Event on watched dir itself
+            if not rel_dir:
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    self._on_change(None)  # Sync dir itself vanished
+                return
+            self._on_change(rel_dir)
+            return
+        path = str(PurePosixPath(rel_dir) / name) if rel_dir else name
+        if (mask & self.IN_ISDIR) and (mask & (self.IN_CREATE | self.IN_MOVED_TO)):
+            try:
+                self._add_watch(path)
+            except OSError:
+                self._on_change(None)  # Out of watches or similar. Can't be sure to catch changes anymore.
+                return
+            self._start_subdir_walk(path, report=True)
+        self._on_change(path)
+
+
+class PollingWatcher(DirWatcher):
+    """
+    Fallback watcher for platforms without inotify (or when out of inotify watches).
+    Periodically walks the tree and compares sizes and mtimes. Cheaper than a rescan,
+    as it doesn't read files or build SyncBatches.
+    """
+    def __init__(self, basedir: str, poll_interval: float, debounce: float = Defaults.WATCH_DEBOUNCE):
+        super().__init__(basedir, debounce)
+        self.poll_interval = poll_interval
+        self.own_write_grace += poll_interval * 2  # Changes are only noticed on next poll
+        self._snapshot: Dict[str, Tuple[bool, int, int]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _take_snapshot(self) -> Dict[str, Tuple[bool, int, int]]:
+        res = {}
+        stack = [str(self.basedir)]
+        while stack:
+            top = stack.pop()
+            try:
+                with os.scandir(top) as it:
+                    for e in it:
+                        try:
+                            is_dir = e.is_dir(follow_symlinks=False)
+                            st = e.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        res[self._relpath(e.path)] = (is_dir, (-1 if is_dir else st.st_size), st.st_mtime_ns)
+                        if is_dir:
+                            stack.append(e.path)
+            except OSError:
+                pass
+        return res
+
+    async def _poll_loop(self) -> None:
+        loop = asyncio.get_event_loop()
+        self._snapshot = await loop.run_in_executor(None, self._take_snapshot)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            new = await loop.run_in_executor(None, self._take_snapshot)
+            for p in set(new.keys()) | set(self._snapshot.keys()):
+                old_st, new_st = self._snapshot.get(p), new.get(p)
+                if old_st != new_st:
+                    # (Dir mtime changes just mean that entries changed, and those are reported separately)
+                    if old_st is None or new_st is None or not (old_st[0] and new_st[0]):
+                        self._on_change(p)
+            self._snapshot = new
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._poll_loop())
+
+    def close(self) -> None:
+        super().close()
+        if self._task:
+            self._task.cancel()
+
+
+def make_dir_watcher(basedir: str, poll_interval: float, status_func: Callable) -> DirWatcher:
+    """
+    Helper for nodes. Create and start the best available watcher for given dir.
+    """
+    try:
+        res = InotifyWatcher(basedir)
+        status_func(log_info=f'Watching sync dir for changes (inotify).')
+    except (OSError, AttributeError) as e:
+        status_func(log_info=f'Inotify not available ({str(e)}). Polling sync dir for changes '
+                             f'every {poll_interval}s instead.')
+        res = PollingWatcher(basedir, poll_interval)
+    res.start()
+    return res
@@ -1,16 +1,40 @@
 from pathlib import Path, PurePosixPath
 from aiohttp import web, ClientSession
-from typing import Tuple, Optional, Dict, Iterable
+from typing import Tuple, Optional, Dict, List
 from contextlib import suppress
-import aiofiles, os, time, asyncio, aiohttp, platform, subprocess, sys
+import aiofiles, aiofiles.os, os, time, asyncio, aiohttp, platform, subprocess, sys, stat, errno, ctypes, ctypes.util
+import functools, struct
 
 import lz4.frame
 from types import SimpleNamespace
 
 from .common import Defaults, process_multibuffer_io, file_read_producer
-from .chunker import FileChunk
+from .chunker import FileChunk, ChunkHasher, hash_file_range, leaf_hashes, changed_leaf_ranges
 from .ratelimiter import RateLimiter
 
+_FALLOC_FL_KEEP_SIZE, _FALLOC_FL_PUNCH_HOLE = 0x01, 0x02
+_fallocate = None
+if sys.platform.startswith('linux'):
+    with suppress(OSError, AttributeError):
+        _fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).fallocate
+        _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+
+
+try:
+    import fcntl  # (not on Windows)
+except ImportError:
+    fcntl = None
+
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQIIII')     # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, -
+_FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')  # fe_logical, fe_physical, fe_length, -, -, fe_flags, -, -, -
+
+
+def _punch_hole(fd: int, pos: int, size: int) -> bool:
+    """Deallocate given range of a file (reads as zeros afterwards). Linux only. Return False if not supported."""
+    return _fallocate is not None and _fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, pos, size) == 0
+
+
 class FileIO:
     """
     Helper for reading and writing chunks from/to files + downloading / uploading them over network.
@@ -85,25 +109,33 @@ class FileIO:
             -> Tuple[web.StreamResponse, Optional[float], Optional[float]]:
         """
         Read given chunk from disk and stream out as a HTTP response.
+        If request has a Range header (single range, e.g. 'bytes=1048576-'), only that part of the chunk is sent.
 
         :param chunk: Chunk to read
         :param request: HTTP request to answer
         :param use_lz4: Compress with LZ4 if client accepts it
         :return: Tuple(Aiohttp.response, float(seconds the upload took) or None if it no progress was made, compr_ratio)
         """
-        use_lz4 = (chunk.cmpratio < 0.95) and ('lz4' in str(request.headers.get('Accept-Encoding')))
+        use_lz4 = (chunk.cmpratio < Defaults.LZ4_MAX_CMPRATIO) and \
+            ('lz4' in str(request.headers.get('Accept-Encoding')))
         response = None
         upload_size = 0
         start_t = time.time()
         try:
             async with self.open_and_seek(chunk.path, chunk.pos, for_write=False) as inf:
+                start, end = self.requested_range(request, chunk.size)
+                if start:
+                    await inf.seek(chunk.pos + start)
                 with lz4.frame.LZ4FrameCompressor() as lz:
                     # Ok, read chunk from file and stream it out
+                    headers = {'Content-Type': 'application/octet-stream', 'Content-Disposition': 'inline',
+                               'Content-Encoding': 'lz4' if use_lz4 else 'None'}
+                    if (start, end) != (0, chunk.size):
+                        headers['Content-Range'] = f'bytes {start}-{end - 1}/{chunk.size}'
                     response = web.StreamResponse(
-                        status=200,
-                        reason='OK',
-                        headers={'Content-Type': 'application/octet-stream', 'Content-Disposition': 'inline',
-                                 'Content-Encoding': 'lz4' if use_lz4 else 'None'})
+                        status=200 if 'Content-Range' not in headers else 206,
+                        reason='OK' if 'Content-Range' not in headers else 'Partial Content',
+                        headers=headers)
                     response.enable_compression(False)  # Make sure there's no double compression
                     await response.prepare(request)
                     if use_lz4:
@@ -123,18 +155,20 @@ class FileIO:
                             cnt -= limited_n
 
                     await process_multibuffer_io(
-                        producer=file_read_producer(inf, chunk.size), consumer=write_http, timeout=Defaults.TIMEOUT_WHEN_NO_PROGRESS,
+                        producer=file_read_producer(inf, end - start), consumer=write_http, timeout=Defaults.TIMEOUT_WHEN_NO_PROGRESS,
                         initial_buffers=[bytearray(Defaults.FILE_BUFFER_SIZE) for i in range(5)])
 
                     if use_lz4:
                         await response.write(lz.flush())
-                    return response, (time.time() - start_t), (upload_size / (chunk.size or 1))
+                    return response, (time.time() - start_t), (upload_size / ((end - start) or 1))
 
         except asyncio.CancelledError as e:
             # If client disconnected, predict how long upload would have taken
             predicted_time = (time.time() - start_t) / (upload_size or 1) * chunk.size
             return response, predicted_time, None
 
+        except web.HTTPException:
+            raise
         except PermissionError as e:
             raise web.HTTPForbidden(reason=str(e))
         except FileNotFoundError as e:
@@ -149,6 +183,22 @@ class FileIO:
                     await response.write_eof()  # Close chunked response despite possible errors
 
 
+    @staticmethod
+    def requested_range(request: web.Request, size: int) -> Tuple[int, int]:
+        """
+        Parse HTTP Range header of a request for a blob of given size.
+        :return: Tuple(start, end) of requested bytes, (0, size) if there's no Range header
+        """
+        try:
+            rng = request.http_range
+        except ValueError:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+        start = 0 if rng.start is None else (rng.start if rng.start >= 0 else max(0, size + rng.start))
+        end = size if rng.stop is None else min(rng.stop, size)
+        if start >= end and (start, end) != (0, 0):
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+        return start, end
+
     async def copy_chunk_locally(self, copy_from: FileChunk, copy_to: FileChunk) -> bool:
         """
         Locally copy chunk contents from one file (+position) to another.
@@ -157,8 +207,9 @@ class FileIO:
         """
         if copy_from.path == copy_to.path and copy_from.pos == copy_to.pos:
             return True
-        if copy_from.hash != copy_to.hash:
-            raise ValueError(f"From and To chunks must have same hash (was: '{copy_from.hash}' vs '{copy_to.hash}').")
+        if copy_from.hash != copy_to.hash or copy_from.size != copy_to.size:
+            raise ValueError(f"From and To chunks must have same hash and size (was: '{copy_from.hash}' "
+                             f"({copy_from.size} bytes) vs '{copy_to.hash}' ({copy_to.size} bytes)).")
 
         async with self.open_and_seek(copy_from.path, copy_from.pos, for_write=False) as inf:
             if not inf:
@@ -173,7 +224,9 @@ class FileIO:
                     initial_buffers=[bytearray(Defaults.FILE_BUFFER_SIZE) for i in range(5)])
 
     async def download_chunk(self, chunk: FileChunk, url: str, http_session: ClientSession,
-                             file_size: int= -1, max_rate: float = float('inf'), progr_func = None) -> None:
+                             file_size: int= -1, max_rate: float = float('inf'), progr_func = None,
+                             hasher: Optional[ChunkHasher] = None, offset: int = 0,
+                             end: Optional[int] = None) -> None:
         """
         Download chunk from given URL and write directly into (the middle of a) file as specified by FileChunk.
         :param chunk: Specs for chunk to get
@@ -182,6 +235,12 @@ class FileIO:
         :param file_size: Size of complete file (optional). File will be truncated to this size.
         :param max_rate: Maximum download rate, mbit/s
         :param progr_func: Progress reporting callback
+        :param hasher: If given, data is hashed with it while writing, and IOError raised if it doesn't match chunk.hash
+                       (hasher is then reset, so that a retry starts from chunk start).
+        :param offset: Resume an earlier download from this many bytes into the chunk. Asks for a byte range, but
+                       also works with servers that send the whole chunk. Hasher must have hashed data before it.
+        :param end: Only download chunk up to this position (default: chunk end), e.g. to fetch changed parts of a
+                    chunk. Chunk hash is only checked if download reaches chunk end.
         """
         with suppress(RuntimeError):  # Avoid dirty exit in aiofiles when Ctrl^C (RuntimeError('Event loop is closed')
             LMIN, LMAX = Defaults.DOWNLOAD_BUFFER_MAX, Defaults.NETWORK_BUFFER_MIN
@@ -189,15 +248,22 @@ class FileIO:
             limiters = (self.dl_limiter, session_limiter)
 
             aio_timeout = aiohttp.ClientTimeout(connect=Defaults.TIMEOUT_WHEN_NO_PROGRESS, sock_connect=Defaults.TIMEOUT_WHEN_NO_PROGRESS)
-            async with http_session.get(url, headers={'Accept-Encoding': 'lz4'}, timeout=aio_timeout) as resp:
-                if resp.status != 200:  # some error
+            end = chunk.size if end is None else end
+            assert hasher is None or hasher.size == offset
+            headers = {'Accept-Encoding': 'lz4'}
+            if (offset, end) != (0, chunk.size):
+                headers['Range'] = f'bytes={offset}-{end - 1}'
+            async with http_session.get(url, headers=headers, timeout=aio_timeout) as resp:
+                if resp.status not in (200, 206):  # some error
                     raise IOError(f'HTTP status {resp.status}')
                 else:
-                    total_dl = 0
+                    total_dl = offset
+                    skip = offset if resp.status == 200 else 0  # (server ignored Range, throw away what we have)
                     use_lz4 = 'lz4' in str(resp.headers.get('Content-Encoding'))
                     with lz4.frame.LZ4FrameDecompressor() as lz:
-                        async with self.open_and_seek(chunk.path, chunk.pos, for_write=True) as outf:
+                        async with self.open_and_seek(chunk.path, chunk.pos + offset, for_write=True) as outf:
                             progr_timer = RateLimiter(1.0, 2.0)
+                            loop = asyncio.get_running_loop()
 
                             async def read_http(__):
                                 limited_n = min([int(await lmt.acquire(LMIN, LMAX)) for lmt in limiters])
@@ -207,21 +273,151 @@ class FileIO:
                                 return new_buff or None
 
                             async def write_file(buff):
-                                nonlocal total_dl
+                                nonlocal total_dl, skip
                                 data = lz.decompress(buff) if use_lz4 else buff
+                                if skip:
+                                    data, skip = data[skip:], max(0, skip - len(data))
+                                if resp.status == 200 and total_dl + len(data) > end:
+                                    data = data[:max(0, end - total_dl)]  # (server ignored Range)
                                 total_dl += len(data)
+                                if total_dl > end:  # (chunks can be variable sized, don't overwrite the next)
+                                    raise IOError(f'Got more data than requested ({end - offset} bytes)')
                                 if progr_timer.try_acquire(1.0):
                                     progr_func(total_dl, file_size)
                                 await outf.write(data)
+                                if hasher:  # (after write, so that hasher never claims more than what's in the file)
+                                    await loop.run_in_executor(None, hasher.update, data)
 
                             await process_multibuffer_io(
                                 producer=read_http, consumer=write_file, timeout=Defaults.TIMEOUT_WHEN_NO_PROGRESS,
                                 initial_buffers=[True for i in range(5)])
                             progr_func(total_dl, file_size)
+                            if total_dl != end:
+                                raise IOError(f'Got {total_dl - offset} bytes, expected {end - offset}')
+                            if hasher and end == chunk.size and hasher.result() != chunk.hash:
+                                got = hasher.result()
+                                hasher.reset()
+                                raise IOError(f"Hash mismatch, got '{got}', expected '{chunk.hash}'")
 
                             if file_size >= 0:
                                 await outf.truncate(file_size)
 
+    def data_ranges(self, path, size: int) -> Optional[List[Tuple[int, int]]]:
+        """
+        Find out which parts of a (sparse) file contain data, with SEEK_DATA / SEEK_HOLE. Everything else is holes.
+        Blocking, run in executor.
+
+        :param size: File size (ranges are clipped to it)
+        :return: Sorted list of (start, end) ranges, or None if OS or filesystem can't tell
+        """
+        if not hasattr(os, 'SEEK_DATA'):
+            return None
+        res = []
+        with open(self.resolve_and_sanitize(path), 'rb') as f:
+            fd, pos = f.fileno(), 0
+            while pos < size:
+                try:
+                    start = os.lseek(fd, pos, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        break  # Only a hole left
+                    return None
+                end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+                if start < end:
+                    res.append((start, end))
+                pos = max(end, pos + 1)
+        return res
+
+    def changed_ranges(self, chunk: FileChunk, hasher: ChunkHasher) -> List[Tuple[int, int]]:
+        """
+        Compare what's currently on disk at chunk's position (e.g. an older version of a modified chunk) with
+        expected leaf hashes of the chunk, to only download the parts that differ. Blocking, run in executor.
+
+        :param chunk: Chunk that's about to be downloaded
+        :param hasher: Hasher with expected_leaves, possibly already at a leaf boundary inside the chunk (resume)
+        :return: List of (start, end) chunk byte ranges that must be downloaded
+        """
+        start, leaf = hasher.size, hasher.leaf
+        everything = [(start, chunk.size)]
+        if hasher.expected_leaves is None:
+            return everything
+        try:
+            path = self.resolve_and_sanitize(chunk.path)
+            size_on_disk = path.stat().st_size
+        except FileNotFoundError:
+            return everything
+        begin, end = chunk.pos + start, min(chunk.pos + chunk.size, size_on_disk)
+        data = self.data_ranges(chunk.path, size_on_disk)
+        if begin >= end or (data is not None and not any(s < end and e > begin for s, e in data)):
+            return everything  # (nothing there but holes, e.g. a preallocated file)
+        leaves = hash_file_range(str(path), begin, end - begin, False, hasher.hash_algo, leaf)
+        have = leaf_hashes(end - begin, leaves, leaf, hasher.hash_algo)
+        return changed_leaf_ranges(have, hasher.expected_leaves, leaf, chunk.size, start)
+
+    def physical_offset(self, path) -> Optional[int]:
+        """
+        Find where on disk the file's first extent is (FIEMAP ioctl, Linux only). Reading files in this order
+        avoids seeks on spinning disks. Blocking, run in executor.
+
+        :return: Byte offset on the device, or None if unknown (or file is empty / inline / not supported)
+        """
+        if fcntl is None or not sys.platform.startswith('linux'):
+            return None
+        buff = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size)
+        _FIEMAP_HEADER.pack_into(buff, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+        try:
+            with open(self.resolve_and_sanitize(path), 'rb') as f:
+                fcntl.ioctl(f.fileno(), _FS_IOC_FIEMAP, buff)
+        except OSError:
+            return None
+        if _FIEMAP_HEADER.unpack_from(buff)[3] < 1:
+            return None
+        return _FIEMAP_EXTENT.unpack_from(buff, _FIEMAP_HEADER.size)[1]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def is_rotational(st_dev: int) -> Optional[bool]:
+        """
+        Find out if device (st_dev from stat()) is a spinning disk, from Linux sysfs.
+        :return: True / False, or None if unknown
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        base = f'/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}'
+        for p in (base + '/queue/rotational', base + '/../queue/rotational'):  # (disk, or partition of it)
+            with suppress(OSError, ValueError):
+                with open(p) as f:
+                    return f.read().strip() == '1'
+        return None
+
+    async def write_zeros(self, chunk: FileChunk, file_size: int = -1) -> None:
+        """
+        Make given chunk of a file all zeros, with as little I/O as possible: nothing needs to be done for a hole
+        or past end of file (file is extended by truncate), existing data is deallocated (hole punched) if
+        supported, and only as a last resort zeros are actually written. Creates the file if it doesn't exist.
+
+        :param chunk: Chunk to zero out
+        :param file_size: Size of complete file (optional). File will be truncated to this size.
+        """
+        def zero_it():
+            path = self.resolve_and_sanitize(chunk.path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'r+b' if path.exists() else 'w+b') as f:
+                cur_size = os.fstat(f.fileno()).st_size
+                start, end = chunk.pos, min(chunk.pos + chunk.size, cur_size)
+                if start < end:
+                    data = self.data_ranges(chunk.path, cur_size)
+                    if (data is None or any(s < end and e > start for (s, e) in data)) and \
+                            not _punch_hole(f.fileno(), start, end - start):
+                        f.seek(start)
+                        zeros = bytes(min(end - start, Defaults.FILE_BUFFER_SIZE))
+                        for pos in range(start, end, len(zeros)):
+                            f.write(zeros[:min(len(zeros), end - pos)])
+                new_size = file_size if file_size >= 0 else max(cur_size, chunk.pos + chunk.size)
+                if new_size != cur_size:
+                    f.truncate(new_size)
+        await asyncio.get_running_loop().run_in_executor(None, zero_it)
+
     def try_precreate_large_sparse_file(self, path, size: int) -> bool:
         """
         Attempts to create a sparse file 'path' with given size, if it doesn't exist already.
@@ -256,6 +452,49 @@ class FileIO:
         path = self.resolve_and_sanitize(path)
         return await aiofiles.os.stat(str(path))
 
+    async def scan_tree(self, rel_top: str = '') -> Tuple[Dict[str, os.stat_result], Dict[str, os.stat_result]]:
+        """
+        Walk given directory tree and stat() everything in it, in a single pass.
+        Subdirectories are scanned in parallel (in executor threads), which helps a lot on network file systems.
+        Symlinks are followed for stat(), but not descended into. Special files and broken links are skipped.
+
+        :param rel_top: Directory to scan, relative to basedir ('' = whole basedir)
+        :return: Tuple({file_path: stat_result}, {dir_path: stat_result}), posix style paths relative to basedir
+        """
+        rel_top = '' if rel_top in ('', '.') else str(PurePosixPath(rel_top))
+        top = self.resolve_and_sanitize(rel_top) if rel_top else self.basedir
+        files: Dict[str, os.stat_result] = {}
+        dirs: Dict[str, os.stat_result] = {}
+
+        def scan_one(full_path: str, rel_path: str):
+            subdirs = []
+            with os.scandir(full_path) as it:
+                for e in it:
+                    rel = (rel_path + '/' + e.name) if rel_path else e.name
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue  # Broken symlink or vanished
+                    if stat.S_ISDIR(st.st_mode):
+                        dirs[rel] = st
+                        if not e.is_symlink():
+                            subdirs.append((e.path, rel))
+                    elif stat.S_ISREG(st.st_mode):
+                        files[rel] = st
+            return subdirs
+
+        loop = asyncio.get_running_loop()
+        pending = {loop.run_in_executor(None, scan_one, str(top), rel_top)}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    for full_path, rel_path in fut.result():
+                        pending.add(loop.run_in_executor(None, scan_one, full_path, rel_path))
+                except OSError:
+                    pass  # Unreadable or vanished dir. Skip it, like os.walk() does.
+        return files, dirs
+
     async def remove_file_and_paths(self, path):
         path = self.resolve_and_sanitize(path)
         if path.exists():
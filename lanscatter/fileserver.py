@@ -55,6 +55,8 @@ class FileServer:
                     if ul_time:
                         self.upload_times.append(ul_time)
                     return res
+                except web.HTTPRequestRangeNotSatisfiable:
+                    raise
                 except Exception as e:
                     self._status_func(log_error=f"Upload error on [{request.remote}] GET {request.path_qs} "
                                                 f"({type(e).__name__}) {str(e)}")
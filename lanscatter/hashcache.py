@@ -0,0 +1,205 @@
+from typing import Optional, List, Tuple, Iterable, Dict
+from pathlib import Path
+import sqlite3, threading, json, hashlib, os, time
+
+from .common import Defaults
+
+# Persistent on-disk cache of file hashes. Lets scan_dir() skip rehashing unchanged files
+# after a restart, even when there's no in-memory batch from a previous scan to compare against.
+#
+# Backed by SQLite in WAL mode, so an interrupted (killed) process leaves the cache consistent.
+# Cache contents are disposable; anything that looks wrong is simply thrown away and rehashed.
+
+
+class HashCache:
+    """
+    Maps (path, size, mtime, inode, ctime) + chunking geometry, mode and hash algorithm to previously calculated
+    FileChunks and file chain hash. Also keeps leaf hashes (see chunker.leaf_size()) of files, if they were
+    chunked so that leaves are file aligned. Those can be recombined into chunks of another size without rehashing.
+    """
+    SCHEMA_VERSION = 4
+    COMMIT_INTERVAL = 5.0  # Seconds between commits during long scans
+
+    def __init__(self, db_path: str):
+        """
+        :param db_path: SQLite database file. Created (with parent dirs) if it doesn't exist.
+        """
+        self.db_path = str(db_path)
+        self.lock = threading.RLock()
+        self.last_commit_t = time.time()
+        self._present: Dict[str, tuple] = {}  # path -> entry known to be in db, see contains()
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.db = self._open()
+        except sqlite3.DatabaseError:
+            # Corrupted or otherwise unusable cache file -- start from scratch
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.db_path + suffix):
+                    os.remove(self.db_path + suffix)
+            self.db = self._open()
+
+    def _open(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        if db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            db.execute('DROP TABLE IF EXISTS files')
+            db.execute('PRAGMA user_version=%d' % self.SCHEMA_VERSION)
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER, mtime_ns INTEGER, inode INTEGER, ctime_ns INTEGER,
+                chunk_size INTEGER, sub_chunk_size INTEGER, cmp_tested INTEGER, hash_algo TEXT, chunking TEXT,
+                chain_hash TEXT,
+                chunks TEXT,
+                leaf_size INTEGER, leaves TEXT)''')
+        db.commit()
+        return db
+
+    @staticmethod
+    def _key(st) -> Tuple[int, int, int, int]:
+        return int(st.st_size), int(st.st_mtime_ns), int(st.st_ino), int(st.st_ctime_ns)
+
+    def lookup(self, path: str, st: os.stat_result, chunk_size: int, sub_chunk_size: int, test_compress: bool,
+               hash_algo: str = Defaults.HASH_ALGO, chunking: str = Defaults.CHUNKING) ->\
+            Optional[Tuple[Optional[str], List[Tuple[int, int, float, str]]]]:
+        """
+        Find cached hashes for given file.
+
+        :param path: Relative path, as in FileAttribs.path
+        :param st: Current stat() result for the file
+        :param chunk_size: Chunk size the hashes must have been calculated with
+        :param sub_chunk_size: Sub chunk size --||--
+        :param test_compress: If True, only accept entries that have real (tested) compression ratios
+        :param hash_algo: Hash algorithm the hashes must have been calculated with
+        :param chunking: Chunking mode --||--
+        :return: Tuple(chain_hash, [(pos, size, cmpratio, hash), ...]) or None if not found / out of date
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime_ns, inode, ctime_ns, chunk_size, sub_chunk_size, hash_algo, chunking, cmp_tested, '
+                'chain_hash, chunks '
+                'FROM files WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return None
+        if tuple(row[0:4]) != self._key(st) or tuple(row[4:8]) != (chunk_size, sub_chunk_size, hash_algo, chunking):
+            return None
+        if test_compress and not row[8]:
+            return None
+        try:
+            return row[9], [tuple(c) for c in json.loads(row[10])]
+        except ValueError:
+            return None
+
+    def contains(self, path: str, st: os.stat_result, chunk_size: int, sub_chunk_size: int, test_compress: bool,
+                 hash_algo: str = Defaults.HASH_ALGO, chunking: str = Defaults.CHUNKING) -> bool:
+        """
+        Cheap check for whether lookup() would find hashes for given file, without reading them. Entries that
+        have been found (or stored) once are remembered in memory, so rescans of unchanged files don't touch db.
+        """
+        entry = (path, *self._key(st), chunk_size, sub_chunk_size, hash_algo, chunking, bool(test_compress))
+        if self._present.get(path) == entry:
+            return True
+        with self.lock:
+            row = self.db.execute(
+                'SELECT 1 FROM files WHERE path=? AND size=? AND mtime_ns=? AND inode=? AND ctime_ns=? AND '
+                'chunk_size=? AND sub_chunk_size=? AND hash_algo=? AND chunking=? AND cmp_tested>=?', entry).fetchone()
+        if row is not None:
+            self._present[path] = entry
+        return row is not None
+
+    def lookup_leaves(self, path: str, st: os.stat_result, leaf_size: int, test_compress: bool,
+                      hash_algo: str = Defaults.HASH_ALGO) -> Optional[List[Tuple[str, int]]]:
+        """
+        Find cached leaf hashes for given file, regardless of chunk geometry it was last hashed with.
+
+        :param leaf_size: Leaf size the hashes must have been calculated with
+        :return: [(leaf hash, compressed size), ...] in file order, or None if not found / out of date
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime_ns, inode, ctime_ns, leaf_size, hash_algo, cmp_tested, leaves '
+                'FROM files WHERE path=?', (path,)).fetchone()
+        if row is None or row[7] is None:
+            return None
+        if tuple(row[0:4]) != self._key(st) or tuple(row[4:6]) != (leaf_size, hash_algo):
+            return None
+        if test_compress and not row[6]:
+            return None
+        try:
+            return [tuple(l) for l in json.loads(row[7])]
+        except ValueError:
+            return None
+
+    def store(self, path: str, st: os.stat_result, chunk_size: int, sub_chunk_size: int, test_compress: bool,
+              chain_hash: Optional[str], chunks: Iterable[Tuple[int, int, float, str]],
+              hash_algo: str = Defaults.HASH_ALGO, chunking: str = Defaults.CHUNKING,
+              leaf_size: int = 0, leaves: Optional[Iterable[Tuple[str, int]]] = None) -> None:
+        """
+        Save (replace) hashes for given file. Commits to disk every COMMIT_INTERVAL seconds;
+        call flush() to force it.
+
+        :param st: stat() result for the file, taken _before_ it was read for hashing
+        :param chunks: [(pos, size, cmpratio, hash), ...]
+        :param leaf_size: Leaf size of leaves
+        :param leaves: Optional leaf hashes of the whole file, [(leaf hash, compressed size), ...]
+        """
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, *self._key(st), chunk_size, sub_chunk_size, int(bool(test_compress)), hash_algo, chunking,
+                 chain_hash, json.dumps([list(c) for c in chunks]),
+                 leaf_size, None if leaves is None else json.dumps([list(l) for l in leaves])))
+            self._present[path] = (path, *self._key(st), chunk_size, sub_chunk_size, hash_algo, chunking,
+                                   bool(test_compress))
+            if time.time() - self.last_commit_t > self.COMMIT_INTERVAL:
+                self.flush()
+
+    def forget_all_except(self, paths: Iterable[str]) -> None:
+        """Remove entries for files that don't exist anymore."""
+        keep = set(paths)
+        with self.lock:
+            stale = [p for (p,) in self.db.execute('SELECT path FROM files') if p not in keep]
+            self.db.executemany('DELETE FROM files WHERE path=?', ((p,) for p in stale))
+            self._present = {p: e for p, e in self._present.items() if p in keep}
+
+    def flush(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.last_commit_t = time.time()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def default_hash_cache_path(sync_dir: str) -> str:
+    """
+    Pick a per-sync-dir cache file in user's cache directory.
+    (Sync dir itself is not used, as master treats it as read-only.)
+    """
+    try:
+        import appdirs
+        base = Path(appdirs.user_cache_dir(Defaults.APP_NAME, Defaults.APP_VENDOR))
+    except ImportError:
+        base = Path.home() / '.cache' / Defaults.APP_NAME.lower()
+    dir_id = hashlib.blake2b(str(Path(sync_dir).resolve()).encode('utf-8'), digest_size=8).hexdigest()
+    return str(base / f'hashcache-{dir_id}.sqlite')
+
+
+def open_hash_cache(sync_dir: str, cache_path: Optional[str], status_func) -> Optional[HashCache]:
+    """
+    Helper for CLI programs. Open hash cache for given sync dir, or return None if disabled or unusable.
+    :param cache_path: Cache file path, '' for default location or None to disable the cache.
+    """
+    if cache_path is None:
+        return None
+    cache_path = cache_path or default_hash_cache_path(sync_dir)
+    try:
+        res = HashCache(cache_path)
+        status_func(log_info=f"Using hash cache '{cache_path}'.")
+        return res
+    except (OSError, sqlite3.Error) as e:
+        status_func(log_error=f"Could not open hash cache '{cache_path}' ({str(e)}). Continuing without it.")
+        return None
@@ -0,0 +1,233 @@
+from typing import Dict, Tuple, List
+import json, struct, math
+
+from .chunker import SyncBatch, FileAttribs, FileChunk
+
+# Compact binary serialization for SyncBatches ("manifests").
+#
+# Compared to JSON encoded SyncBatch.to_dict(), this avoids repeating paths for every chunk,
+# stores hex hashes as raw bytes and positions/sizes as varints. Used for websocket messages
+# to peers, and usable for storing manifests on disk.
+#
+# Layout (all integers are unsigned LEB128 varints unless noted):
+#
+#   magic 'LSM1', chunk_size, sub_chunk_size, hash_algo (length, utf-8), chunking (length, utf-8), number of files
+#   for each file, sorted by path:
+#       path (front coded: length of prefix shared with previous path, suffix length, utf-8 suffix)
+#       size (zigzag, as directories are -1), flags, mtime, chain_hash (if flags say so), number of chunks
+#       for each chunk, sorted by pos:
+#           pos (zigzag, relative to end of previous chunk), size, cmpratio (float64, NaN = None), hash
+#   number of chunks with leaf hashes (SyncBatch.chunk_leaves)
+#   for each of them, sorted by chunk hash:
+#       chunk hash, number of leaves, leaf hashes
+#
+# Hashes are stored as varint (length*2 + is_hex) followed by raw bytes, so non-hex hashes also survive.
+
+MAGIC = b'LSM1'
+MSG_MAGIC = b'LSMSG1'
+
+_F_CHAIN_HASH = 1   # File has chain_hash
+_F_FLOAT_MTIME = 2  # mtime is float64 instead of zigzag varint
+
+_float64 = struct.Struct('<d')
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def _put_varint(out: bytearray, n: int) -> None:
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(data: bytes, i: int) -> Tuple[int, int]:
+    b = data[i]
+    if b < 0x80:
+        return b, i + 1
+    res, shift = 0, 0
+    while True:
+        b = data[i]
+        i += 1
+        res |= (b & 0x7f) << shift
+        if b < 0x80:
+            return res, i
+        shift += 7
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) if n >= 0 else ((-n << 1) - 1)
+
+
+def _unzigzag(n: int) -> int:
+    return (n >> 1) if not (n & 1) else -((n + 1) >> 1)
+
+
+def _put_hash(out: bytearray, h: str) -> None:
+    try:
+        raw, is_hex = bytes.fromhex(h), 1
+        if raw.hex() != h:  # (e.g. uppercase hex wouldn't roundtrip)
+            raise ValueError
+    except ValueError:
+        raw, is_hex = h.encode('utf-8'), 0
+    _put_varint(out, len(raw) * 2 + is_hex)
+    out += raw
+
+
+def _get_hash(data: bytes, i: int) -> Tuple[str, int]:
+    n, i = _get_varint(data, i)
+    raw = data[i:i + (n >> 1)]
+    return (raw.hex() if (n & 1) else raw.decode('utf-8')), i + (n >> 1)
+
+
+def encode_batch(batch: SyncBatch) -> bytes:
+    """Serialize given SyncBatch into a binary manifest"""
+    out = bytearray(MAGIC)
+    _put_varint(out, batch.chunk_size)
+    _put_varint(out, batch.sub_chunk_size)
+    for s in (batch.hash_algo, batch.chunking):
+        bs = s.encode('utf-8')
+        _put_varint(out, len(bs))
+        out += bs
+    _put_varint(out, len(batch.files))
+    prev_path = b''
+    for path in sorted(batch.files.keys()):
+        f = batch.files[path]
+        bpath = path.encode('utf-8')
+        common = 0
+        for a, b in zip(prev_path, bpath):
+            if a != b:
+                break
+            common += 1
+        _put_varint(out, common)
+        _put_varint(out, len(bpath) - common)
+        out += bpath[common:]
+        prev_path = bpath
+
+        _put_varint(out, _zigzag(f.size))
+        int_mtime = isinstance(f.mtime, int)
+        _put_varint(out, (0 if int_mtime else _F_FLOAT_MTIME) | (0 if f.chain_hash is None else _F_CHAIN_HASH))
+        if int_mtime:
+            _put_varint(out, _zigzag(f.mtime))
+        else:
+            out += _float64.pack(f.mtime)
+        if f.chain_hash is not None:
+            _put_hash(out, f.chain_hash)
+
+        chunks = batch.chunks_of(path)
+        _put_varint(out, len(chunks))
+        expected_pos = 0
+        for c in chunks:
+            _put_varint(out, _zigzag(c.pos - expected_pos))
+            _put_varint(out, c.size)
+            out += _float64.pack(math.nan if c.cmpratio is None else c.cmpratio)
+            _put_hash(out, c.hash)
+            expected_pos = c.pos + c.size
+
+    _put_varint(out, len(batch.chunk_leaves))
+    for h in sorted(batch.chunk_leaves.keys()):
+        _put_hash(out, h)
+        _put_varint(out, len(batch.chunk_leaves[h]))
+        for lh in batch.chunk_leaves[h]:
+            _put_hash(out, lh)
+    return bytes(out)
+
+
+def decode_batch(data: bytes) -> SyncBatch:
+    """Deserialize a binary manifest made by encode_batch()"""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ManifestError('Not a binary manifest (bad magic)')
+    try:
+        i = len(MAGIC)
+        chunk_size, i = _get_varint(data, i)
+        sub_chunk_size, i = _get_varint(data, i)
+        n, i = _get_varint(data, i)
+        hash_algo = data[i:i + n].decode('utf-8')
+        i += n
+        n, i = _get_varint(data, i)
+        chunking = data[i:i + n].decode('utf-8')
+        i += n
+        n_files, i = _get_varint(data, i)
+        files: List[FileAttribs] = []
+        chunks: List[FileChunk] = []
+        prev_path = b''
+        unpack_float = _float64.unpack_from
+        for __ in range(n_files):
+            common, i = _get_varint(data, i)
+            n, i = _get_varint(data, i)
+            bpath = prev_path[:common] + data[i:i + n]
+            i += n
+            prev_path = bpath
+            path = bpath.decode('utf-8')
+
+            zsize, i = _get_varint(data, i)
+            flags, i = _get_varint(data, i)
+            if flags & _F_FLOAT_MTIME:
+                mtime = unpack_float(data, i)[0]
+                i += 8
+            else:
+                zmtime, i = _get_varint(data, i)
+                mtime = _unzigzag(zmtime)
+            chain_hash = None
+            if flags & _F_CHAIN_HASH:
+                chain_hash, i = _get_hash(data, i)
+            files.append(FileAttribs(path=path, size=_unzigzag(zsize), mtime=mtime, chain_hash=chain_hash))
+
+            n_chunks, i = _get_varint(data, i)
+            expected_pos = 0
+            for __ in range(n_chunks):
+                zpos, i = _get_varint(data, i)
+                size, i = _get_varint(data, i)
+                cmpratio = unpack_float(data, i)[0]
+                i += 8
+                h, i = _get_hash(data, i)
+                pos = expected_pos + _unzigzag(zpos)
+                chunks.append(FileChunk(path=path, pos=pos, size=size,
+                                        cmpratio=(None if math.isnan(cmpratio) else cmpratio), hash=h))
+                expected_pos = pos + size
+
+        chunk_leaves: Dict[str, List[str]] = {}
+        n_leaved, i = _get_varint(data, i)
+        for __ in range(n_leaved):
+            h, i = _get_hash(data, i)
+            n, i = _get_varint(data, i)
+            hashes = chunk_leaves[h] = []
+            for __ in range(n):
+                lh, i = _get_hash(data, i)
+                hashes.append(lh)
+    except (IndexError, UnicodeDecodeError, struct.error) as e:
+        raise ManifestError(f'Corrupted binary manifest ({str(e)})')
+    if i != len(data):
+        raise ManifestError('Corrupted binary manifest (truncated or trailing garbage)')
+
+    res = SyncBatch(chunk_size=chunk_size, sub_chunk_size=sub_chunk_size, hash_algo=hash_algo, chunking=chunking)
+    res.add(files=files, chunks=chunks, chunk_leaves=chunk_leaves)
+    return res
+
+
+def pack_message(msg: Dict, batch: SyncBatch) -> bytes:
+    """
+    Make a binary websocket message out of a JSON serializable message dict and a batch.
+    Receiver gets the batch (still encoded) in msg['manifest'], see unpack_message().
+    """
+    header = json.dumps(msg).encode('utf-8')
+    out = bytearray(MSG_MAGIC)
+    _put_varint(out, len(header))
+    out += header
+    out += encode_batch(batch)
+    return bytes(out)
+
+
+def unpack_message(data: bytes) -> Dict:
+    """
+    Parse a binary websocket message made by pack_message(). Batch is left encoded
+    in msg['manifest'], so that receiver can skip decoding it if it's not needed (use decode_batch()).
+    """
+    if data[:len(MSG_MAGIC)] != MSG_MAGIC:
+        raise ManifestError('Not a binary message (bad magic)')
+    n, i = _get_varint(data, len(MSG_MAGIC))
+    msg = json.loads(data[i:i + n].decode('utf-8'))
+    msg['manifest'] = data[i + n:]
+    return msg
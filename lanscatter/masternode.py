@@ -12,7 +12,10 @@ from datetime import datetime
 from . import planner
 from .fileio import FileIO
 from .fileserver import FileServer
-from .chunker import scan_dir
+from .chunker import scan_dir, SyncBatch, is_zero_hash
+from . import manifest
+from .hashcache import open_hash_cache
+from .dirwatcher import make_dir_watcher
 from .common import make_human_cli_status_func, json_status_func, Defaults, parse_cli_args, HashableBase
 
 
@@ -46,6 +49,8 @@ class MasterNode:
         self.replan_trigger = asyncio.Event()
         self.status_page_cache_html = None
         self.status_page_cache_timestamp = time.time()
+        self.batch_version = 0  # Incremented on every batch change. Peers use it to detect missed deltas.
+        self.batch_complete = True  # False while batch is a partial result of an ongoing dir scan
 
         dummy_lm = planner.LinkMapper()
         self.swarm = planner.SwarmCoordinator(link_mapper=dummy_lm)
@@ -59,21 +64,57 @@ class MasterNode:
         self.file_server = FileServer(status_func, upload_finished_func=__on_upload_finished)
 
 
-    def __make_batch_msg(self):
-        return {'action': 'new_batch', 'data': self.file_server.batch.to_dict()}
-
-    async def replace_sync_batch(self, new_batch):
-        if new_batch != self.file_server.batch:
-            self.status_func(log_info='Sync batch changed. Updating planner and notifying clients.')
+    def __make_batch_msg(self, binary: bool = False):
+        """
+        Make a full batch message. If binary is True, returns bytes (a binary manifest message,
+        for joined peers) instead of a dict.
+        """
+        batch = self.file_server.batch
+        msg = {'action': 'new_batch', 'version': self.batch_version, 'digest': batch.digest(),
+               'complete': self.batch_complete}
+        if binary:
+            return manifest.pack_message(msg, batch)
+        msg['data'] = batch.to_dict()
+        return msg
+
+    async def replace_sync_batch(self, new_batch, complete: bool = True):
+        """
+        Start distributing given batch.
+        :param complete: False if batch is a partial result of a scan that's still running. Peers won't
+                         delete local files that are missing from incomplete batches.
+        """
+        if new_batch != self.file_server.batch or complete != self.batch_complete:
+            if complete:
+                self.status_func(log_info='Sync batch changed. Updating planner and notifying clients.')
+            else:
+                self.status_func(log_info=f'Dir scan in progress. Publishing partial sync batch '
+                                          f'({len(new_batch.files)} files and dirs so far).')
+            old_batch = self.file_server.batch
             self.file_server.set_batch(new_batch)
+            self.batch_version += 1
+            self.batch_complete = complete
 
-            # Update planner and send new list to clients
-            self.swarm.reset_hashes((c.hash for c in self.file_server.batch.chunks))
+            # Update planner and send new list to clients. All-zero chunks are never transferred, peers make them.
+            self.swarm.reset_hashes((c.hash for c in self.file_server.batch.chunks if not is_zero_hash(c.hash)))
             self.seed_node.add_hashes(self.swarm.all_hashes, clear_first=True)
-            fl_msg = self.__make_batch_msg()
+
+            # Build messages lazily; a full batch can be large, and a delta only useful if it's small
+            full_msg, delta_msg = None, None
+            delta = old_batch.delta_to(new_batch) if old_batch else None
+            if delta is not None and (len(delta['chunks']) + len(delta['files'])) * 2 > \
+                    len(new_batch.chunks) + len(new_batch.files):
+                delta = None
             for n in self.swarm.nodes:
                 if n != self.seed_node:
-                    await n.client.send_queue.put(fl_msg)
+                    if delta is not None:
+                        delta_msg = delta_msg or {
+                            'action': 'batch_delta', 'from_version': self.batch_version - 1,
+                            'version': self.batch_version, 'digest': new_batch.digest(), 'data': delta,
+                            'complete': complete}
+                        await n.client.send_queue.put(delta_msg)
+                    else:
+                        full_msg = full_msg or self.__make_batch_msg(binary=True)
+                        await n.client.send_queue.put(full_msg)
             self.replan_trigger.set()
         else:
             self.status_func(log_info='No changes in sync dir.')
@@ -157,7 +198,7 @@ class MasterNode:
                     self.status_func(log_info=f'[{peer.address}] Client "{client_name}" joined swarm as "{peer.node.name}".'
                                               f' URL: {peer.node.client.dl_url}')
                     await ok('Joined swarm.')
-                    await peer.sendq.put(self.__make_batch_msg())
+                    await peer.sendq.put(self.__make_batch_msg(binary=True))
 
                     self.replan_trigger.set()
 
@@ -170,7 +211,8 @@ class MasterNode:
                     if not peer.node:
                         return await error("Join the swarm first.")
 
-                    unknown_hashes = peer.node.add_hashes(msg.get('hashes'), clear_first=(action == 'set_hashes'))
+                    unknown_hashes = peer.node.add_hashes((h for h in msg.get('hashes') if not is_zero_hash(str(h))),
+                                                          clear_first=(action == 'set_hashes'))
 
                     self.replan_trigger.set()
                     await ok('Hashes updated')
@@ -214,6 +256,12 @@ class MasterNode:
 
                     await ok('Transfer status updated')
 
+                # ---------------------------------------------------
+                # Client missed a batch delta and needs a full one
+                # ---------------------------------------------------
+                elif action == 'get_batch':
+                    await peer.sendq.put(self.__make_batch_msg(binary=True))
+
                 elif action == 'error':
                     self.status_func(log_info=f'Error msg from client ({client_name}): {str(msg)}')
                 else:
@@ -276,6 +324,10 @@ class MasterNode:
                 while not ws.closed:
                     with suppress(asyncio.TimeoutError):
                         msg = await asyncio.wait_for(peer.sendq.get(), timeout=1)
+                        if isinstance(msg, bytes):
+                            if not ws.closed:
+                                await ws.send_bytes(msg, compress=9)
+                            continue
                         if msg and not ws.closed:
                             await ws.send_json(msg, compress=9)
                         if msg and msg.get('action') == 'fatal':
@@ -395,6 +447,14 @@ async def run_master_server(base_dir: str,
                             concurrent_uploads: int = Defaults.CONCURRENT_TRANSFERS_MASTER,
                             chunk_size=Defaults.CHUNK_SIZE, disable_lz4=False,
                             max_workers=Defaults.MAX_WORKERS,
+                            hash_backend: str = 'thread', hash_workers: Optional[int] = None,
+                            hash_algo: str = Defaults.HASH_ALGO,
+                            chunking: str = Defaults.CHUNKING,
+                            scan_cache: str = Defaults.SCAN_CACHE_MODE,
+                            chunk_leaves: bool = False,
+                            hash_cache_path: Optional[str] = None,
+                            watch_dir: bool = True,
+                            full_rescan_interval: float = Defaults.FULL_RESCAN_INTERVAL_WATCHED,
                             https_cert=None, https_key=None):
 
     # Mute asyncio task exceptions on KeyboardInterrupt / thread CancelledError
@@ -411,24 +471,66 @@ async def run_master_server(base_dir: str,
                         cur_status=f'Hashing ({cur_filename} / at {int(file_progress * 100 + 0.5)}%)')
 
         fio = FileIO(Path(base_dir))
-        while True:
-            # TODO: integrate with inotify (watchdog package) to avoid frequent rescans
-            def scandir_blocking():
-                return asyncio.run(scan_dir(
-                    fio, max_chunk_size=chunk_size, old_batch=server.file_server.batch,
-                    max_sub_chunk_size=int(chunk_size / Defaults.HASH_TASKS_PER_CHUNK),
-                    progress_func=progress_func_adapter, test_compress=(not disable_lz4)))
-            try:
-                new_batch, errors = await loop.run_in_executor(None, scandir_blocking)
-                for i, e in enumerate(errors):
-                    status_func(log_error=f'- Dir scan error #{i}: {e}')
-                if new_batch != server.file_server.batch:
-                    status_func(cur_status=f'New file batch. Serving as master.')
-                    await server.replace_sync_batch(new_batch)
-            except FileNotFoundError as e:
-                status_func(log_info=f'NOTE: Dir scan failed as file suddenly vanished (trying again in a bit): {e}')
+        hash_cache = open_hash_cache(base_dir, hash_cache_path, status_func)
+
+        # Start watching before first scan, so that no changes are missed
+        watcher = make_dir_watcher(base_dir, dir_scan_interval, status_func) if watch_dir else None
+        dirty_paths = None  # None = full rescan
+        next_full_scan = time.time() + full_rescan_interval
+
+        def device_stats(dev: str, n: int, t: float):
+            status_func(log_info=f'Hashed {n / 1024 / 1024:.0f} MB from device {dev} at '
+                                 f'{n / 1024 / 1024 / max(t, 1e-3):.0f} MB/s')
+
+        def publish_partial(batch: SyncBatch):
+            """Called from scanner thread. Waits until published, so a late partial can't replace the final batch."""
+            asyncio.run_coroutine_threadsafe(server.replace_sync_batch(batch, complete=False), loop).result()
+
+        try:
+            while True:
+                # (Don't compare against a partial batch, it could be missing files that were unchanged)
+                old_batch = server.file_server.batch if server.batch_complete else None
+
+                def scandir_blocking():
+                    return asyncio.run(scan_dir(
+                        fio, max_chunk_size=chunk_size, old_batch=old_batch, partial_batch_func=publish_partial,
+                        max_sub_chunk_size=int(chunk_size / Defaults.HASH_TASKS_PER_CHUNK),
+                        progress_func=progress_func_adapter, test_compress=(not disable_lz4), hash_cache=hash_cache,
+                        dirty_paths=dirty_paths, hash_backend=hash_backend, hash_workers=hash_workers,
+                        hash_algo=hash_algo, append_verify_interval=Defaults.APPEND_VERIFY_INTERVAL, chunking=chunking,
+                        device_stats_func=device_stats, cache_mode=scan_cache, chunk_leaves=chunk_leaves))
+                if dirty_paths is not None:
+                    status_func(log_debug=f'Rescanning {len(dirty_paths)} changed path(s).')
+                try:
+                    new_batch, errors = await loop.run_in_executor(None, scandir_blocking)
+                    for i, e in enumerate(errors):
+                        status_func(log_error=f'- Dir scan error #{i}: {e}')
+                    if new_batch != server.file_server.batch or not server.batch_complete:
+                        status_func(cur_status=f'New file batch. Serving as master.')
+                        await server.replace_sync_batch(new_batch)
+                except FileNotFoundError as e:
+                    status_func(log_info=f'NOTE: Dir scan failed as file suddenly vanished (trying again in a bit): {e}')
+                    if watcher:
+                        await asyncio.sleep(Defaults.WATCH_DEBOUNCE)
+                        dirty_paths = None
+                        continue
+
+                if not watcher:
+                    await asyncio.sleep(dir_scan_interval)
+                    continue
 
-            await asyncio.sleep(dir_scan_interval)
+                # Wait for changes, but do an occasional full rescan just in case
+                while True:
+                    dirty_paths = await watcher.wait_changes(timeout=max(0.0, next_full_scan - time.time()))
+                    if dirty_paths is None or time.time() >= next_full_scan:
+                        dirty_paths = None
+                        next_full_scan = time.time() + full_rescan_interval
+                        break
+                    elif dirty_paths:
+                        break
+        finally:
+            if watcher:
+                watcher.close()
 
     try:
         await server.start_master_server(
@@ -453,6 +555,10 @@ async def async_main():
         base_dir=args.dir, port=args.port, ul_limit=args.ul_limit, concurrent_uploads=args.ct,
         dir_scan_interval=args.rescan_interval,  # https_cert=args.sslcert, https_key=args.sslkey,
         disable_lz4=args.no_compress, max_workers=args.max_workers,
+        hash_backend=args.hash_backend, hash_workers=(args.hash_workers or None), hash_algo=args.hash_algo,
+        chunking=args.chunking, scan_cache=args.scan_cache, chunk_leaves=args.leaf_hashes,
+        hash_cache_path=(None if args.no_hash_cache else args.hash_cache),
+        watch_dir=(not args.no_watch), full_rescan_interval=args.full_rescan_interval,
         chunk_size=args.chunksize, status_func=status_func)
 
 def main():
@@ -2,7 +2,7 @@ from typing import Callable, Dict, Tuple, Set, Optional
 import asyncio, aiohttp
 from aiohttp import WSMsgType
 from pathlib import Path
-from contextlib import suppress
+from contextlib import suppress, nullcontext
 import async_timeout
 import traceback, time, json, platform, os
 from concurrent.futures import ThreadPoolExecutor
@@ -10,10 +10,13 @@ from concurrent.futures import ThreadPoolExecutor
 import signal
 import concurrent.futures
 
-from .chunker import SyncBatch, scan_dir
+from .chunker import SyncBatch, FileChunk, ChunkHasher, scan_dir, HASH_ALGOS, CHUNKINGS, is_zero_hash
 from .common import make_human_cli_status_func, json_status_func, Defaults, parse_cli_args
 from .fileserver import FileServer
 from .fileio import FileIO
+from .hashcache import open_hash_cache
+from .dirwatcher import make_dir_watcher
+from . import manifest
 
 
 # Client that keeps given directory synced with a master server,
@@ -26,20 +29,38 @@ class PeerNode:
                  status_func: Callable,         # Callback for status reporting
                  file_rescan_interval: float,   # How often to rescan sync directory (seconds)
                  dl_limit: float,               # Download limit, Mbits/s
-                 ul_limit: float):              # Upload limit, Mbits/s
+                 ul_limit: float,               # Upload limit, Mbits/s
+                 hash_cache_path: Optional[str] = None,  # Persistent hash cache file ('' = default, None = disable)
+                 watch_dir: bool = True,        # Watch sync dir for changes instead of periodical full rescans
+                 full_rescan_interval: float = Defaults.FULL_RESCAN_INTERVAL_WATCHED,  # (when watching)
+                 hash_backend: str = 'thread',  # 'thread' or 'process', see scan_dir()
+                 hash_workers: Optional[int] = None,  # Parallel hash tasks (None = backend's default)
+                 scan_cache: str = Defaults.SCAN_CACHE_MODE):  # Page cache use when hashing, see scan_dir()
 
         self.local_rescan_interval = file_rescan_interval
+        self.watch_dir = watch_dir
+        self.full_rescan_interval = full_rescan_interval
+        self.hash_backend, self.hash_workers, self.scan_cache = hash_backend, hash_workers, scan_cache
+        self.watcher = None  # DirWatcher, created by file_rescan_loop()
         self.next_periodical_rescan = time.time()
         self.file_io = FileIO(Path(basedir), dl_limit, ul_limit)
         self.status_func = status_func
+        self.hash_cache = open_hash_cache(basedir, hash_cache_path, status_func)
 
         self.server_send_queue = asyncio.Queue()
         self.full_rescan_trigger = asyncio.Event()
+        self.written_rescan_trigger = asyncio.Event()  # Rescan chunks in written_chunks
+        self.written_chunks: Dict[str, Set[Tuple[int, int]]] = {}  # path -> {(pos, size), ...} written since scan
+        self.fixups_trigger = asyncio.Event()  # Run local_file_fixups() without a rescan (e.g. after downloads)
         self.exit_trigger = asyncio.Event()
 
         self.local_batch = SyncBatch()
         self.remote_batch = SyncBatch()
+        self.remote_batch_version: Optional[int] = None  # Master's version number for remote_batch
+        self.remote_batch_complete = True  # False if master is still scanning (=batch may be missing files)
         self.active_downloads: Dict[str, Tuple[str, float]] = {}  # chunk_id -> (url, max_rate)
+        self.partial_downloads: Dict[str, Tuple[FileChunk, int]] = {}  # chunk_id -> (target, verified bytes) of
+                                                                        # interrupted downloads, for resuming them
         self.joined_swarm = False
 
         async def __on_upload_finished():
@@ -48,6 +69,14 @@ class PeerNode:
         self.fileserver = FileServer(status_func=self.status_func, upload_finished_func=__on_upload_finished)
 
 
+    def own_writes(self, *paths: str):
+        """Context manager for marking changes we make to local files, so that dir watcher ignores them."""
+        return self.watcher.own_writes(*paths) if self.watcher else nullcontext()
+
+    def mark_written(self, chunk: FileChunk):
+        """Remember a chunk we've written, so that next rescan hashes only it (instead of the whole file)."""
+        self.written_chunks.setdefault(chunk.path, set()).add((chunk.pos, chunk.size))
+
     async def send_transfer_report(self):
         """
         Tell master our transfers stats to help plan chunk distribution
@@ -91,13 +120,15 @@ class PeerNode:
             for p in path_diff.there_only:
                 f = self.remote_batch.files[p]
                 if f.is_dir:
-                    await self.file_io.create_folders(p)
-                    await self.file_io.change_mtime(p, f.mtime)
+                    with self.own_writes(p):
+                        await self.file_io.create_folders(p)
+                        await self.file_io.change_mtime(p, f.mtime)
                     self.local_batch.add(files=[f])
 
             # Precreate large sparse files
-            with ThreadPoolExecutor(max_workers=Defaults.MAX_WORKERS) as executor:
-                files = [self.remote_batch.files[p] for p in path_diff.there_only]
+            files = [self.remote_batch.files[p] for p in path_diff.there_only]
+            with ThreadPoolExecutor(max_workers=Defaults.MAX_WORKERS) as executor, \
+                    self.own_writes(*(f.path for f in files)):
                 def doit(f):
                     if self.file_io.try_precreate_large_sparse_file(f.path, f.size):
                         self.status_func(log_info=f"Precreated sparse file: '{f.path}' ({int(f.size/1024/1024)} MB)")
@@ -106,21 +137,45 @@ class PeerNode:
 
             # Check each missing chunk to see if we've already got it in another local file
             for missing in chunk_diff.there_only:
+                if is_zero_hash(missing.hash):
+                    continue
                 dupe = self.local_batch.first_chunk_with(missing.hash)
                 if dupe:
                     self.status_func(log_info=f'LOCAL: Copying {missing.hash} from "{dupe.path}"/{dupe.pos}'
                                               f' to "{missing.path}"/{missing.pos}')
-                    await self.file_io.copy_chunk_locally(copy_from=dupe, copy_to=missing)
-                    self.full_rescan_trigger.set()  # changes to file contents, need to re-hash them
-
-            # Filter out chunks with no useful hashes
-            self.local_batch.discard(chunks=chunk_diff.here_only)
-
-            # Delete dangling files
+                    with self.own_writes(missing.path):
+                        await self.file_io.copy_chunk_locally(copy_from=dupe, copy_to=missing)
+                    self.mark_written(missing)
+                    self.written_rescan_trigger.set()  # changes to file contents, need to re-hash them
+
+            # All-zero chunks aren't downloaded, make them locally (usually a hole in a sparse file, so no writes).
+            # Done after copies, as they may overwrite chunks that were copy sources.
+            zero_chunks = [c for c in chunk_diff.there_only if is_zero_hash(c.hash)]
+            for missing in zero_chunks:
+                with self.own_writes(missing.path):
+                    await self.file_io.write_zeros(missing, file_size=self.remote_batch.files[missing.path].size)
+                self.local_batch.add(chunks=(missing,))
+                self.mark_written(missing)
+            if zero_chunks:
+                self.status_func(log_info=f'LOCAL: Created {len(zero_chunks)} all-zero chunks locally.')
+
+            # Filter out chunks with no useful hashes (but keep those of files master hasn't listed yet)
+            useless = chunk_diff.here_only
+            if not self.remote_batch_complete:
+                useless = [c for c in useless if c.path in self.remote_batch.files]
+            self.local_batch.discard(chunks=useless)
+
+            # Delete dangling files (unless master is still scanning, and they might just not be listed yet)
             path_diff = self.local_batch.file_tree_diff(self.remote_batch)
+            if not self.remote_batch_complete:
+                if path_diff.here_only:
+                    self.status_func(log_info=f'LOCAL: Master is still scanning. Keeping {len(path_diff.here_only)} '
+                                              f'local files/dirs that are not in sync batch yet.')
+                path_diff.here_only = set()
             for path in path_diff.here_only:
                 self.status_func(log_info=f'LOCAL: Deleting dangling file: "{path}"')
-                await self.file_io.remove_file_and_paths(path)
+                with self.own_writes(path):
+                    await self.file_io.remove_file_and_paths(path)
             self.local_batch.discard(paths=path_diff.here_only)
 
             # Fix timestamps on complete / incomplete files
@@ -130,21 +185,24 @@ class PeerNode:
 
                 if here.is_dir != there.is_dir:
                     self.status_func(log_info=f'LOCAL: "{f.path}" is dir here and file there (or vice versa). Deleting.')
-                    await self.file_io.remove_file_and_paths(f.path)
+                    with self.own_writes(f.path):
+                        await self.file_io.remove_file_and_paths(f.path)
                     self.local_batch.discard(paths=[f.path])
                 elif here.is_dir:
                     if here.mtime != there.mtime:
                         self.status_func(log_info=f'LOCAL: Fixing mtime for dir "{here.path}"')
-                        await self.file_io.change_mtime(here.path, there.mtime)
-                        here.mtime = there.mtime
+                        with self.own_writes(here.path):
+                            await self.file_io.change_mtime(here.path, there.mtime)
+                        self.local_batch.set_mtime(here.path, there.mtime)
                 else:
                     assert(there.chain_hash is not None)
                     if here.chain_hash == there.chain_hash:
                         if here.size == there.size:
                             assert here.mtime != there.mtime
                             self.status_func(log_info=f'LOCAL: File complete, setting mtime: "{here.path}"')
-                            await self.file_io.change_mtime(here.path, there.mtime)
-                            here.mtime = there.mtime
+                            with self.own_writes(here.path):
+                                await self.file_io.change_mtime(here.path, there.mtime)
+                            self.local_batch.set_mtime(here.path, there.mtime)
                         else:
                             self.status_func(log_error=f'LOCAL: Hash matches but size differs. Forgetting file. Here: {str(here)}, there: {str(there)}')
                             self.local_batch.discard(paths=[f.path])
@@ -152,8 +210,10 @@ class PeerNode:
                     elif here.mtime == there.mtime:
                         self.status_func(log_info=f'LOCAL: File "{here.path}" has wrong content but was'
                                                   f' set to target time. Resetting it to "now".')
-                        here.mtime = time.time()
-                        await self.file_io.change_mtime(here.path, here.mtime)
+                        now = time.time()
+                        with self.own_writes(here.path):
+                            await self.file_io.change_mtime(here.path, now)
+                        self.local_batch.set_mtime(here.path, now)
 
             self.status_func(log_debug=f"LOCAL: Local fixups done.")
             self.local_batch.sanity_checks()
@@ -162,6 +222,12 @@ class PeerNode:
             if self.local_batch == self.remote_batch:
                 self.status_func(log_info='Up to date.', cur_status='Up to date.', progress=-1)
             else:
+                if not self.remote_batch_complete:
+                    # Extra local files are expected, as master hasn't listed them yet. Compare the rest.
+                    path_diff = self.local_batch.file_tree_diff(self.remote_batch)
+                    if not (path_diff.there_only or path_diff.with_different_attribs):
+                        self.status_func(cur_status='Up to date with files master has scanned so far.', progress=-1)
+                        return
                 # If we've got all hashes, local changes and scans should get us up to date. Run multiple times if needed.
                 if self.local_batch.have_all_hashes(self.remote_batch.all_hashes()):
                     self.status_func(log_info='Have all chunks but local dir not in sync yet. Rescanning.')
@@ -188,12 +254,22 @@ class PeerNode:
             return
 
         max_rate = max_rate or float('inf')
-        target = self.remote_batch.first_chunk_with(chunk_hash)
+        # Resume an interrupted download of the same chunk (possibly from another peer), if target is still valid
+        target, offset = self.partial_downloads.pop(chunk_hash, (None, 0))
+        if target is None or target not in self.remote_batch.chunks_with(chunk_hash):
+            target, offset = self.remote_batch.first_chunk_with(chunk_hash), 0
         if not target:
             self.status_func(log_error=f'Bad download command from master, or old filelist? Chunk {chunk_hash} is unknown.')
             return
-
-        dl_task = None
+        hasher = ChunkHasher(self.remote_batch.sub_chunk_size, self.remote_batch.hash_algo,
+                             expected_leaves=self.remote_batch.chunk_leaves.get(chunk_hash))
+        if offset and hasher.expected_leaves is not None:
+            hasher.skip(offset)
+            self.status_func(log_info=f'Resuming download of {chunk_hash} at {offset} / {target.size} bytes.')
+        else:
+            offset = 0
+
+        dl_task, done = None, False
         try:
             self.active_downloads[chunk_hash] = (url, max_rate)
             await self.send_transfer_report()
@@ -203,27 +279,46 @@ class PeerNode:
                                  log_info=f'From {url} (lim: {int(max_rate*8/1024/1024+0.5)} Mbps) [{int(float(got) / (total or 1) * 100 + 0.5)}%]',
                                  progress=len(self.local_batch.all_hashes()) / (len(self.remote_batch.all_hashes()) or 1))
 
-            async with async_timeout.timeout(timeout):
-                dl_task = asyncio.create_task(
-                    self.file_io.download_chunk(chunk=target, url=url, http_session=http_session,
-                                                file_size=self.remote_batch.files[target.path].size,
-                                                max_rate=max_rate, progr_func=progress))
-                await asyncio.wait([dl_task, asyncio.create_task(self.exit_trigger.wait())],
-                                   return_when=asyncio.FIRST_COMPLETED)
+            async def fetch():
+                # If an older version of the chunk is on disk already, only get leaves that changed
+                ranges = await asyncio.get_running_loop().run_in_executor(
+                    None, self.file_io.changed_ranges, target, hasher)
+                if ranges != [(offset, target.size)]:
+                    self.status_func(log_info=f'Delta download of {chunk_hash}: {sum(e - s for s, e in ranges)} '
+                                              f'/ {target.size - offset} bytes differ from local file.')
+                for start, end in ranges:
+                    hasher.skip(start)
+                    await self.file_io.download_chunk(chunk=target, url=url, http_session=http_session,
+                                                      file_size=self.remote_batch.files[target.path].size,
+                                                      max_rate=max_rate, progr_func=progress,
+                                                      hasher=hasher, offset=start, end=end)
+                hasher.skip(target.size)
+                if hasher.result() != target.hash:
+                    got = hasher.result()
+                    hasher.reset()
+                    raise IOError(f"Hash mismatch after delta download, got '{got}', expected '{target.hash}'")
+
+            with self.own_writes(target.path):
+                async with async_timeout.timeout(timeout):
+                    dl_task = asyncio.create_task(fetch())
+                    await asyncio.wait([dl_task, asyncio.create_task(self.exit_trigger.wait())],
+                                       return_when=asyncio.FIRST_COMPLETED)
             if not dl_task.done():
                 raise asyncio.CancelledError()
 
             dl_task.result()  # raises exception if one happened inside the task
+            done = True
 
+            # Chunk was hashed while downloading, so no need to rescan it
             self.local_batch.add(chunks=(target,))
             await self.server_send_queue.put({
                 'action': 'add_hashes',
                 'hashes': (chunk_hash,)})
 
-            # Rescan when it looks like we've got everything
+            # Fix up local files (copies, timestamps) when it looks like we've got everything
             if self.local_batch.have_all_hashes(self.remote_batch.all_hashes()):
-                self.status_func(log_info=f'All chunks apparently complete. Rescanning to make sure.')
-                self.full_rescan_trigger.set()
+                self.status_func(log_info=f'All chunks downloaded. Finishing up local files.')
+                self.fixups_trigger.set()
 
         except asyncio.TimeoutError as e:
             self.status_func(log_info=f'Timeout. GET {url} took over {float("%.2g" % timeout)}s.')
@@ -241,10 +336,34 @@ class PeerNode:
         finally:
             if dl_task:
                 dl_task.cancel()
+            if not done and hasher.verified_size > 0:
+                self.partial_downloads[chunk_hash] = (target, hasher.verified_size)
             self.active_downloads.pop(chunk_hash)
             await self.send_transfer_report()
 
 
+    @staticmethod
+    def _batch_from_msg(msg) -> SyncBatch:
+        """Get sync batch from a server message, whether it was sent as JSON or as a binary manifest."""
+        if msg.get('manifest') is not None:
+            return manifest.decode_batch(msg['manifest'])
+        return SyncBatch.from_dict(msg.get('data'))
+
+    def _check_batch_format(self, batch: SyncBatch) -> bool:
+        """Make sure we can hash and chunk files like master does. If not, there's no way to sync, so exit."""
+        if batch.hash_algo in HASH_ALGOS and batch.chunking in CHUNKINGS:
+            return True
+        if batch.hash_algo not in HASH_ALGOS:
+            self.status_func(log_error=f"Master uses hash algorithm '{batch.hash_algo}', which is not available here "
+                                       f"(supported: {', '.join(sorted(HASH_ALGOS))}). Install the package that "
+                                       f"provides it, or use another algorithm on master.", popup=True)
+        else:
+            self.status_func(log_error=f"Master uses chunking mode '{batch.chunking}', which is not supported here "
+                                       f"(supported: {', '.join(CHUNKINGS)}).", popup=True)
+        self.status_func(log_info='Exiting because of fatal error.')
+        self.exit_trigger.set()
+        return False
+
     async def process_server_msg(self, msg, http_session):
         """
         Ingest messages from websocket connection with master.
@@ -252,7 +371,8 @@ class PeerNode:
         try:
             async def error(txt):
                 self.status_func(log_error=f'Error handling server message: {txt}, orig msg="{str(msg)}"')
-                await self.server_send_queue.put({'action': 'error', 'orig_msg': msg, 'message': txt})
+                orig_msg = {k: v for k, v in msg.items() if k != 'manifest'}  # (binary data isn't JSON serializable)
+                await self.server_send_queue.put({'action': 'error', 'orig_msg': orig_msg, 'message': txt})
 
             action = msg.get('action')
 
@@ -269,15 +389,30 @@ class PeerNode:
 
             elif action == 'initial_batch':
                 self.status_func(log_info=f'Initial sync batch received.')
-                new_batch = SyncBatch.from_dict(msg.get('data'))
+                new_batch = self._batch_from_msg(msg)
                 self.status_func(log_info=f'Chunks size is {int(new_batch.chunk_size/1024/1024+0.5)} MB '
-                                          f'({new_batch.chunk_size} bytes).')
+                                          f'({new_batch.chunk_size} bytes), hash algorithm {new_batch.hash_algo}, '
+                                          f'{new_batch.chunking} chunking.')
+                if not self._check_batch_format(new_batch):
+                    return
                 self.remote_batch = new_batch
+                self.remote_batch_version = msg.get('version')
+                self.remote_batch_complete = msg.get('complete', True)
                 # self.status_func(log_debug='Initial sync batch:' + str(self.remote_batch))
                 self.full_rescan_trigger.set()
 
             elif action == 'new_batch':
-                new_batch = SyncBatch.from_dict(msg.get('data'))
+                self.remote_batch_version = msg.get('version')
+                was_complete, self.remote_batch_complete = self.remote_batch_complete, msg.get('complete', True)
+                if msg.get('digest') and msg.get('digest') == self.remote_batch.digest():
+                    if self.remote_batch_complete and not was_complete:
+                        self.status_func(log_info=f"Master finished scanning, sync batch is now complete.")
+                        return await self.local_file_fixups()
+                    self.status_func(log_info=f"Got sync batch update from master, but digest is unchanged. Ignoring.")
+                    return
+                new_batch = self._batch_from_msg(msg)
+                if not self._check_batch_format(new_batch):
+                    return
                 if new_batch != self.remote_batch:
                     self.status_func(log_info=f'New sync batch received.')
                     self.remote_batch = new_batch
@@ -285,6 +420,25 @@ class PeerNode:
                 else:
                     self.status_func(log_info=f"Got sync batch update from master, but nothing has changed. Ignoring.")
 
+            elif action == 'batch_delta':
+                from_version, version, digest = msg.get('from_version'), msg.get('version'), msg.get('digest')
+                if None in (from_version, version, digest, msg.get('data')):
+                    return await error('Bad batch delta from server')
+                if self.remote_batch_version is None or from_version != self.remote_batch_version:
+                    self.status_func(log_info=f'Missed sync batch version(s) ({self.remote_batch_version} -> '
+                                              f'{from_version}). Requesting full batch.')
+                    self.remote_batch_version = None
+                    return await self.server_send_queue.put({'action': 'get_batch'})
+                self.remote_batch.apply_delta(msg['data'])
+                if self.remote_batch.digest() != digest:
+                    self.status_func(log_error=f'Sync batch delta resulted in a wrong digest. Requesting full batch.')
+                    self.remote_batch_version = None
+                    return await self.server_send_queue.put({'action': 'get_batch'})
+                self.status_func(log_info=f'New sync batch received (as a delta, version {version}).')
+                self.remote_batch_version = version
+                self.remote_batch_complete = msg.get('complete', True)
+                await self.local_file_fixups()
+
             elif action == 'error':
                 self.status_func(log_error='Error from server:' + str(json.dumps(msg, indent=2)))
             elif action == 'fatal':
@@ -335,11 +489,14 @@ class PeerNode:
                                         log_error=f'Connection to master closed with error: %s' % ws.exception())
                                 elif msg.type == WSMsgType.TEXT:
                                     await self.process_server_msg(msg.json(), session)
+                                elif msg.type == WSMsgType.BINARY:
+                                    await self.process_server_msg(manifest.unpack_message(msg.data), session)
                             except Exception as e:
-                                self.status_func(log_error=f'Error ("{str(e)}") handling server msg: {msg.data}'
+                                orig_msg = msg.data if msg.type != WSMsgType.BINARY else '<binary message>'
+                                self.status_func(log_error=f'Error ("{str(e)}") handling server msg: {orig_msg}'
                                                             'traceback: ' + traceback.format_exc())
                                 await self.server_send_queue.put({
-                                    'action': 'error', 'orig_msg': msg.data, 'message': 'Exception: ' + str(e)})
+                                    'action': 'error', 'orig_msg': orig_msg, 'message': 'Exception: ' + str(e)})
                             finally:
                                 if self.exit_trigger.is_set():
                                     await ws.close()
@@ -358,6 +515,8 @@ class PeerNode:
             finally:
                 # Return into initial state for new connection
                 self.remote_batch = SyncBatch()
+                self.remote_batch_version = None
+                self.remote_batch_complete = True
                 self.next_periodical_rescan = time.time()
                 self.joined_swarm = False
 
@@ -369,28 +528,63 @@ class PeerNode:
             self.status_func(progress=total_progress,
                              cur_status=f'Hashing ({cur_filename} / at {int(file_progress*100+0.5)}%)')
 
-        while not self.exit_trigger.is_set():
-            # TODO: integrate with inotify (watchdog package) to avoid frequent rescans when up-to-date.
-            #  (on any event, schedule next scan 10s in the future to avoid trashing when modification is on-going)
+        def __device_stats_func(dev, n, t):
+            self.status_func(log_debug=f'Hashed {n / 1024 / 1024:.0f} MB from device {dev} at '
+                                       f'{n / 1024 / 1024 / max(t, 1e-3):.0f} MB/s')
+
+        if self.watch_dir:
+            self.watcher = make_dir_watcher(str(self.file_io.basedir), self.local_rescan_interval, self.status_func)
+        full_interval = self.full_rescan_interval if self.watcher else self.local_rescan_interval
 
+        while not self.exit_trigger.is_set():
             if self.remote_batch.chunk_size > 0:
                 # Time for a periodical rescan after sync is complete?
                 full_periodical_now = time.time() >= self.next_periodical_rescan and \
                                       self.local_batch == self.remote_batch
 
-                # Wait until server has give us a remote batch (cannot chunk files without knowing chunk size)
-                if self.full_rescan_trigger.is_set() or full_periodical_now:
-                    self.next_periodical_rescan = time.time() + self.local_rescan_interval
-                    self.full_rescan_trigger.clear()
+                # Local changes reported by dir watcher? (None = watcher lost track, do a full rescan)
+                dirty_paths = set()
+                if self.watcher and self.watcher.changes_ready.is_set():
+                    dirty_paths = self.watcher.pop_changes()
+                    if dirty_paths is None:
+                        self.full_rescan_trigger.set()
+                full_now = self.full_rescan_trigger.is_set() or full_periodical_now
+
+                # Chunks we've written ourselves (dir watcher ignores those). Rehash only them, unless
+                # the file was also changed by someone else.
+                dirty_chunks = {}
+                if self.written_rescan_trigger.is_set() or full_now or dirty_paths:
+                    self.written_rescan_trigger.clear()
+                    dirty_chunks, self.written_chunks = self.written_chunks, {}
+                    if dirty_paths is None:
+                        dirty_chunks = {}  # (watcher lost track, files may have other changes too)
+                    else:
+                        for p in dirty_paths:
+                            dirty_chunks.pop(p, None)
+                        dirty_paths |= set(dirty_chunks.keys())
 
-                    self.status_func(log_debug='Rescanning local files.')
+                # Wait until server has give us a remote batch (cannot chunk files without knowing chunk size)
+                if full_now or dirty_paths:
+                    if full_now:
+                        dirty_paths = None
+                        dirty_chunks = {}  # (verify whole files, not just what we wrote)
+                        self.next_periodical_rescan = time.time() + full_interval
+                        self.full_rescan_trigger.clear()
+                        self.status_func(log_debug='Rescanning local files.')
+                    else:
+                        self.status_func(log_debug=f'Rescanning {len(dirty_paths)} locally changed path(s).')
 
                     try:
                         def scandir_blocking():
                             return asyncio.run(scan_dir(
                                 self.file_io, max_chunk_size=self.remote_batch.chunk_size,
                                 max_sub_chunk_size=self.remote_batch.sub_chunk_size,
-                                old_batch=self.local_batch, progress_func=__hash_dir_progress_func, test_compress=False))
+                                old_batch=self.local_batch, progress_func=__hash_dir_progress_func, test_compress=False,
+                                hash_cache=self.hash_cache, dirty_paths=dirty_paths,
+                                hash_backend=self.hash_backend, hash_workers=self.hash_workers,
+                                hash_algo=self.remote_batch.hash_algo, chunking=self.remote_batch.chunking,
+                                layout_batch=self.remote_batch, dirty_chunks=dirty_chunks,
+                                device_stats_func=__device_stats_func, cache_mode=self.scan_cache))
                         loop = asyncio.get_event_loop()
                         new_local_batch, errors = await loop.run_in_executor(None, scandir_blocking)
                         for i, e in enumerate(errors):
@@ -412,7 +606,7 @@ class PeerNode:
                                                                   'app': Defaults.APP_VERSION})
                                 await self.server_send_queue.put({
                                     'action': 'join_swarm',
-                                    'hashes': tuple(self.local_batch.all_hashes()),
+                                    'hashes': tuple(h for h in self.local_batch.all_hashes() if not is_zero_hash(h)),
                                     'dl_url': self.fileserver.base_url + '/blob/{hash}',
                                     'nick': self.fileserver.hostname,
                                     'concurrent_transfers': concurrent_transfer_limit
@@ -420,16 +614,27 @@ class PeerNode:
                             else:
                                 await self.server_send_queue.put({
                                     'action': 'set_hashes',
-                                    'hashes': list(self.local_batch.all_hashes())})
+                                    'hashes': [h for h in self.local_batch.all_hashes() if not is_zero_hash(h)]})
 
                     except FileNotFoundError as e:
                         self.status_func(log_info=f'NOTE: Dir scan failed, trying again in a bit: {e}')
+                        for p, chunks in dirty_chunks.items():
+                            self.written_chunks.setdefault(p, set()).update(chunks)
+
+                elif self.fixups_trigger.is_set():
+                    self.fixups_trigger.clear()
+                    await self.local_file_fixups()
 
             with suppress(asyncio.TimeoutError):
                 await asyncio.wait(
-                    (self.full_rescan_trigger.wait(), self.exit_trigger.wait()),
+                    (self.full_rescan_trigger.wait(), self.written_rescan_trigger.wait(), self.fixups_trigger.wait(),
+                     self.exit_trigger.wait()) +
+                    ((self.watcher.changes_ready.wait(),) if self.watcher else ()),
                     timeout=4, return_when=asyncio.FIRST_COMPLETED)
 
+        if self.watcher:
+            self.watcher.close()
+
 
     async def run(self, port: int, server_url: str, concurrent_transfer_limit: int, max_workers: int):
         """Run all async loops."""
@@ -470,9 +675,16 @@ async def run_file_client(base_dir: str, server_url: str, status_func=None,
                           dl_limit: float = Defaults.BANDWIDTH_LIMIT_MBITS_PER_SEC,
                           ul_limit: float = Defaults.BANDWIDTH_LIMIT_MBITS_PER_SEC,
                           max_workers: int = Defaults.MAX_WORKERS,
-                          concurrent_transfer_limit: int = Defaults.CONCURRENT_TRANSFERS_PEER):
+                          concurrent_transfer_limit: int = Defaults.CONCURRENT_TRANSFERS_PEER,
+                          hash_cache_path: Optional[str] = None,
+                          watch_dir: bool = True,
+                          full_rescan_interval: float = Defaults.FULL_RESCAN_INTERVAL_WATCHED,
+                          hash_backend: str = 'thread', hash_workers: Optional[int] = None,
+                          scan_cache: str = Defaults.SCAN_CACHE_MODE):
     pn = PeerNode(basedir=base_dir, status_func=status_func, file_rescan_interval=rescan_interval,
-                  dl_limit=dl_limit, ul_limit=ul_limit)
+                  dl_limit=dl_limit, ul_limit=ul_limit, hash_cache_path=hash_cache_path,
+                  watch_dir=watch_dir, full_rescan_interval=full_rescan_interval,
+                  hash_backend=hash_backend, hash_workers=hash_workers, scan_cache=scan_cache)
     await pn.run(port, server_url, concurrent_transfer_limit, max_workers)
 
 
@@ -485,6 +697,9 @@ async def async_main():
         rescan_interval=args.rescan_interval,
         dl_limit=args.dl_limit, ul_limit=args.ul_limit, concurrent_transfer_limit=args.ct,
         max_workers=args.max_workers,
+        hash_backend=args.hash_backend, hash_workers=(args.hash_workers or None), scan_cache=args.scan_cache,
+        hash_cache_path=(None if args.no_hash_cache else args.hash_cache),
+        watch_dir=(not args.no_watch), full_rescan_interval=args.full_rescan_interval,
         status_func=status_func)
 
 def main():
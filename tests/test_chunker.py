@@ -0,0 +1,607 @@
+import pytest, asyncio, os, json, itertools, hashlib, pickle
+from contextlib import suppress
+from pathlib import Path
+from lanscatter import chunker, fileio, hashcache
+from lanscatter.common import Defaults
+
+CHUNK_SIZE = 5000
+SUB_CHUNK_SIZE = 1000
+
+
+def _write(p: Path, data: bytes):
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(data)
+
+
+def _scan(fio, old_batch=None, hash_cache=None, hashed_files=None):
+    def progress(cur_filename, file_progress, total_progress):
+        if hashed_files is not None:
+            hashed_files.add(cur_filename)
+    return asyncio.run(chunker.scan_dir(
+        fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=old_batch, progress_func=progress,
+        test_compress=True, hash_cache=hash_cache))
+
+
+def test_hash_cache(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    _write(sync_dir / 'a.bin', os.urandom(CHUNK_SIZE * 2 + 123))
+    _write(sync_dir / 'sub' / 'b.bin', b'\0' * (CHUNK_SIZE * 3))
+    _write(sync_dir / 'empty.bin', b'')
+    fio = fileio.FileIO(sync_dir)
+    cache_file = str(tmp_path / 'cache' / 'hashes.sqlite')
+
+    cache = hashcache.HashCache(cache_file)
+    hashed = set()
+    batch1, errors = _scan(fio, hash_cache=cache, hashed_files=hashed)
+    assert not errors
+    assert hashed == {'a.bin', 'sub/b.bin', 'empty.bin'}
+    cache.close()
+
+    # "Restart": no old batch, but the cache should make rehashing unnecessary
+    cache = hashcache.HashCache(cache_file)
+    hashed = set()
+    batch2, errors = _scan(fio, hash_cache=cache, hashed_files=hashed)
+    assert not errors
+    assert not hashed
+    assert batch1 == batch2
+
+    # Modified file must be rehashed, others not
+    _write(sync_dir / 'a.bin', os.urandom(CHUNK_SIZE + 1))
+    hashed = set()
+    batch3, errors = _scan(fio, hash_cache=cache, hashed_files=hashed)
+    assert hashed == {'a.bin'}
+    assert batch3 != batch2
+    assert batch3 == _scan(fio)[0]
+
+    # Different chunk geometry must not use cached hashes
+    assert cache.lookup('sub/b.bin', os.stat(str(sync_dir / 'sub' / 'b.bin')),
+                        CHUNK_SIZE * 2, SUB_CHUNK_SIZE, True) is None
+    b_stat = os.stat(str(sync_dir / 'sub' / 'b.bin'))
+    assert cache.contains('sub/b.bin', b_stat, CHUNK_SIZE, SUB_CHUNK_SIZE, True)
+    assert not cache.contains('sub/b.bin', b_stat, CHUNK_SIZE * 2, SUB_CHUNK_SIZE, True)
+    cache.close()
+    cache = hashcache.HashCache(cache_file)  # (not remembered in memory, must find it in db)
+    assert cache.contains('sub/b.bin', b_stat, CHUNK_SIZE, SUB_CHUNK_SIZE, False)
+    assert not cache.contains('nope.bin', b_stat, CHUNK_SIZE, SUB_CHUNK_SIZE, False)
+    cache.close()
+
+    # Corrupted cache file is discarded instead of crashing
+    for suffix in ('-wal', '-shm'):
+        with suppress(FileNotFoundError):
+            os.remove(cache_file + suffix)
+    Path(cache_file).write_bytes(b'garbage' * 1000)
+    cache = hashcache.HashCache(cache_file)
+    hashed = set()
+    assert _scan(fio, hash_cache=cache, hashed_files=hashed)[0] == batch3
+    assert hashed == {'a.bin', 'sub/b.bin', 'empty.bin'}
+    cache.close()
+
+
+
+def _chunk(path, pos, h, size=CHUNK_SIZE, cmpratio=1.0):
+    return chunker.FileChunk(path=path, pos=pos, size=size, cmpratio=cmpratio, hash=h)
+
+
+def test_records():
+    c = _chunk('a', 0, 'h1')
+    assert c == _chunk('a', 0, 'h1') and hash(c) == hash(_chunk('a', 0, 'h1'))
+    assert c != _chunk('a', 0, 'h2') and c != chunker.FileAttribs(path='a', size=0, mtime=0, chain_hash=None)
+    assert chunker.FileChunk(**c.to_dict()) == c
+    assert pickle.loads(pickle.dumps(c)) == c
+    assert repr(c) == "FileChunk{'cmpratio': 1.0, 'hash': 'h1', 'path': 'a', 'pos': 0, 'size': 5000}"
+    c.hash = 'h2'  # (resets cached hash)
+    assert c == _chunk('a', 0, 'h2') and hash(c) == hash(_chunk('a', 0, 'h2'))
+    with pytest.raises(TypeError):
+        chunker.FileChunk(path='a', pos=0, size=1, cmpratio=1.0, hash='h1', extra=1)
+    with pytest.raises(TypeError):
+        chunker.FileChunk(path='a', pos=0, size=1, cmpratio=1.0)
+
+
+def test_batch_indexes():
+    b = chunker.SyncBatch(CHUNK_SIZE, SUB_CHUNK_SIZE)
+    b.add(chunks=[_chunk('a', CHUNK_SIZE, 'h2'), _chunk('a', 0, 'h1'), _chunk('b', 0, 'h1'), _chunk('c', 0, 'h3')])
+    assert [c.pos for c in b.chunks_of('a')] == [0, CHUNK_SIZE]
+    assert b.files['a'].size == CHUNK_SIZE * 2
+    assert b.files['a'].chain_hash == chunker.calc_chain_hash(c for c in b.chunks if c.path == 'a')
+    assert b.first_chunk_with('h1').hash == 'h1'
+    assert {c.path for c in b.chunks_with('h1')} == {'a', 'b'}
+    assert b.first_chunk_with('nonexisting') is None
+    assert b.all_hashes() == {'h1', 'h2', 'h3'}
+
+    b.discard(paths=['a'])
+    assert b.chunks_of('a') == []
+    assert {c.path for c in b.chunks_with('h1')} == {'b'}
+    assert b.first_chunk_with('h2') is None
+
+    b.discard(chunks=[_chunk('b', 0, 'h1')])
+    assert b.first_chunk_with('h1') is None
+    assert b.files['b'].chain_hash is None
+    assert b.all_hashes() == {'h3'}
+
+    other = chunker.SyncBatch(CHUNK_SIZE, SUB_CHUNK_SIZE)
+    other.add(chunks=[_chunk('x', 0, 'h3', cmpratio=0.5)])
+    b.copy_chunk_compress_ratios_from(other)
+    assert b.first_chunk_with('h3').cmpratio == 0.5
+    assert b.chunks_of('c')[0].cmpratio == 0.5
+    b.sanity_checks()
+
+
+def test_batch_digest():
+    def make():
+        b = chunker.SyncBatch(CHUNK_SIZE, SUB_CHUNK_SIZE)
+        b.add(files=[chunker.FileAttribs(path='d', size=-1, mtime=123, chain_hash=None)],
+              chunks=[_chunk('d/a', 0, 'h1'), _chunk('d/a', CHUNK_SIZE, 'h2'), _chunk('b', 0, 'h3')])
+        return b
+    b1, b2 = make(), make()
+    assert b1 == b2 and b1.digest() == b2.digest()
+    assert chunker.SyncBatch.from_dict(b1.to_dict()) == b1
+
+    b2.set_mtime('d', 124)
+    assert b1 != b2
+    b2.set_mtime('d', 123)
+    assert b1 == b2
+
+    b2.discard(chunks=[_chunk('d/a', CHUNK_SIZE, 'h2')])
+    assert b1 != b2
+    b2.add(chunks=[_chunk('d/a', CHUNK_SIZE, 'h2')])
+    assert b1 == b2
+
+    b2.copy_chunk_compress_ratios_from(chunker.SyncBatch())
+    assert b1 != b2  # cmpratio is part of content
+    assert b1 != chunker.SyncBatch(CHUNK_SIZE * 2, SUB_CHUNK_SIZE)
+
+
+def test_batch_diff():
+    here = chunker.SyncBatch(CHUNK_SIZE, SUB_CHUNK_SIZE)
+    here.add(files=[chunker.FileAttribs(path='d', size=-1, mtime=123, chain_hash=None)],
+             chunks=[_chunk('d/a', 0, 'h1'), _chunk('d/a', CHUNK_SIZE, 'h2'), _chunk('b', 0, 'h3'), _chunk('c', 0, 'h4')])
+    there = chunker.SyncBatch.from_dict(here.to_dict())
+    assert not list(here.differing_paths(there))
+    there.discard(paths=['c'])
+    there.discard(chunks=[_chunk('d/a', CHUNK_SIZE, 'h2')])
+    there.add(chunks=[_chunk('d/a', CHUNK_SIZE, 'h5'), _chunk('d/a', CHUNK_SIZE * 2, 'h6'), _chunk('e', 0, 'h1')])
+    there.set_mtime('d', 124)
+    assert set(here.differing_paths(there)) == {'c', 'd', 'd/a', 'e'}
+
+    # Same results as plain set operations
+    cd = here.chunk_diff(there)
+    assert cd.there_only == there.chunks - here.chunks
+    assert cd.here_only == here.chunks - there.chunks
+    pd = here.file_tree_diff(there)
+    assert pd.there_only == {'e'} and pd.here_only == {'c'}
+    assert {f.path for f in pd.with_different_attribs} == {'d', 'd/a'}
+    assert all(f is here.files[f.path] for f in pd.with_different_attribs)
+
+
+def test_merge_chunk_diff():
+    a = [_chunk('f', 0, 'h1'), _chunk('f', 0, 'h2', size=10), _chunk('f', 0, 'h3'),
+         _chunk('f', CHUNK_SIZE, 'h4'), _chunk('f', CHUNK_SIZE * 2, 'h5')]
+    b = [_chunk('f', 0, 'h3'), _chunk('f', 0, 'h1', size=10), _chunk('f', 0, 'h2', size=10), _chunk('f', 0, 'h6'),
+         _chunk('f', CHUNK_SIZE, 'h4', cmpratio=0.5), _chunk('f', CHUNK_SIZE * 3, 'h5')]
+    for x, y in itertools.permutations([a, b, a[:1], b[1:3], []], 2):
+        x_only, y_only = chunker._merge_chunk_diff(x, y)
+        assert set(x_only) == set(x) - set(y) and len(x_only) == len(set(x_only))
+        assert set(y_only) == set(y) - set(x) and len(y_only) == len(set(y_only))
+        assert [c.pos for c in x_only] == sorted(c.pos for c in x_only)
+
+
+def test_batch_delta():
+    old = chunker.SyncBatch(CHUNK_SIZE, SUB_CHUNK_SIZE)
+    old.add(files=[chunker.FileAttribs(path='d', size=-1, mtime=123, chain_hash=None)],
+            chunks=[_chunk('d/a', 0, 'h1'), _chunk('d/a', CHUNK_SIZE, 'h2'), _chunk('b', 0, 'h3'), _chunk('c', 0, 'h4')])
+    new = chunker.SyncBatch.from_dict(old.to_dict())
+    assert old.delta_to(new) == {'files': [], 'removed_files': [], 'chunks': [], 'removed_chunks': []}
+
+    new.discard(paths=['c'])
+    new.discard(chunks=[_chunk('d/a', CHUNK_SIZE, 'h2')])
+    new.add(chunks=[_chunk('d/a', 0, 'h1'), _chunk('d/a', CHUNK_SIZE, 'h5', size=10), _chunk('e', 0, 'h1')])
+    new.set_mtime('d', 124)
+    delta = old.delta_to(new)
+    assert delta['removed_files'] == ['c']
+    assert {c['hash'] for c in delta['chunks']} == {'h5', 'h1'}
+    assert [c['hash'] for c in delta['removed_chunks']] == ['h2']
+    assert 'b' not in {f['path'] for f in delta['files']}
+
+    patched = chunker.SyncBatch.from_dict(old.to_dict())
+    patched.apply_delta(json.loads(json.dumps(delta)))
+    assert patched == new
+    assert patched.first_chunk_with('h4') is None
+    patched.sanity_checks()
+
+    assert old.delta_to(chunker.SyncBatch(CHUNK_SIZE * 2, SUB_CHUNK_SIZE)) is None
+
+def test_targeted_rescan(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    _write(sync_dir / 'a.bin', os.urandom(CHUNK_SIZE + 1))
+    _write(sync_dir / 'd' / 'b.bin', os.urandom(100))
+    _write(sync_dir / 'd' / 'e' / 'c.bin', os.urandom(100))
+    fio = fileio.FileIO(sync_dir)
+    batch1, __ = _scan(fio)
+
+    # Changes outside dirty paths are not noticed, changes inside them are
+    _write(sync_dir / 'a.bin', os.urandom(10))
+    _write(sync_dir / 'd' / 'e' / 'new.bin', os.urandom(10))
+    (sync_dir / 'd' / 'b.bin').unlink()
+    hashed = set()
+    batch2, errors = asyncio.run(chunker.scan_dir(
+        fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=batch1, test_compress=True,
+        progress_func=lambda cur_filename, **kw: hashed.add(cur_filename), dirty_paths=['d/e', 'd/b.bin']))
+    assert not errors
+    assert hashed == {'d/e/new.bin'}
+    assert batch2.files['a.bin'] == batch1.files['a.bin']
+    assert 'd/b.bin' not in batch2.files
+    assert {'d', 'd/e', 'd/e/c.bin', 'd/e/new.bin'} <= set(batch2.files.keys())
+
+    # Full rescan catches up with the rest
+    batch3, __ = _scan(fio, old_batch=batch2)
+    assert batch3 != batch2 and batch3 == _scan(fio)[0]
+
+
+def test_process_hash_backend(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    _write(sync_dir / 'a.bin', os.urandom(CHUNK_SIZE * 2 + 123))
+    _write(sync_dir / 'sub' / 'b.bin', b'\0' * (CHUNK_SIZE * 3))
+    _write(sync_dir / 'empty.bin', b'')
+    fio = fileio.FileIO(sync_dir)
+    for backend, mode in itertools.product(('process', 'thread'), chunker.SCAN_CACHE_MODES):
+        hashed, dev_stats = set(), []
+        batch, errors = asyncio.run(chunker.scan_dir(
+            fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=None, test_compress=True,
+            progress_func=lambda cur_filename, **kw: hashed.add(cur_filename), hash_backend=backend, hash_workers=2,
+            device_stats_func=lambda *args: dev_stats.append(args), cache_mode=mode))
+        assert not errors
+        assert hashed == {'a.bin', 'sub/b.bin', 'empty.bin'}
+        assert batch == _scan(fio)[0]
+        assert [(n, t >= 0) for (dev, n, t) in dev_stats] == [(CHUNK_SIZE * 5 + 123, True)]  # (all on one device)
+    assert batch.chunks_of('sub/b.bin')[0].cmpratio < 0.1
+    chunker._shutdown_process_pools()
+    assert not chunker._process_pools
+
+    with pytest.raises(ValueError):
+        asyncio.run(chunker.scan_dir(fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=None, test_compress=True,
+                                     progress_func=lambda **kw: None, hash_backend='gpu'))
+
+
+def test_hash_file_range(tmp_path):
+    data = os.urandom(chunker.HASH_READ_STEP * 2) + b'\0' * (chunker.HASH_READ_STEP + 123)
+    (tmp_path / 'f.bin').write_bytes(data)
+    for pos, size in ((0, len(data)), (1000, chunker.HASH_READ_STEP + 1), (len(data) - 10, 100)):
+        for test_compress, mode in itertools.product((True, False), chunker.SCAN_CACHE_MODES):
+            assert chunker.hash_file_range(str(tmp_path / 'f.bin'), pos, size, test_compress, cache_mode=mode) == \
+                   chunker.hash_and_test_compress(data[pos:pos + size], test_compress)
+
+
+def test_estimate_compressed_size():
+    import lz4.frame, random
+    n = chunker.HASH_READ_STEP
+    assert chunker.estimate_compressed_size(os.urandom(n)) == n
+    assert chunker.estimate_compressed_size(b'\0' * n) < n * 0.01
+    zeros_zip = b'PK\x03\x04' + b'\0' * n
+    assert chunker.estimate_compressed_size(zeros_zip, file_start=True) == len(zeros_zip)
+    assert chunker.estimate_compressed_size(zeros_zip) < n * 0.01
+
+    rnd = random.Random(1234)
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for __ in range(rnd.randint(2, 10))) for __ in range(5000)]
+    text = b' '.join(rnd.choice(words) for __ in range(n // 5))[:n]
+    exact = len(lz4.frame.compress(text)) / len(text)
+    assert abs(chunker.estimate_compressed_size(text) / len(text) - exact) < 0.1
+
+
+def test_hash_algos(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    _write(sync_dir / 'a.bin', os.urandom(CHUNK_SIZE * 2 + 123))
+    fio = fileio.FileIO(sync_dir)
+    cache = hashcache.HashCache(str(tmp_path / 'hashes.sqlite'))
+
+    def scan(algo, old_batch=None, backend='thread'):
+        hashed = set()
+        res, errors = asyncio.run(chunker.scan_dir(
+            fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=old_batch, test_compress=False, hash_cache=cache,
+            progress_func=lambda cur_filename, **kw: hashed.add(cur_filename), hash_algo=algo, hash_backend=backend))
+        assert not errors
+        return res, hashed
+
+    blake, __ = scan('blake2b')
+    sha, hashed = scan('sha256', old_batch=blake)
+    assert hashed == {'a.bin'}  # Neither old batch nor hash cache is usable with a different algorithm
+    assert sha.hash_algo == 'sha256' and sha != blake
+    assert {len(c.hash) for c in sha.chunks} == {32}
+    assert sha.files['a.bin'].chain_hash == chunker.calc_chain_hash(sha.chunks_of('a.bin'), 'sha256')
+    assert scan('sha256', backend='process')[0] == sha
+    assert chunker.SyncBatch.from_dict(sha.to_dict()) == sha
+    assert blake.delta_to(sha) is None
+
+    # Cache only has hashes for the latest algorithm
+    assert scan('sha256')[1] == set()
+    assert scan('blake2b')[1] == {'a.bin'}
+
+    with pytest.raises(ValueError):
+        scan('nonexisting')
+    cache.close()
+
+
+def test_partial_batches(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    for i in range(5):
+        _write(sync_dir / 'd' / f'{i}.bin', os.urandom(CHUNK_SIZE + i))
+    fio = fileio.FileIO(sync_dir)
+    partials = []
+    final, errors = asyncio.run(chunker.scan_dir(
+        fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=None, test_compress=False, progress_func=lambda *a, **kw: None,
+        partial_batch_func=partials.append, partial_batch_interval=0))
+    assert not errors
+    assert [len([f for f in p.files.values() if not f.is_dir]) for p in partials] == [1, 2, 3, 4, 5]
+    for p in partials:
+        assert 'd' in p.files
+        assert p.chunks <= final.chunks
+        assert all(final.files[f.path] == f for f in p.files.values())
+    assert partials[-1] == final
+
+
+def test_append_rehash(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    _write(sync_dir / 'log.bin', os.urandom(CHUNK_SIZE * 3 + 123))
+    fio = fileio.FileIO(sync_dir)
+
+    def scan(old_batch, verify_interval):
+        progress = []
+        res = asyncio.run(chunker.scan_dir(
+            fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=old_batch, test_compress=True,
+            progress_func=lambda cur_filename, file_progress, **kw: progress.append(file_progress),
+            append_verify_interval=verify_interval))
+        return res, progress
+
+    (batch1, errors), __ = scan(None, 60)
+    assert not errors and 'log.bin' in batch1.hashed_at
+
+    # Edit beginning of file and append to it. Only the tail gets hashed, so edit goes unnoticed...
+    with open(sync_dir / 'log.bin', 'r+b') as f:
+        f.write(b'edit')
+        f.seek(0, os.SEEK_END)
+        f.write(os.urandom(CHUNK_SIZE))
+    os.utime(sync_dir / 'log.bin', (batch1.files['log.bin'].mtime + 10,) * 2)
+    (batch2, errors), progress = scan(batch1, 60)
+    assert not errors
+    assert min(progress) >= (CHUNK_SIZE * 3) / (CHUNK_SIZE * 4 + 123)
+    assert batch2.chunks_of('log.bin')[:3] == batch1.chunks_of('log.bin')[:3]
+    assert batch2.hashed_at['log.bin'] == batch1.hashed_at['log.bin']
+    full = _scan(fio)[0]
+    assert batch2.chunks_of('log.bin')[3:] == full.chunks_of('log.bin')[3:]
+    assert batch2 != full
+
+    # ...until prefix is verified again
+    with open(sync_dir / 'log.bin', 'ab') as f:
+        f.write(b'more')
+    (batch3, errors), progress = scan(batch2, 0)
+    assert not errors and min(progress) == 0
+    assert batch3 == _scan(fio)[0]
+
+    # Replaced files are always fully rehashed
+    _write(sync_dir / 'new.bin', os.urandom(CHUNK_SIZE * 5))
+    os.replace(sync_dir / 'new.bin', sync_dir / 'log.bin')
+    (batch4, errors), progress = scan(batch3, 60)
+    assert not errors and min(progress) == 0
+    assert batch4 == _scan(fio)[0]
+
+
+def test_cdc_chunking(tmp_path, monkeypatch):
+    sync_dir = tmp_path / 'sync'
+    data = os.urandom(CHUNK_SIZE * 20)
+    _write(sync_dir / 'a.bin', data)
+    fio = fileio.FileIO(sync_dir)
+
+    def scan(chunking, layout_batch=None):
+        batch, errors = asyncio.run(chunker.scan_dir(
+            fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=None, progress_func=lambda *a, **kw: None,
+            test_compress=False, chunking=chunking, layout_batch=layout_batch))
+        assert not errors
+        return batch
+
+    batch1 = scan('cdc')
+    chunks = batch1.chunks_of('a.bin')
+    min_size, avg_size, max_size = chunker.cdc_chunk_sizes(CHUNK_SIZE)
+    assert batch1.chunking == 'cdc' and len(set(c.size for c in chunks)) > 1
+    assert all(min_size <= c.size <= max_size for c in chunks[:-1])
+    assert [c.pos for c in chunks] == [0] + list(itertools.accumulate(c.size for c in chunks[:-1]))
+
+    # Pure Python Gear hash finds the same boundaries as numpy
+    with open(sync_dir / 'a.bin', 'rb') as f:
+        ends = chunker.cdc_chunk_ends(f, 0, len(data), CHUNK_SIZE)
+        assert ends == [c.pos + c.size for c in chunks]
+        monkeypatch.setattr(chunker, 'numpy', None)
+        assert chunker.cdc_chunk_ends(f, 0, len(data), CHUNK_SIZE) == ends
+    monkeypatch.undo()
+
+    # Insertion near the beginning only changes chunks around it (unlike with fixed chunking)
+    fixed1 = scan('fixed')
+    _write(sync_dir / 'a.bin', data[:100] + b'inserted' + data[100:])
+    batch2, fixed2 = scan('cdc'), scan('fixed')
+    assert len(batch1.all_hashes() - batch2.all_hashes()) <= 2
+    assert len(fixed1.all_hashes() & fixed2.all_hashes()) == 0
+    assert batch1 != batch2 and batch1.delta_to(fixed1) is None
+
+    # Layout batch forces chunk boundaries
+    batch3 = scan('cdc', layout_batch=batch1)
+    chunks3 = batch3.chunks_of('a.bin')
+    assert [(c.pos, c.size) for c in chunks3[:-1]] == [(c.pos, c.size) for c in chunks]
+    assert chunks3[-1].pos + chunks3[-1].size == len(data) + len(b'inserted')
+
+    with pytest.raises(ValueError):
+        scan('rabin')
+
+
+def test_zero_chunks(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    data = os.urandom(CHUNK_SIZE) + bytes(CHUNK_SIZE * 2 + 10) + os.urandom(SUB_CHUNK_SIZE) + bytes(CHUNK_SIZE)
+    _write(sync_dir / 'zeros.bin', data)
+    with open(sync_dir / 'sparse.bin', 'wb') as f:  # (same contents, but with holes, if filesystem supports them)
+        f.write(data[:CHUNK_SIZE + 10])
+        f.truncate(len(data))
+        f.seek(CHUNK_SIZE * 3 + 10)
+        f.write(data[CHUNK_SIZE * 3 + 10:CHUNK_SIZE * 3 + 10 + SUB_CHUNK_SIZE])
+    fio = fileio.FileIO(sync_dir)
+    batch, errors = _scan(fio)
+    assert not errors
+
+    for fn in ('zeros.bin', 'sparse.bin'):
+        hashes = [c.hash for c in batch.chunks_of(fn)]
+        assert [chunker.is_zero_hash(h) for h in hashes] == [False, True, True, False, True]
+        assert hashes[1] == chunker.zero_chunk_hash(CHUNK_SIZE)
+    assert batch.files['zeros.bin'].chain_hash == batch.files['sparse.bin'].chain_hash
+
+    # Chunks that are only partly zeros get regular hashes, same as without the zero optimization
+    mixed = batch.chunks_of('zeros.bin')[3]
+    h = ''
+    for pos in range(mixed.pos, mixed.pos + mixed.size, SUB_CHUNK_SIZE):
+        sub = hashlib.blake2b(data[pos:min(pos + SUB_CHUNK_SIZE, mixed.pos + mixed.size)], digest_size=12).hexdigest()
+        h = chunker.HashFunc().update((h + sub).encode('utf-8')).result()
+    assert mixed.hash == h
+
+
+@pytest.mark.parametrize('chunking', chunker.CHUNKINGS)
+def test_chunk_hasher(tmp_path, chunking):
+    sync_dir = tmp_path / 'sync'
+    data = os.urandom(CHUNK_SIZE * 3) + bytes(CHUNK_SIZE * 2 + 10) + os.urandom(SUB_CHUNK_SIZE) + bytes(CHUNK_SIZE)
+    _write(sync_dir / 'a.bin', data)
+    _write(sync_dir / 'empty.bin', b'')
+    batch, errors = asyncio.run(chunker.scan_dir(
+        fileio.FileIO(sync_dir), CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=None, progress_func=lambda *a, **kw: None,
+        test_compress=False, chunking=chunking))
+    assert not errors
+
+    # Same hashes as scan_dir(), whatever pieces data arrives in
+    for c in batch.chunks:
+        chunk_data = data[c.pos:c.pos + c.size] if c.path == 'a.bin' else b''
+        for piece_size in (1, 333, SUB_CHUNK_SIZE, CHUNK_SIZE * 2):
+            hasher = chunker.ChunkHasher(SUB_CHUNK_SIZE)
+            for i in range(0, len(chunk_data), piece_size):
+                hasher.update(chunk_data[i:i + piece_size])
+            assert hasher.result() == c.hash
+    assert any(chunker.is_zero_hash(c.hash) for c in batch.chunks)
+
+
+def test_chunk_hasher_leaves():
+    data = os.urandom(SUB_CHUNK_SIZE * 3 + 10)
+    full = chunker.ChunkHasher(SUB_CHUNK_SIZE)
+    full.update(data)
+    leaves = full.leaf_hashes + [chunker.HashFunc().update(data[SUB_CHUNK_SIZE * 3:]).result()]
+    assert chunker.chain_leaf_hashes(leaves, Defaults.HASH_ALGO) == full.result()
+    assert full.verified_size == 0
+
+    # Bad leaf is noticed immediately, and everything before it is verified
+    hasher = chunker.ChunkHasher(SUB_CHUNK_SIZE, expected_leaves=leaves)
+    bad = bytearray(data)
+    bad[SUB_CHUNK_SIZE * 2 + 5] ^= 1
+    with pytest.raises(IOError):
+        hasher.update(bad)
+    assert hasher.verified_size == SUB_CHUNK_SIZE * 2
+
+    # Resume from there
+    resumed = chunker.ChunkHasher(SUB_CHUNK_SIZE, expected_leaves=leaves)
+    resumed.skip(hasher.verified_size)
+    resumed.update(data[hasher.verified_size:])
+    assert resumed.result() == full.result()
+
+
+def test_scan_chunk_leaves(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    _write(sync_dir / 'a.bin', os.urandom(CHUNK_SIZE * 2 + 123))
+    _write(sync_dir / 'zeros.bin', os.urandom(10) + bytes(CHUNK_SIZE * 2))
+    fio = fileio.FileIO(sync_dir)
+
+    def scan(old_batch=None, chunking='fixed'):
+        batch, errors = asyncio.run(chunker.scan_dir(
+            fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=old_batch, progress_func=lambda *a, **kw: None,
+            test_compress=False, chunking=chunking, chunk_leaves=True))
+        assert not errors
+        return batch
+
+    for chunking in chunker.CHUNKINGS:
+        batch = scan(chunking=chunking)
+        assert set(batch.chunk_leaves.keys()) == {h for h in batch.all_hashes() if not chunker.is_zero_hash(h)}
+        for h, leaves in batch.chunk_leaves.items():
+            assert chunker.chain_leaf_hashes(leaves, batch.hash_algo) == h
+            assert len(leaves) == -(-batch.first_chunk_with(h).size // SUB_CHUNK_SIZE)
+
+    # Unchanged and changed files after a rescan, and batch serialization
+    batch = scan()
+    _write(sync_dir / 'b.bin', os.urandom(100))
+    (sync_dir / 'a.bin').unlink()
+    batch2 = scan(old_batch=batch)
+    assert set(batch2.chunk_leaves.keys()) == {h for h in batch2.all_hashes() if not chunker.is_zero_hash(h)}
+    assert chunker.SyncBatch.from_dict(json.loads(json.dumps(batch2.to_dict()))).chunk_leaves == batch2.chunk_leaves
+    assert 'chunk_leaves' not in chunker.SyncBatch(CHUNK_SIZE, SUB_CHUNK_SIZE).to_dict()
+
+    # Deltas carry leaves of new chunks, and removing chunks forgets theirs
+    patched = chunker.SyncBatch.from_dict(batch.to_dict())
+    patched.apply_delta(json.loads(json.dumps(batch.delta_to(batch2))))
+    assert patched == batch2 and patched.chunk_leaves == batch2.chunk_leaves
+
+
+def test_leaf_recombine(tmp_path, monkeypatch):
+    monkeypatch.setattr(Defaults, 'LEAF_SIZE', SUB_CHUNK_SIZE)
+    sync_dir = tmp_path / 'sync'
+    _write(sync_dir / 'a.bin', os.urandom(CHUNK_SIZE * 2 + 123))
+    _write(sync_dir / 'zeros.bin', os.urandom(SUB_CHUNK_SIZE) + bytes(CHUNK_SIZE * 3) + os.urandom(10))
+    _write(sync_dir / 'empty.bin', b'')
+    fio = fileio.FileIO(sync_dir)
+    cache = hashcache.HashCache(str(tmp_path / 'hashes.sqlite'))
+
+    def scan(chunk_size, sub_chunk_size, old_batch=None, hash_cache=None, chunking='fixed'):
+        hashed = set()
+        batch, errors = asyncio.run(chunker.scan_dir(
+            fio, chunk_size, sub_chunk_size, old_batch=old_batch, test_compress=True, hash_cache=hash_cache,
+            progress_func=lambda cur_filename, file_progress, total_progress: hashed.add(cur_filename),
+            chunking=chunking))
+        assert not errors
+        return batch, hashed
+
+    batch1, hashed = scan(CHUNK_SIZE, SUB_CHUNK_SIZE, hash_cache=cache)
+    assert hashed and set(batch1.leaves.keys()) == {'a.bin', 'zeros.bin', 'empty.bin'}
+    assert any(chunker.is_zero_hash(c.hash) for c in batch1.chunks)
+
+    # Other chunk sizes (multiples of leaf size) are recombined from leaves of old batch, without reading files
+    for chunk_size in (CHUNK_SIZE * 2, SUB_CHUNK_SIZE * 3):
+        batch2, hashed = scan(chunk_size, SUB_CHUNK_SIZE * 2, old_batch=batch1)
+        assert not hashed
+        assert batch2 == scan(chunk_size, SUB_CHUNK_SIZE * 2)[0]
+        assert batch2 != batch1
+        assert batch2.leaves == batch1.leaves
+
+    # ...or from hash cache
+    batch3, hashed = scan(CHUNK_SIZE * 3, SUB_CHUNK_SIZE, hash_cache=cache)
+    assert not hashed
+    assert batch3 == scan(CHUNK_SIZE * 3, SUB_CHUNK_SIZE)[0]
+
+    # Content defined chunks are not made of whole leaves, so those must be hashed
+    assert scan(CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=batch1, chunking='cdc')[1]
+    cache.close()
+
+
+def test_dirty_chunks(tmp_path):
+    sync_dir = tmp_path / 'sync'
+    data = bytearray(os.urandom(CHUNK_SIZE * 4 + 10))
+    _write(sync_dir / 'a.bin', data)
+    _write(sync_dir / 'b.bin', b'b' * 100)
+    fio = fileio.FileIO(sync_dir)
+    batch1, __ = _scan(fio)
+
+    # Overwrite second and fourth chunk in place, but only report the second one as written
+    data[CHUNK_SIZE:CHUNK_SIZE * 2] = os.urandom(CHUNK_SIZE)
+    data[CHUNK_SIZE * 3:CHUNK_SIZE * 4] = os.urandom(CHUNK_SIZE)
+    (sync_dir / 'a.bin').write_bytes(data)
+    hashed = set()
+    batch2, errors = asyncio.run(chunker.scan_dir(
+        fio, CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=batch1, test_compress=True, dirty_paths=(),
+        dirty_chunks={'a.bin': [(CHUNK_SIZE, CHUNK_SIZE)]},
+        progress_func=lambda cur_filename, file_progress, total_progress: hashed.add(cur_filename)))
+    assert not errors
+    assert hashed == {'a.bin'}
+
+    old, new, full = batch1.chunks_of('a.bin'), batch2.chunks_of('a.bin'), _scan(fio)[0].chunks_of('a.bin')
+    assert [c.pos for c in new] == [c.pos for c in old]
+    assert new[1] == full[1] != old[1]  # (rehashed)
+    assert new[3] == old[3] != full[3]  # (not read, as it wasn't reported)
+    assert new[0] == old[0] and new[2] == old[2] and new[4] == old[4]
+    assert batch2.files['b.bin'] == batch1.files['b.bin']
+    assert batch2.files['a.bin'].chain_hash == chunker.calc_chain_hash(new)
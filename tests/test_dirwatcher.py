@@ -0,0 +1,85 @@
+import pytest, asyncio, platform
+from pathlib import Path
+from lanscatter import dirwatcher
+
+
+async def _collect(watcher, timeout=5):
+    res = set()
+    while True:
+        changes = await watcher.wait_changes(timeout=timeout)
+        if changes is None:
+            return None
+        if not changes:
+            return res
+        res |= changes
+        timeout = 1  # Gather any stragglers
+
+
+def _exercise(tmp_path: Path, make_watcher):
+    (tmp_path / 'existing_dir').mkdir()
+    (tmp_path / 'existing_dir' / 'old.txt').write_text('old')
+
+    async def test():
+        w = make_watcher(str(tmp_path))
+        w.start()
+        try:
+            await asyncio.sleep(0.5)
+            (tmp_path / 'existing_dir' / 'old.txt').write_text('modified')
+            (tmp_path / 'new_dir' / 'sub').mkdir(parents=True)
+            (tmp_path / 'top.txt').write_text('new')
+            with w.own_writes('mine.txt'):
+                (tmp_path / 'mine.txt').write_text('written by us')
+            changes = await _collect(w)
+            assert changes is not None
+            assert {'existing_dir/old.txt', 'new_dir', 'top.txt'} <= changes
+            assert 'mine.txt' not in changes
+
+            # Files in newly created dirs must be watched too
+            (tmp_path / 'new_dir' / 'sub' / 'deep.txt').write_text('deep')
+            assert 'new_dir/sub/deep.txt' in await _collect(w)
+
+            # ...and in trees moved in from elsewhere
+            outside = tmp_path.parent / (tmp_path.name + '_outside')
+            (outside / 'x' / 'y').mkdir(parents=True)
+            (outside / 'x').rename(tmp_path / 'moved')
+            assert 'moved' in await _collect(w)
+            (tmp_path / 'moved' / 'y' / 'z.txt').write_text('moved')
+            assert 'moved/y/z.txt' in await _collect(w)
+        finally:
+            w.close()
+    asyncio.run(test())
+
+
+@pytest.mark.skipif(platform.system() != 'Linux', reason='inotify is Linux only')
+def test_inotify_watcher(tmp_path):
+    _exercise(tmp_path, lambda d: dirwatcher.InotifyWatcher(d, debounce=0.2))
+
+
+@pytest.mark.skipif(platform.system() != 'Linux', reason='inotify is Linux only')
+def test_inotify_watcher_during_walk(tmp_path):
+    for i in range(200):
+        (tmp_path / f'd{i}' / 'sub').mkdir(parents=True)
+
+    async def test():
+        # Watches added by the background walk end up in the map
+        w = dirwatcher.InotifyWatcher(str(tmp_path), debounce=0.2)
+        w.start()
+        try:
+            await asyncio.sleep(0.5)
+            assert len(w._watches) == 401 and w._walks_running == 0
+            (tmp_path / 'd199' / 'sub' / 'late.txt').write_text('late')
+            assert 'd199/sub/late.txt' in await _collect(w)
+        finally:
+            w.close()
+
+        # Closing in the middle of a walk is fine
+        w = dirwatcher.InotifyWatcher(str(tmp_path), debounce=0.2)
+        w.start()
+        w.close()
+        await asyncio.sleep(0.5)
+        assert w._walks_running == 0 and len(w._watches) == 1
+    asyncio.run(test())
+
+
+def test_polling_watcher(tmp_path):
+    _exercise(tmp_path, lambda d: dirwatcher.PollingWatcher(d, poll_interval=0.3, debounce=0.2))
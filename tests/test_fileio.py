@@ -1,4 +1,4 @@
-import pytest, asyncio, aiohttp.web
+import pytest, asyncio, aiohttp.web, os
 from lanscatter import fileio, chunker
 from pathlib import Path
 
@@ -43,4 +43,192 @@ def test_fileio(tmp_path):
         assert fio.try_precreate_large_sparse_file('sparsefiletest.bin', 1234) == fio.resolve_and_sanitize('sparsefiletest.bin').exists()
         await fio.remove_file_and_paths('sparsefiletest.bin')
 
-    asyncio.run(aiotests())
\ No newline at end of file
+    asyncio.run(aiotests())
+
+def test_scan_tree(tmp_path):
+    for p in ('a.bin', 'd/b.bin', 'd/e/c.bin'):
+        (tmp_path / p).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / p).write_bytes(b'x' * len(p))
+    (tmp_path / 'empty_dir').mkdir()
+    (tmp_path / 'broken_link').symlink_to(tmp_path / 'nonexisting')
+    (tmp_path / 'dir_link').symlink_to(tmp_path / 'd')
+
+    fio = fileio.FileIO(Path(tmp_path))
+    files, dirs = asyncio.run(fio.scan_tree())
+    assert set(files.keys()) == {'a.bin', 'd/b.bin', 'd/e/c.bin'}
+    assert set(dirs.keys()) == {'d', 'd/e', 'empty_dir', 'dir_link'}  # Symlinked dirs are not descended into
+    assert all(files[p].st_size == len(p) for p in files)
+
+    files, dirs = asyncio.run(fio.scan_tree('d'))
+    assert set(files.keys()) == {'d/b.bin', 'd/e/c.bin'} and set(dirs.keys()) == {'d/e'}
+
+
+def test_sparse_and_zeros(tmp_path):
+    fio = fileio.FileIO(Path(tmp_path))
+    size, block = 8 * 1024 * 1024, 1024 * 1024
+    with open(tmp_path / 'sparse.bin', 'wb') as f:
+        f.truncate(size)
+        f.seek(block * 2)
+        f.write(b'\1' * block)
+
+    ranges = fio.data_ranges('sparse.bin', size)
+    if ranges is not None:  # (filesystem may not support holes)
+        assert any(s <= block * 2 < e for (s, e) in ranges)
+        assert sum(e - s for (s, e) in ranges) < size
+
+    async def zero(pos, file_size=-1):
+        await fio.write_zeros(chunker.FileChunk(path='sub/sparse.bin' if file_size >= 0 else 'sparse.bin', pos=pos,
+                                                size=block, cmpratio=0, hash=chunker.zero_chunk_hash(block)),
+                              file_size=file_size)
+
+    asyncio.run(zero(block * 2))
+    assert (tmp_path / 'sparse.bin').read_bytes() == bytes(size)
+
+    # Creates missing files, and extends / truncates them
+    asyncio.run(zero(block, file_size=block * 3))
+    assert (tmp_path / 'sub' / 'sparse.bin').read_bytes() == bytes(block * 3)
+    asyncio.run(zero(0, file_size=block))
+    assert (tmp_path / 'sub' / 'sparse.bin').stat().st_size == block
+
+
+def test_physical_offset(tmp_path):
+    fio = fileio.FileIO(Path(tmp_path))
+    (tmp_path / 'a.bin').write_bytes(os.urandom(100000))
+    os.sync()
+    pos = fio.physical_offset('a.bin')
+    assert pos is None or pos >= 0
+    assert fio.is_rotational(os.stat(str(tmp_path / 'a.bin')).st_dev) in (True, False, None)
+
+
+def test_download_verify(tmp_path):
+    data = os.urandom(12345)
+    good = chunker.FileChunk(path='a.bin', pos=0, size=len(data), cmpratio=1, hash='')
+    hasher = chunker.ChunkHasher(1000)
+    hasher.update(data)
+    good.hash = hasher.result()
+    bad = chunker.FileChunk(path='b.bin', pos=0, size=len(data), cmpratio=1, hash='abcdef1234')
+
+    async def aiotests():
+        async def handler(request):
+            return aiohttp.web.Response(body=data)
+        app = aiohttp.web.Application()
+        app.router.add_get('/blob', handler)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f'http://127.0.0.1:{runner.addresses[0][1]}/blob'
+        try:
+            fio = fileio.FileIO(Path(tmp_path))
+            async with aiohttp.ClientSession() as session:
+                await fio.download_chunk(good, url, session, progr_func=lambda *a: None,
+                                         hasher=chunker.ChunkHasher(1000))
+                assert (tmp_path / 'a.bin').read_bytes() == data
+                with pytest.raises(IOError, match='Hash mismatch'):
+                    await fio.download_chunk(bad, url, session, progr_func=lambda *a: None,
+                                             hasher=chunker.ChunkHasher(1000))
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(aiotests())
+
+
+def test_ranged_download_resume(tmp_path):
+    data = os.urandom(12345)
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'a.bin').write_bytes(data)
+    (tmp_path / 'dst').mkdir()
+    (tmp_path / 'dst' / 'a.bin').write_bytes(data[:3000] + bytes(len(data) - 3000))  # (interrupted earlier)
+    full = chunker.ChunkHasher(1000)
+    full.update(data)
+    leaves = full.leaf_hashes + [chunker.HashFunc().update(data[12000:]).result()]
+    chunk = chunker.FileChunk(path='a.bin', pos=0, size=len(data), cmpratio=1, hash=full.result())
+
+    async def aiotests():
+        src = fileio.FileIO(tmp_path / 'src')
+
+        async def ranged(request):
+            return (await src.upload_chunk(chunk, request))[0]
+
+        async def whole(request):
+            return aiohttp.web.Response(body=data)
+
+        app = aiohttp.web.Application()
+        app.router.add_get('/ranged', ranged)
+        app.router.add_get('/whole', whole)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(base + '/ranged', headers={'Range': 'bytes=100-199'}) as resp:
+                    assert resp.status == 206 and await resp.read() == data[100:200]
+                    assert resp.headers['Content-Range'] == f'bytes 100-199/{len(data)}'
+                async with session.get(base + '/ranged', headers={'Range': f'bytes={len(data)}-'}) as resp:
+                    assert resp.status == 416
+
+                dst = fileio.FileIO(tmp_path / 'dst')
+                for url in ('/ranged', '/whole'):  # (server that ignores Range also works)
+                    hasher = chunker.ChunkHasher(1000, expected_leaves=leaves)
+                    hasher.skip(3000)
+                    await dst.download_chunk(chunk, base + url, session, progr_func=lambda *a: None,
+                                             hasher=hasher, offset=3000)
+                    assert (tmp_path / 'dst' / 'a.bin').read_bytes() == data
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(aiotests())
+
+
+def test_delta_download(tmp_path):
+    data = bytearray(os.urandom(12345))
+    old = bytes(data[:12200])  # (older, shorter version of the file)
+    data[2500:2600] = os.urandom(100)
+    data[5999:6001] = os.urandom(2)
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'a.bin').write_bytes(data)
+    (tmp_path / 'dst').mkdir()
+    (tmp_path / 'dst' / 'a.bin').write_bytes(old)
+    full = chunker.ChunkHasher(1000)
+    full.update(data)
+    leaves = full.leaf_hashes + [chunker.HashFunc().update(data[12000:]).result()]
+    chunk = chunker.FileChunk(path='a.bin', pos=0, size=len(data), cmpratio=1, hash=full.result())
+
+    assert chunker.changed_leaf_ranges(leaves[3:8], leaves, 1000, len(data), start=3000) == [(8000, len(data))]
+
+    async def aiotests():
+        src = fileio.FileIO(tmp_path / 'src')
+        got = []
+
+        async def ranged(request):
+            got.append(request.headers['Range'])
+            return (await src.upload_chunk(chunk, request))[0]
+
+        app = aiohttp.web.Application()
+        app.router.add_get('/ranged', ranged)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                dst = fileio.FileIO(tmp_path / 'dst')
+                hasher = chunker.ChunkHasher(1000, expected_leaves=leaves)
+                ranges = dst.changed_ranges(chunk, hasher)
+                assert ranges == [(2000, 3000), (5000, 7000), (12000, len(data))]
+                for start, end in ranges:
+                    hasher.skip(start)
+                    await dst.download_chunk(chunk, f'http://127.0.0.1:{runner.addresses[0][1]}/ranged', session,
+                                             file_size=len(data), progr_func=lambda *a: None,
+                                             hasher=hasher, offset=start, end=end)
+                hasher.skip(chunk.size)
+                assert hasher.result() == chunk.hash
+                assert got == ['bytes=2000-2999', 'bytes=5000-6999', f'bytes=12000-{len(data) - 1}']
+                assert (tmp_path / 'dst' / 'a.bin').read_bytes() == data
+                assert dst.changed_ranges(chunk, chunker.ChunkHasher(1000, expected_leaves=leaves)) == []
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(aiotests())
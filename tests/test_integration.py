@@ -8,7 +8,7 @@ from pathlib import Path
 from types import SimpleNamespace
 import asyncio, aiohttp, re
 
-from lanscatter import common, masternode, peernode
+from lanscatter import common, masternode, peernode, manifest
 
 
 """
@@ -275,6 +275,8 @@ async def _bad_request_tests(master_port):
                     if msg.type == aiohttp.WSMsgType.TEXT:
                         assert 'traceback' not in msg.data.lower()
                         recvd.append(json.loads(msg.data))
+                    elif msg.type == aiohttp.WSMsgType.BINARY:
+                        recvd.append(manifest.unpack_message(msg.data))
             with suppress(asyncio.TimeoutError):
                 await asyncio.wait_for(do_iter(), timeout=timeout)
             return recvd
@@ -358,9 +360,11 @@ def test_bad_protocol(test_dir_factory):
     _assert_node_basics(p, check_sync_results=False)
 
 
-def test_minimal_downloads(test_dir_factory):
+@pytest.mark.parametrize("chunking", ['fixed', 'cdc'])
+def test_minimal_downloads(test_dir_factory, chunking):
     """Test that each chunk is downloaded only once."""
-    master = _spawn_sync_process(f'master', True, test_dir_factory('master'), 0, PORT_BASE, ['--no-compress', '--rescan-interval', '2'])
+    master = _spawn_sync_process(f'master', True, test_dir_factory('master'), 0, PORT_BASE,
+                                 ['--no-compress', '--rescan-interval', '2', '--chunking', chunking])
     peer = _spawn_sync_process(f'leecher', False, test_dir_factory('leecher', keep_empty=True), PORT_BASE+1, PORT_BASE,)
 
     _wait_seconds(12)
@@ -428,7 +432,7 @@ def test_swarm__corruption__bad_protocol__uptodate__errors(test_dir_factory):
         time.sleep(0.1)  # stagger peer generation a bit
         if i == 1:
             # Start server after the first peer to test start order
-            master = _spawn_sync_process(f'master', True, master_dir, 0, master_port, ['--rescan-interval', '3'])
+            master = _spawn_sync_process(f'master', True, master_dir, 0, master_port, ['--rescan-interval', '3', '--leaf-hashes'])
 
     # Test a path that's an existing dir on master and a file on peer + vice versa
     _create_file(Path(master.dir)/'file_on_master', 123)
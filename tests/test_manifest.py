@@ -0,0 +1,53 @@
+import pytest, json
+from lanscatter import chunker, manifest
+
+CHUNK_SIZE = 5000
+
+
+def _batch():
+    b = chunker.SyncBatch(CHUNK_SIZE, CHUNK_SIZE // 5)
+    b.add(files=[chunker.FileAttribs(path='d', size=-1, mtime=123, chain_hash=None),
+                 chunker.FileAttribs(path='d/empty', size=0, mtime=1500000000, chain_hash=None),
+                 chunker.FileAttribs(path='d/äö', size=-1, mtime=-5, chain_hash=None)],
+          chunks=[chunker.FileChunk(path='d/a', pos=0, size=CHUNK_SIZE, cmpratio=0.25, hash='ab' * 12),
+                  chunker.FileChunk(path='d/a', pos=CHUNK_SIZE, size=10, cmpratio=None, hash='cd' * 12),
+                  chunker.FileChunk(path='d/ab', pos=0, size=10, cmpratio=1.0, hash='not hex'),
+                  chunker.FileChunk(path='e', pos=0, size=7, cmpratio=1/3, hash='ABCD')])
+    b.set_mtime('d', 124.5)
+    return b
+
+
+def test_manifest_roundtrip():
+    b = _batch()
+    data = manifest.encode_batch(b)
+    b2 = manifest.decode_batch(data)
+    assert b2 == b
+    assert b2.to_dict() == b.to_dict()
+    assert len(data) < len(json.dumps(b.to_dict())) / 2
+
+    empty = chunker.SyncBatch()
+    assert manifest.decode_batch(manifest.encode_batch(empty)) == empty
+    sha = chunker.SyncBatch(CHUNK_SIZE, CHUNK_SIZE // 5, hash_algo='sha256')
+    assert manifest.decode_batch(manifest.encode_batch(sha)).hash_algo == 'sha256'
+    cdc = chunker.SyncBatch(CHUNK_SIZE, CHUNK_SIZE // 5, chunking='cdc')
+    assert manifest.decode_batch(manifest.encode_batch(cdc)).chunking == 'cdc'
+
+    # Leaf hashes survive
+    leaved = _batch()
+    leaved.add(chunk_leaves={'ab' * 12: ['01' * 12, 'not hex'], 'ABCD': ['23' * 12], 'nonexisting': ['45' * 12]})
+    assert manifest.decode_batch(manifest.encode_batch(leaved)).chunk_leaves == \
+        {'ab' * 12: ['01' * 12, 'not hex'], 'ABCD': ['23' * 12]}
+
+    with pytest.raises(manifest.ManifestError):
+        manifest.decode_batch(b'LSJ1' + data[4:])
+    with pytest.raises(manifest.ManifestError):
+        manifest.decode_batch(data[:-3])
+    with pytest.raises(manifest.ManifestError):
+        manifest.decode_batch(data + b'\0')
+
+
+def test_manifest_message():
+    b = _batch()
+    msg = manifest.unpack_message(manifest.pack_message({'action': 'new_batch', 'digest': b.digest()}, b))
+    assert msg['action'] == 'new_batch' and msg['digest'] == b.digest()
+    assert manifest.decode_batch(msg['manifest']) == b
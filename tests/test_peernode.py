@@ -0,0 +1,46 @@
+import asyncio, os
+from pathlib import Path
+from lanscatter import chunker, fileio
+from lanscatter.peernode import PeerNode
+
+CHUNK_SIZE = 5000
+SUB_CHUNK_SIZE = 1000
+
+
+def _scan(path: Path):
+    return asyncio.run(chunker.scan_dir(
+        fileio.FileIO(path), CHUNK_SIZE, SUB_CHUNK_SIZE, old_batch=None,
+        progress_func=lambda *a, **kw: None, test_compress=False))[0]
+
+
+def test_fixups_keep_unlisted_files_during_partial_batch(tmp_path):
+    """Peer that already has a file shouldn't forget its chunks while master hasn't listed it yet."""
+    (tmp_path / 'master').mkdir()
+    (tmp_path / 'peer').mkdir()
+    b_data = os.urandom(CHUNK_SIZE * 2)
+    (tmp_path / 'master' / 'a.bin').write_bytes(os.urandom(CHUNK_SIZE + 10))
+    (tmp_path / 'master' / 'b.bin').write_bytes(b_data)
+    (tmp_path / 'peer' / 'b.bin').write_bytes(b_data)
+    os.utime(tmp_path / 'peer' / 'b.bin', (1234567, 1234567))
+
+    complete = _scan(tmp_path / 'master')
+    partial = _scan(tmp_path / 'master')
+    partial.discard(paths=['b.bin'])
+    local = _scan(tmp_path / 'peer')
+
+    async def aiotests():
+        peer = PeerNode(str(tmp_path / 'peer'), lambda *a, **kw: None, 1, 0, 0, watch_dir=False)
+        peer.local_batch = local
+
+        peer.remote_batch, peer.remote_batch_complete = partial, False
+        await peer.local_file_fixups()
+        assert 'b.bin' in peer.local_batch.files
+        assert {c.path for c in peer.local_batch.chunk_diff(partial).there_only} == {'a.bin'}
+
+        peer.remote_batch, peer.remote_batch_complete = complete, True
+        await peer.local_file_fixups()
+        assert {c.path for c in peer.local_batch.chunk_diff(complete).there_only} == {'a.bin'}
+        assert peer.local_batch.files['b.bin'] == complete.files['b.bin']
+        assert not peer.full_rescan_trigger.is_set()
+
+    asyncio.run(aiotests())